@@ -0,0 +1,291 @@
+'''
+An asyncio front end to the database
+'''
+# Every database call blocks on disk I/O, so calls are run on a bounded pool
+# of executor threads. Gets of a key which is already being read share the
+# read in flight. At most max_writes writes are admitted at once, a write
+# over that bound is held back and its future does not resolve until the
+# write was admitted and done, drain lets a producer wait until no write is
+# held back. Writes to the same key are never run concurrently so revisions
+# keep their order.
+# The methods return futures instead of using coroutine syntax so that the
+# module still compiles where asyncio is not available.
+
+# Import python libs
+import functools
+import itertools
+import collections
+
+# Import third party libs
+try:
+    import asyncio
+    import concurrent.futures
+    HAS_ASYNCIO = True
+except ImportError:
+    HAS_ASYNCIO = False
+
+
+class AsyncDB(object):
+    '''
+    Wrap an opened maras.db.DB so that its operations return awaitables.
+    More than one worker needs the DB to be opened with threads
+    '''
+    def __init__(self, db, workers=None, max_writes=64):
+        if not HAS_ASYNCIO:
+            raise ValueError('asyncio is not available')
+        if workers is None:
+            workers = max(db.threads, 1)
+        if workers > 1 and not db.threads:
+            raise ValueError('More than one worker needs a DB with threads')
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.max_writes = max_writes
+        # Reads in flight by (key, id_), writes in flight and the keys they
+        # touch, the (keys, func, args, future) of admitted writes waiting
+        # for their keys and of the writes held back over max_writes
+        self.reads = {}
+        self.writes = 0
+        self.w_keys = collections.Counter()
+        self.queue = collections.deque()
+        self.held = collections.deque()
+        self.drains = []
+        self.idle = []
+        self.n_reads = 0
+        self.coalesced = 0
+        self.waits = 0
+
+    def _loop(self):
+        '''
+        Return the event loop of the caller
+        '''
+        return asyncio.get_event_loop()
+
+    def _run(self, func, *args):
+        '''
+        Run func on the executor and return its future
+        '''
+        return self._loop().run_in_executor(
+                self.executor,
+                functools.partial(func, *args))
+
+    def _done(self, result):
+        '''
+        Return a future already resolved to result
+        '''
+        fut = self._loop().create_future()
+        fut.set_result(result)
+        return fut
+
+    def get(self, key, id_=None):
+        '''
+        Return an awaitable of the entry of key, concurrent gets of the same
+        key share a single read
+        '''
+        req = (key, id_)
+        fut = self.reads.get(req)
+        if fut is None:
+            self.n_reads += 1
+            fut = self._run(self.db.get, key, id_)
+            self.reads[req] = fut
+            fut.add_done_callback(functools.partial(self._read_done, req))
+        else:
+            self.coalesced += 1
+        # Shield the shared read from the cancellation of a single caller
+        return asyncio.shield(fut)
+
+    def _read_done(self, req, fut):
+        '''
+        Forget a finished read
+        '''
+        if self.reads.get(req) is fut:
+            del self.reads[req]
+
+    def get_many(self, keys):
+        '''
+        Return an awaitable of the (entries, missing) of DB.get_many
+        '''
+        self.n_reads += 1
+        return self._run(self.db.get_many, list(keys))
+
+    def scan(self, prefix='', keys_only=False, batch=1024):
+        '''
+        Return an asynchronous iterator over DB.scan, the storage is read a
+        batch at a time on the executor
+        '''
+        return AsyncScan(self, prefix, keys_only, batch)
+
+    def insert(self, data, key, id_=None, stor=None):
+        '''
+        Return an awaitable of the index reference of the inserted data
+        '''
+        return self._write([key], self.db.insert, data, key, id_, stor)
+
+    def insert_many(self, records, stor=None):
+        '''
+        Return an awaitable of the index references of DB.insert_many
+        '''
+        records = list(records)
+        return self._write(
+                [rec[1] for rec in records],
+                self.db.insert_many,
+                records,
+                stor)
+
+    def _write(self, keys, func, *args):
+        '''
+        Admit a write, or hold it back while max_writes writes are
+        admitted, and return a future which resolves once it is done
+        '''
+        for key in keys:
+            # Later gets must not join a read started before the write
+            self.reads.pop((key, None), None)
+        fut = self._loop().create_future()
+        self.held.append((keys, func, args, fut))
+        self._submit()
+        return fut
+
+    def _submit(self):
+        '''
+        Admit held back writes while there is room and run the admitted
+        writes whose keys no earlier write still holds. At most max_writes
+        writes are looked at
+        '''
+        while self.held and self.writes + len(self.queue) < self.max_writes:
+            item = self.held.popleft()
+            if not item[3].cancelled():
+                self.queue.append(item)
+        blocked = set()
+        keep = collections.deque()
+        while self.queue:
+            keys, func, args, fut = item = self.queue.popleft()
+            if fut.cancelled():
+                continue
+            if any(key in blocked or self.w_keys[key] for key in keys):
+                blocked.update(keys)
+                keep.append(item)
+                continue
+            self.writes += 1
+            self.w_keys.update(keys)
+            run = self._run(func, *args)
+            run.add_done_callback(
+                    functools.partial(self._written, keys, fut))
+        self.queue = keep
+        if not self.held:
+            self._wake(self.drains)
+            if not self.writes and not self.queue:
+                self._wake(self.idle)
+
+    def _written(self, keys, fut, run):
+        '''
+        Pass the result of a finished write on and submit the next ones
+        '''
+        self.writes -= 1
+        self.w_keys.subtract(keys)
+        for key in keys:
+            if not self.w_keys[key]:
+                del self.w_keys[key]
+        if not fut.cancelled():
+            if run.exception() is not None:
+                fut.set_exception(run.exception())
+            else:
+                fut.set_result(run.result())
+        self._submit()
+
+    def _wake(self, waiters):
+        '''
+        Resolve and empty a list of waiting futures
+        '''
+        while waiters:
+            fut = waiters.pop()
+            if not fut.done():
+                fut.set_result(None)
+
+    def drain(self):
+        '''
+        Return an awaitable which resolves once no write is held back,
+        producers which do not await their writes should await this
+        '''
+        if not self.held:
+            return self._done(None)
+        self.waits += 1
+        fut = self._loop().create_future()
+        self.drains.append(fut)
+        return fut
+
+    def flush(self):
+        '''
+        Return an awaitable which resolves once every queued write is done
+        '''
+        if not self.writes and not self.queue and not self.held:
+            return self._done(None)
+        fut = self._loop().create_future()
+        self.idle.append(fut)
+        return fut
+
+    def sync(self):
+        '''
+        Return an awaitable of DB.sync
+        '''
+        return self._run(self.db.sync)
+
+    def close(self):
+        '''
+        Return an awaitable which finishes the queued writes, closes the
+        database and shuts the executor down
+        '''
+        loop = self._loop()
+        ret = loop.create_future()
+
+        def _close(fut):
+            run = self._run(self.db.close)
+            run.add_done_callback(_closed)
+
+        def _closed(run):
+            self.executor.shutdown(wait=False)
+            if run.exception() is not None:
+                ret.set_exception(run.exception())
+            else:
+                ret.set_result(None)
+        self.flush().add_done_callback(_close)
+        return ret
+
+    def stats(self):
+        '''
+        Return the read, coalescing and write queue counters
+        '''
+        return {
+                'reads': self.n_reads,
+                'coalesced': self.coalesced,
+                'writes': self.writes,
+                'queued': len(self.queue),
+                'held': len(self.held),
+                'drain_waits': self.waits,
+                }
+
+
+class AsyncScan(object):
+    '''
+    Asynchronous iterator over the items of DB.scan
+    '''
+    def __init__(self, adb, prefix, keys_only, batch):
+        self.adb = adb
+        self.gen = adb.db.scan(prefix, keys_only, batch)
+        self.batch = batch
+        self.items = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.items:
+            return self.adb._done(self.items.popleft())
+        return self.adb._run(self._next)
+
+    def _next(self):
+        '''
+        Read the next batch on the executor and return its first item
+        '''
+        self.items.extend(itertools.islice(self.gen, self.batch))
+        if not self.items:
+            raise StopAsyncIteration
+        return self.items.popleft()
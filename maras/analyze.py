@@ -0,0 +1,471 @@
+'''
+Bulk analysis of the bucket regions of hash maps with NumPy
+
+    python -m maras.analyze <db_root> [--prefix PREFIX]
+'''
+# The bucket region of a map is mapped read only as a NumPy structured array
+# built from the fmt, entry_map, bucket_size and header_len of the map
+# header, the buckets of a fixed map follow its header in midx_N and the
+# pages of a growable map fill bkt_N past its state. Occupancy, empty runs
+# and prev offsets are then computed over whole maps at once instead of one
+# bucket at a time through the index.
+# contains answers whether keys are stored for a batch of keys. The keys are
+# hashed one by one, but the buckets of every map are then probed for all of
+# the keys of its directory at once, following the same probe order as
+# lookups. Buckets are read as they are on disk, writes of other processes
+# in flight may or may not be seen.
+
+# Import python libs
+import os
+import re
+import sys
+import struct
+import argparse
+
+# Import maras libs
+import maras.db
+import maras.index.dhm
+
+# Import third party libs
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# struct format codes and the NumPy type codes of the same size
+STRUCT_TYPES = {
+        'c': 'S1',
+        'b': 'i1',
+        'B': 'u1',
+        '?': 'b1',
+        'h': 'i2',
+        'H': 'u2',
+        'i': 'i4',
+        'I': 'u4',
+        'l': 'i4',
+        'L': 'u4',
+        'q': 'i8',
+        'Q': 'u8',
+        'f': 'f4',
+        'd': 'f8',
+        }
+BYTE_ORDERS = {
+        '<': '<',
+        '>': '>',
+        '!': '>',
+        '=': '=',
+        '@': '=',
+        }
+FMT_RE = re.compile(r'(\d*)([a-zA-Z?])')
+# The bucket placement value is taken from the first 16 hex digits of the
+# bucket key
+PLACE_DIGITS = 16
+PERCENTILES = (50, 90, 99)
+
+if HAS_NUMPY:
+    # Value of every hex digit byte
+    HEX_VALUES = numpy.zeros(256, numpy.uint64)
+    for _ind, _char in enumerate('0123456789abcdef'):
+        HEX_VALUES[ord(_char)] = _ind
+        HEX_VALUES[ord(_char.upper())] = _ind
+
+
+def _check():
+    '''
+    Raise ValueError if NumPy is not available
+    '''
+    if not HAS_NUMPY:
+        raise ValueError('Map analysis needs numpy')
+
+
+def bucket_dtype(header):
+    '''
+    Return the NumPy structured type of one bucket of a map, fields are
+    named from the entry_map of the header and fields past it are named
+    f<N>
+    '''
+    _check()
+    fmt = header['fmt']
+    order = '@'
+    if fmt[:1] in BYTE_ORDERS:
+        order = fmt[0]
+        fmt = fmt[1:]
+    names = []
+    formats = []
+    offsets = []
+    done = ''
+    for count, code in FMT_RE.findall(fmt):
+        count = int(count) if count else 1
+        if code in 'sp':
+            fields = [('S{0}'.format(count), '{0}{1}'.format(count, code))]
+        elif code == 'x':
+            done += '{0}x'.format(count)
+            continue
+        elif code in STRUCT_TYPES:
+            fields = [(STRUCT_TYPES[code], code)] * count
+        else:
+            raise ValueError(
+                    'Bucket format code {0} is not supported'.format(code))
+        for np_type, s_code in fields:
+            # The offset includes any alignment padding before the field
+            offsets.append(struct.calcsize('{0}{1}0{2}'.format(
+                order, done, s_code[-1])))
+            if np_type[0] != 'S' and np_type != 'b1':
+                np_type = '{0}{1}'.format(BYTE_ORDERS[order], np_type)
+            formats.append(np_type)
+            ind = len(names)
+            if ind < len(header['entry_map']):
+                names.append(str(header['entry_map'][ind]))
+            else:
+                names.append('f{0}'.format(ind))
+            done += s_code
+    return numpy.dtype({
+        'names': names,
+        'formats': formats,
+        'offsets': offsets,
+        'itemsize': header['bucket_size']})
+
+
+def page_dtype(header):
+    '''
+    Return the NumPy structured type of one page of a growable map
+    '''
+    _check()
+    return numpy.dtype({
+        'names': ['flag', 'slots'],
+        'formats': ['>u8', (bucket_dtype(header), (header['slots'],))],
+        'offsets': [0, maras.index.dhm.PAGE_FLAG.size],
+        'itemsize': header['page_size']})
+
+
+def _map_array(fn_, dtype, offset, count=None):
+    '''
+    Return count records of dtype from offset in fn_ as a read only array,
+    records past the end of the file read as zeros. By default all of the
+    whole and partial records in the file are returned
+    '''
+    size = os.path.getsize(fn_)
+    whole = max(size - offset, 0) // dtype.itemsize
+    if count is None:
+        count = -(-max(size - offset, 0) // dtype.itemsize)
+    if whole >= count:
+        if not count:
+            return numpy.zeros(0, dtype)
+        return numpy.memmap(fn_, dtype, 'r', offset, (count,))
+    # The file ends inside the region, never written buckets are empty
+    ret = numpy.zeros(count, dtype)
+    raw = ret.view(numpy.uint8)
+    with open(fn_, 'rb') as fp_:
+        fp_.seek(offset)
+        data = fp_.read(min(size - offset, count * dtype.itemsize))
+    raw[:len(data)] = numpy.frombuffer(data, numpy.uint8)
+    return ret
+
+
+def buckets(index, fn_):
+    '''
+    Return the buckets of a fixed map as a structured array of h_limit + 1
+    buckets, or the pages of a growable map as a structured array of pages
+    holding the flag and the slots of each page
+    '''
+    _check()
+    map_data = index.maps.get(fn_) or index.open_map(fn_)
+    if map_data.get('grow'):
+        return _map_array(
+                index._bkt_fn(map_data),
+                page_dtype(map_data),
+                maras.index.dhm.BKT_HEAD)
+    return _map_array(
+            fn_,
+            bucket_dtype(map_data),
+            map_data['header_len'],
+            map_data['h_limit'] + 1)
+
+
+def _place_values(h_keys, size):
+    '''
+    Return the placement values of an array of hex bucket keys
+    '''
+    digits = min(PLACE_DIGITS, size)
+    raw = numpy.ascontiguousarray(h_keys, 'S{0}'.format(size))
+    nibbles = HEX_VALUES[raw.view(numpy.uint8).reshape(-1, size)[:, :digits]]
+    vals = numpy.zeros(len(h_keys), numpy.uint64)
+    shift = numpy.uint64(4)
+    for col in range(digits):
+        vals = numpy.left_shift(vals, shift) | nibbles[:, col]
+    return vals
+
+
+def _homes(map_data, state, h_vals):
+    '''
+    Return the home pages of placement values under a growable map state
+    '''
+    base = numpy.uint64(map_data['pages'] << state[0])
+    pages = h_vals % base
+    split = pages < state[1]
+    pages[split] = h_vals[split] % (base * numpy.uint64(2))
+    return pages.astype(numpy.int64)
+
+
+def _runs(empty):
+    '''
+    Return the lengths of the runs of True in a boolean array
+    '''
+    edges = numpy.diff(numpy.concatenate(([0], empty.view(numpy.int8), [0])))
+    return numpy.flatnonzero(edges == -1) - numpy.flatnonzero(edges == 1)
+
+
+def _dist(vals):
+    '''
+    Return the summary of an array of values, None if it is empty
+    '''
+    if not len(vals):
+        return None
+    ret = {
+            'min': int(vals.min()),
+            'max': int(vals.max()),
+            'mean': float(vals.mean()),
+            }
+    for pct, val in zip(PERCENTILES, numpy.percentile(vals, PERCENTILES)):
+        ret['p{0}'.format(pct)] = float(val)
+    return ret
+
+
+def _live(index, map_data, pages):
+    '''
+    Return the mask of the slots of a growable map holding a key, slots
+    left behind by a split that has not cleared them yet are not live
+    '''
+    slots = pages['slots']
+    used = (slots['key'] != '') & (slots['prev'] != 0)
+    if not used.any():
+        return used
+    state = index._read_state(map_data)
+    size = slots.dtype['key'].itemsize
+    page_nums = numpy.repeat(
+            numpy.arange(len(pages)),
+            map_data['slots']).reshape(used.shape)
+    homes = numpy.zeros(used.shape, numpy.int64)
+    homes[used] = _homes(
+            map_data,
+            state,
+            _place_values(slots['key'][used], size))
+    return used & (homes <= page_nums)
+
+
+def map_stats(index, fn_):
+    '''
+    Return the occupancy, empty run and prev offset statistics of a map,
+    and the values of the prev offsets of its used buckets
+    '''
+    _check()
+    arr = buckets(index, fn_)
+    map_data = index.maps[fn_]
+    ret = {
+            'map': fn_,
+            'num': map_data['num'],
+            'grow': bool(map_data.get('grow')),
+            }
+    if ret['grow']:
+        used = _live(index, map_data, arr)
+        stale = (arr['slots']['key'] != '') & ~used
+        fill = used.sum(axis=1)
+        level, split, count = index._read_state(map_data)
+        ret.update({
+            'pages': len(arr),
+            'slots': map_data['slots'],
+            'level': level,
+            'split': split,
+            'count': count,
+            'spilled': int((arr['flag'] != 0).sum()),
+            'stale': int(stale.sum()),
+            'page_fill': numpy.bincount(
+                fill,
+                minlength=map_data['slots'] + 1).tolist(),
+            })
+        prevs = arr['slots']['prev'][used]
+        used = used.ravel()
+    else:
+        used = arr['prev'] != 0
+        prevs = arr['prev'][used]
+    runs = _runs(~used)
+    ret.update({
+        'buckets': len(used),
+        'used': int(used.sum()),
+        'occupancy': float(used.mean()) if len(used) else 0.0,
+        'empty_runs': len(runs),
+        'longest_empty': int(runs.max()) if len(runs) else 0,
+        'mean_empty': float(runs.mean()) if len(runs) else 0.0,
+        'prev': _dist(prevs),
+        })
+    return ret, prevs
+
+
+def analyze(db, prefix=''):
+    '''
+    Return the statistics of every map of the primary index of an open
+    database holding keys starting with prefix, and totals across them.
+    depth counts the keys stored in the maps of each number, keys in maps
+    past the first collided in every map before
+    '''
+    _check()
+    index = db.indexes[db.primary]
+    maps = []
+    prevs = []
+    depth = {}
+    dirs = set()
+    for fn_ in index.iter_prefix_maps(prefix):
+        stats, map_prevs = map_stats(index, fn_)
+        maps.append(stats)
+        prevs.append(map_prevs)
+        depth[stats['num']] = depth.get(stats['num'], 0) + stats['used']
+        dirs.add(os.path.dirname(fn_))
+    total = sum(stats['buckets'] for stats in maps)
+    used = sum(stats['used'] for stats in maps)
+    prevs = numpy.concatenate(prevs) if prevs else numpy.zeros(0)
+    return {
+            'maps': maps,
+            'totals': {
+                'maps': len(maps),
+                'dirs': len(dirs),
+                'buckets': total,
+                'used': used,
+                'occupancy': float(used) / total if total else 0.0,
+                'max_depth': max(depth) if depth else 0,
+                'depth': depth,
+                'overflow': used - depth.get(1, 0),
+                'prev': _dist(prevs),
+                },
+            }
+
+
+def _fixed_probe(index, map_data, num, keys, h_keys, h_vals):
+    '''
+    Return the masks of the keys found in a fixed map and of the keys whose
+    bucket holds another key, which are looked for in the next map
+    '''
+    arr = buckets(index, map_data['fn'])
+    if 'place' in map_data:
+        # calc_position over the whole batch, the sum may wrap around but
+        # the masked bits are the same
+        limit = numpy.uint64(map_data['h_limit'])
+        step = (h_vals // (limit + numpy.uint64(1))) | numpy.uint64(1)
+        pos = ((h_vals + numpy.uint64(num - 1) * step) & limit).astype(
+                numpy.int64)
+        cmp_keys = h_keys
+    else:
+        # Maps written before digest placement hold the raw keys
+        pos = numpy.array([
+            maras.index.dhm.legacy_position(
+                key,
+                map_data['h_limit'],
+                1,
+                0)
+            for key in keys], numpy.int64)
+        cmp_keys = numpy.array(
+                list(keys),
+                'S{0}'.format(arr.dtype['key'].itemsize))
+    found = arr[pos]
+    same = found['key'] == cmp_keys
+    return same & (found['prev'] != 0), ~same & (found['key'] != '')
+
+
+def _grow_probe(index, map_data, h_keys):
+    '''
+    Return the mask of the keys found in a growable map, pages are read
+    from the home page of every key for as long as their spill flag is set
+    '''
+    arr = buckets(index, map_data['fn'])
+    hit = numpy.zeros(len(h_keys), bool)
+    if not len(arr):
+        return hit
+    size = arr.dtype['slots'].base['key'].itemsize
+    pages = _homes(
+            map_data,
+            index._read_state(map_data),
+            _place_values(h_keys, size))
+    todo = numpy.arange(len(h_keys))
+    while len(todo):
+        # Pages past the end of the file are empty
+        todo = todo[pages[todo] < len(arr)]
+        rows = arr[pages[todo]]
+        slots = rows['slots']
+        match = ((slots['key'] == h_keys[todo][:, None]) &
+                 (slots['prev'] != 0)).any(axis=1)
+        hit[todo[match]] = True
+        todo = todo[~match & (rows['flag'] != 0)]
+        pages[todo] += 1
+    return hit
+
+
+def contains(db, keys):
+    '''
+    Return a boolean array telling for every key of keys if the primary
+    index of the open database holds it
+    '''
+    _check()
+    index = db.indexes[db.primary]
+    keys = list(keys)
+    ret = numpy.zeros(len(keys), bool)
+    groups = {}
+    for ind, key in enumerate(keys):
+        groups.setdefault(index._hm_dir(key), []).append(ind)
+    h_type = 'S{0}'.format(index.key_size)
+    for hmdir, inds in groups.items():
+        inds = numpy.array(inds)
+        digests = [index._key_digest(keys[ind]) for ind in inds]
+        h_keys = numpy.array([digest[0] for digest in digests], h_type)
+        h_vals = numpy.array([digest[1] for digest in digests], numpy.uint64)
+        num = 1
+        while len(inds):
+            fn_ = os.path.join(hmdir, 'midx_{0}'.format(num))
+            try:
+                map_data = index.maps.get(fn_) or index.open_map(fn_)
+            except IOError:
+                break
+            if map_data.get('grow'):
+                ret[inds[_grow_probe(index, map_data, h_keys)]] = True
+                break
+            hit, more = _fixed_probe(
+                    index,
+                    map_data,
+                    num,
+                    [keys[ind] for ind in inds],
+                    h_keys,
+                    h_vals)
+            ret[inds[hit]] = True
+            inds = inds[more]
+            h_keys = h_keys[more]
+            h_vals = h_vals[more]
+            num += 1
+    return ret
+
+
+def main(argv=None):
+    '''
+    Print the statistics of the maps of a database and their totals
+    '''
+    parser = argparse.ArgumentParser(prog='python -m maras.analyze')
+    parser.add_argument('db_root')
+    parser.add_argument('--prefix', default='')
+    opts = parser.parse_args(argv)
+    if not HAS_NUMPY:
+        print('Map analysis needs numpy')
+        return 1
+    # Analysis only reads, the manifest is left alone
+    db = maras.db.DB(opts.db_root, manifest=False)
+    db.open_db()
+    db.add_index('primary')
+    try:
+        ret = analyze(db, opts.prefix)
+    finally:
+        db.close()
+    for stats in ret['maps'] + [ret['totals']]:
+        print(' '.join(
+            '{0}={1}'.format(name, stats[name]) for name in sorted(stats)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3 @@
+'''
+Benchmarks of the database engine, run with python -m maras.bench
+'''
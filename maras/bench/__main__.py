@@ -0,0 +1,185 @@
+'''
+Command line interface to the benchmarks
+
+    python -m maras.bench --keys flat,nested,zipf --num 20000 --out run.json
+    python -m maras.bench --compare run.json
+    python -m maras.bench --suite hashes --num 500000
+    python -m maras.bench --suite scale --num 10000000 --fixed
+'''
+# Import python libs
+import sys
+import json
+import argparse
+
+# Import maras libs
+import maras.bench.aio
+import maras.bench.hashes
+import maras.bench.keys
+import maras.bench.meter
+import maras.bench.ordered
+import maras.bench.run
+import maras.bench.scale
+import maras.bench.shared
+import maras.bench.sync
+import maras.bench.threads
+
+# Benchmarks of single features, each returns a list of result dicts. A
+# result with ok set to False failed a check made during the run
+SUITES = {
+        'async': maras.bench.aio.bench,
+        'hashes': maras.bench.hashes.bench,
+        'meter': maras.bench.meter.bench,
+        'ordered': maras.bench.ordered.bench,
+        'scale': maras.bench.scale.bench,
+        'shared-readers': maras.bench.shared.readers,
+        'shared-stress': maras.bench.shared.stress,
+        'sync': maras.bench.sync.bench,
+        'threads': maras.bench.threads.bench,
+        }
+
+
+def parse(argv):
+    '''
+    Parse the command line
+    '''
+    parser = argparse.ArgumentParser(prog='python -m maras.bench')
+    parser.add_argument(
+            '--suite',
+            choices=sorted(SUITES),
+            help='Run a feature benchmark instead of the key set runs')
+    parser.add_argument(
+            '--keys',
+            default='flat,nested,zipf',
+            help='Comma separated key sets, of {0}'.format(
+                ', '.join(sorted(maras.bench.keys.KEY_SETS))))
+    parser.add_argument('--num', type=int, default=10000)
+    parser.add_argument('--value-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+            '--hash-limit',
+            type=lambda val: int(val, 0),
+            default=0xfffff)
+    maps = parser.add_mutually_exclusive_group()
+    maps.add_argument(
+            '--growable',
+            dest='growable',
+            action='store_true',
+            default=True,
+            help='Use growable hash maps, the default')
+    maps.add_argument(
+            '--fixed',
+            dest='growable',
+            action='store_false',
+            help='Use fixed hash maps of --hash-limit buckets')
+    parser.add_argument('--fmt', default='>KsQ')
+    parser.add_argument('--key-delim', default='/')
+    parser.add_argument('--sync', default='none')
+    parser.add_argument(
+            '--path',
+            help='Run in this directory and keep the database, only with '
+                 'a single key set')
+    parser.add_argument('--out', help='Write the results as json to this file')
+    parser.add_argument(
+            '--compare',
+            help='Compare the results against an earlier json file')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def report(res):
+    '''
+    Return a one line summary of a result
+    '''
+    return ('{0:<8} insert {1:>8.0f}/s p50 {2:.3f}ms p99 {3:.3f}ms  '
+            'get {4:>8.0f}/s p50 {5:.3f}ms p99 {6:.3f}ms  '
+            'fanout {7:.3f} max {8}  maps {9} disk {10}').format(
+                    res['settings']['key_set'],
+                    res['insert']['ops'],
+                    res['insert']['p50'] * 1000,
+                    res['insert']['p99'] * 1000,
+                    res['get']['ops'],
+                    res['get']['p50'] * 1000,
+                    res['get']['p99'] * 1000,
+                    res['fanout']['mean'],
+                    res['fanout']['max'],
+                    res['disk']['maps'],
+                    res['disk']['total'])
+
+
+def row_line(row):
+    '''
+    Return a feature benchmark result as one line of name=value pairs
+    '''
+    vals = []
+    for name in sorted(row):
+        val = row[name]
+        if isinstance(val, float):
+            val = '{0:.4g}'.format(val)
+        vals.append('{0}={1}'.format(name, val))
+    return ' '.join(vals)
+
+
+def run_suite(opts):
+    '''
+    Run a feature benchmark, returns 1 if a check failed
+    '''
+    rows = SUITES[opts.suite](
+            num=opts.num,
+            seed=opts.seed,
+            value_size=opts.value_size,
+            hash_limit=opts.hash_limit,
+            growable=opts.growable,
+            sync=opts.sync)
+    for row in rows:
+        print(row_line(row))
+    if opts.out:
+        with open(opts.out, 'w') as fp_:
+            json.dump(rows, fp_, indent=2, sort_keys=True)
+    return 1 if any(row.get('ok') is False for row in rows) else 0
+
+
+def main(argv=None):
+    '''
+    Run the benchmarks, returns 2 if a compared metric regressed and 1 if a
+    feature benchmark failed a check
+    '''
+    opts = parse(argv)
+    if opts.suite:
+        return run_suite(opts)
+    key_sets = [name for name in opts.keys.split(',') if name]
+    if opts.path and len(key_sets) > 1:
+        sys.stderr.write('--path can only be used with a single key set\n')
+        return 1
+    results = []
+    for key_set in key_sets:
+        res = maras.bench.run.bench(
+                key_set,
+                num=opts.num,
+                value_size=opts.value_size,
+                seed=opts.seed,
+                path=opts.path,
+                hash_limit=opts.hash_limit,
+                growable=opts.growable,
+                fmt=opts.fmt,
+                key_delim=opts.key_delim,
+                sync=opts.sync)
+        print(report(res))
+        results.append(res)
+    if opts.out:
+        with open(opts.out, 'w') as fp_:
+            json.dump(results, fp_, indent=2, sort_keys=True)
+    if not opts.compare:
+        return 0
+    with open(opts.compare) as fp_:
+        old = json.load(fp_)
+    regressed = False
+    for row in maras.bench.run.compare(old, results, opts.threshold):
+        regressed = regressed or row[5]
+        print('{0:<8} {1:<12} {2:>14.6g} {3:>14.6g} {4:>+8.1%}{5}'.format(
+                row[0], row[1], row[2], row[3], row[4],
+                '  REGRESSED' if row[5] else ''))
+    return 2 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
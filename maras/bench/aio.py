@@ -0,0 +1,116 @@
+'''
+Measure the latency of AsyncDB operations under concurrent clients
+'''
+# Every client issues its next operation as soon as the previous one is
+# done, so clients operations are in flight at any time. Gets are run over
+# every key and over a few hot keys, where concurrent gets of a key share
+# their disk read. The clients are chains of callbacks instead of
+# coroutines so that the module compiles where asyncio is missing.
+
+# Import python libs
+import random
+import shutil
+import timeit
+import tempfile
+import functools
+
+# Import maras libs
+import maras.db
+import maras.aio
+import maras.bench.run
+
+# Import third party libs
+if maras.aio.HAS_ASYNCIO:
+    import asyncio
+
+CLIENT_COUNTS = (1, 16, 256)
+HOT_KEYS = 20
+
+
+def clients_run(adb, loop, op, keys, clients, ops, rnd, value):
+    '''
+    Run ops operations from clients concurrent clients and return the
+    latencies and the number of failed operations
+    '''
+    timer = timeit.default_timer
+    finished = loop.create_future()
+    lats = []
+    state = {'issued': 0, 'errors': 0}
+
+    def _next():
+        if state['issued'] >= ops:
+            return
+        state['issued'] += 1
+        key = rnd.choice(keys)
+        if op == 'get':
+            fut = adb.get(key)
+        else:
+            fut = adb.insert(value, key)
+        fut.add_done_callback(functools.partial(_done, timer()))
+
+    def _done(start, fut):
+        lats.append(timer() - start)
+        if fut.exception() is not None:
+            state['errors'] += 1
+        if len(lats) == ops:
+            finished.set_result(None)
+        else:
+            _next()
+    start = timer()
+    for _ in range(clients):
+        _next()
+    loop.run_until_complete(finished)
+    return lats, timer() - start, state['errors']
+
+
+def bench(
+        num=10000,
+        seed=0,
+        value_size=64,
+        workers=8,
+        client_counts=CLIENT_COUNTS,
+        **kwargs):
+    '''
+    Return the throughput and latency of gets and inserts through AsyncDB
+    for every client count, and of gets of HOT_KEYS keys
+    '''
+    rnd = random.Random(seed)
+    value = 'x' * value_size
+    keys = ['d{0}/k{1}'.format(ind % 16, ind) for ind in range(num)]
+    runs = [('get', keys, count) for count in client_counts]
+    runs.append(('get', keys[:HOT_KEYS], client_counts[-1]))
+    runs.extend(('insert', keys, count) for count in client_counts)
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    rows = []
+    try:
+        db = maras.db.DB(path, threads=workers)
+        db.create(sync='none')
+        db.add_index('bench')
+        db.insert_many([(value, key) for key in keys])
+        adb = maras.aio.AsyncDB(db, workers)
+        for op, run_keys, clients in runs:
+            before = adb.stats()
+            lats, elapsed, errors = clients_run(
+                    adb, loop, op, run_keys, clients, num, rnd, value)
+            after = adb.stats()
+            timing = maras.bench.run.timings(lats, elapsed)
+            rows.append({
+                'op': op,
+                'clients': clients,
+                'keys': len(run_keys),
+                'workers': workers,
+                'ops': timing['ops'],
+                'p50_ms': timing['p50'] * 1000,
+                'p99_ms': timing['p99'] * 1000,
+                'disk_reads': after['reads'] - before['reads'],
+                'coalesced': after['coalesced'] - before['coalesced'],
+                'ok': not errors,
+                })
+        loop.run_until_complete(adb.close())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        shutil.rmtree(path, True)
+    return rows
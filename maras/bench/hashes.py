@@ -0,0 +1,68 @@
+'''
+Measure the bucket distribution and collision rate of the placement hashes
+'''
+# Keys are placed the way DHM places them in the first map of a fixed map
+# directory, one bucket of hash_limit + 1 per key. A key collides when its
+# bucket already holds another key, in a database it would spill into the
+# next midx file.
+
+# Import python libs
+import random
+import timeit
+
+# Import maras libs
+import maras.utils
+import maras.index.dhm
+import maras.bench.keys
+
+HASHES = ('sha1', 'md5', 'crc32')
+
+
+def expected_rate(num, buckets):
+    '''
+    Return the collision rate of num keys placed uniformly in buckets
+    '''
+    filled = buckets * (1 - (1 - 1.0 / buckets) ** num)
+    return (num - filled) / float(num)
+
+
+def distribution(keys, place_hash, hash_limit=0xfffff):
+    '''
+    Return the placement cost and the bucket loads of keys placed with
+    place_hash
+    '''
+    func = maras.utils.get_hash_data(place_hash, place=True)[0]
+    timer = timeit.default_timer
+    start = timer()
+    h_vals = [int(func(key).hexdigest()[:16], 16) for key in keys]
+    elapsed = timer() - start
+    loads = {}
+    for h_val in h_vals:
+        pos = maras.index.dhm.calc_position(h_val, hash_limit, 1, 0)
+        loads[pos] = loads.get(pos, 0) + 1
+    return {
+            'hash': place_hash,
+            'keys': len(keys),
+            'us_per_key': elapsed * 1e6 / len(keys),
+            'buckets_used': len(loads),
+            'collision_rate': (len(keys) - len(loads)) / float(len(keys)),
+            'expected_rate': expected_rate(len(keys), hash_limit + 1),
+            'max_load': max(loads.values()),
+            }
+
+
+def bench(
+        num=500000,
+        seed=0,
+        key_set='profile',
+        hash_limit=0xfffff,
+        hashes=HASHES,
+        **kwargs):
+    '''
+    Return the distribution of num distinct keys of key_set for every
+    placement hash
+    '''
+    keys = list(set(maras.bench.keys.KEY_SETS[key_set](
+        num,
+        random.Random(seed))))
+    return [distribution(keys, name, hash_limit) for name in hashes]
@@ -0,0 +1,65 @@
+'''
+Synthetic key sets for the benchmarks
+'''
+# Every generator takes the number of keys to generate and a random.Random
+# and returns the keys in insertion order, keys may repeat so that revision
+# chains are measured as well.
+
+# Import python libs
+import bisect
+
+
+def flat_keys(num, rnd):
+    '''
+    Unique keys with no delimiter, all stored in the root hash map directory
+    '''
+    return ['k{0:x}'.format(rnd.getrandbits(64)) for _ in range(num)]
+
+
+def nested_keys(num, rnd, depth=4, fanout=8):
+    '''
+    Unique keys spread over a tree of depth levels with fanout directories
+    per level
+    '''
+    keys = []
+    for _ in range(num):
+        path = ['l{0}'.format(rnd.randrange(fanout)) for _ in range(depth)]
+        path.append('k{0:x}'.format(rnd.getrandbits(64)))
+        keys.append('/'.join(path))
+    return keys
+
+
+def zipf_keys(num, rnd, skew=1.1, population=None, dirs=16):
+    '''
+    Keys drawn from a population with a Zipfian distribution, the hottest
+    keys receive many revisions. The population defaults to num keys
+    spread over dirs directories
+    '''
+    if population is None:
+        population = num
+    total = 0.0
+    cum = []
+    for rank in range(1, population + 1):
+        total += 1.0 / rank ** skew
+        cum.append(total)
+    keys = []
+    for _ in range(num):
+        rank = bisect.bisect_left(cum, rnd.random() * total)
+        keys.append('z{0}/k{1}'.format(rank % dirs, rank))
+    return keys
+
+
+def profile_keys(num, rnd):
+    '''
+    Sequential keys of the form user/N/profile, similar keys which a weak
+    placement hash would cluster
+    '''
+    return ['user/{0}/profile'.format(ind) for ind in range(num)]
+
+
+KEY_SETS = {
+        'flat': flat_keys,
+        'nested': nested_keys,
+        'profile': profile_keys,
+        'zipf': zipf_keys,
+        }
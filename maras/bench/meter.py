@@ -0,0 +1,161 @@
+'''
+Measure the cost of the optional meter on inserts and gets
+'''
+# A single database is run with the meter off, on and stripped out,
+# switching between them every CHUNK keys so that the files and the state of
+# the machine are the same for all three. The stripped runs use copies of
+# the instrumented classes compiled with every "if self.meter is not None"
+# block removed, so the cost of a disabled meter is measured on the real
+# code paths and has to stay under MAX_DISABLED_PCT of the latency.
+
+# Import python libs
+import ast
+import inspect
+import random
+import shutil
+import timeit
+import tempfile
+
+# Import maras libs
+import maras.db
+import maras.index.dhm
+import maras.stor.mpack
+import maras.stor.zblock
+import maras.bench.keys
+
+MAX_DISABLED_PCT = 5.0
+MODES = ('bare', 'off', 'on')
+# Keys run in one mode before switching to the next
+CHUNK = 200
+# The modules holding meter tests on the insert and get paths
+METERED = (maras.db, maras.index.dhm, maras.stor.mpack, maras.stor.zblock)
+
+
+class _Strip(ast.NodeTransformer):
+    '''
+    Remove the meter tests from a module
+    '''
+    def visit_If(self, node):
+        self.generic_visit(node)
+        test = node.test
+        if (isinstance(test, ast.Compare)
+                and isinstance(test.left, ast.Attribute)
+                and test.left.attr == 'meter'
+                and isinstance(test.ops[0], ast.IsNot)
+                and not node.orelse):
+            return ast.copy_location(ast.Pass(), node)
+        return node
+
+
+def bare_methods(modules=METERED):
+    '''
+    Return the (class, name, function) of every method of the classes in
+    modules, compiled without the meter tests
+    '''
+    ret = []
+    for mod in modules:
+        tree = _Strip().visit(ast.parse(inspect.getsource(mod)))
+        ast.fix_missing_locations(tree)
+        names = {'__name__': mod.__name__}
+        exec(compile(tree, mod.__file__, 'exec'), names)
+        classes = [
+                (name, obj) for name, obj in vars(mod).items()
+                if inspect.isclass(obj) and obj.__module__ == mod.__name__]
+        for name, cls in classes:
+            for attr, func in vars(names[name]).items():
+                if inspect.isfunction(func) and attr in vars(cls):
+                    ret.append((cls, attr, func))
+        # The bare methods use the original classes, so that super and
+        # isinstance work on the instances they are called on
+        names.update(classes)
+    return ret
+
+
+def patch(methods):
+    '''
+    Set the (class, name, function) methods and return the ones replaced
+    '''
+    old = []
+    for cls, attr, func in methods:
+        old.append((cls, attr, vars(cls)[attr]))
+        setattr(cls, attr, func)
+    return old
+
+
+def set_meter(db, meter):
+    '''
+    Enable or, with None, disable the meter of an open database
+    '''
+    db.meter = meter
+    for comp in list(db.indexes.values()) + list(db.stores.values()):
+        if hasattr(comp, 'meter'):
+            comp.meter = meter
+
+
+def run(db, op, keys, value):
+    '''
+    Insert or get keys and return the seconds taken
+    '''
+    timer = timeit.default_timer
+    start = timer()
+    if op == 'insert':
+        for key in keys:
+            db.insert(value, key)
+    else:
+        for key in keys:
+            db.get(key)
+    return timer() - start
+
+
+def bench(num=10000, seed=0, value_size=64, rounds=3, **kwargs):
+    '''
+    Return the insert and get throughput with the meter off, on and
+    stripped out, the overhead of enabling it and the cost of the disabled
+    meter tests
+    '''
+    keys = maras.bench.keys.KEY_SETS['flat'](num, random.Random(seed))
+    value = 'x' * value_size
+    chunks = [keys[pos:pos + CHUNK] for pos in range(0, num, CHUNK)]
+    bare = bare_methods()
+    secs = dict((mode, {'insert': 0.0, 'get': 0.0}) for mode in MODES)
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path, meter=True)
+        db.create(sync='none')
+        db.add_index('bench')
+        meter = db.meter
+        for num_r in range(rounds):
+            for num_c, chunk in enumerate(chunks):
+                # Every mode runs every chunk, in a rotating order
+                for pos in range(len(MODES)):
+                    mode = MODES[(num_r + num_c + pos) % len(MODES)]
+                    set_meter(db, meter if mode == 'on' else None)
+                    old = patch(bare) if mode == 'bare' else []
+                    try:
+                        for op in ('insert', 'get'):
+                            secs[mode][op] += run(db, op, chunk, value)
+                    finally:
+                        patch(old)
+        set_meter(db, meter)
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    ops = float(num * rounds)
+    rows = []
+    for op in ('insert', 'get'):
+        off = secs['off'][op]
+        on = secs['on'][op]
+        stripped = secs['bare'][op]
+        disabled = (off - stripped) * 100 / stripped
+        rows.append({
+            'op': op,
+            'num': num,
+            'bare_ops': ops / stripped,
+            'off_ops': ops / off,
+            'on_ops': ops / on,
+            'overhead_pct': (on - off) * 100 / off,
+            'off_us': off * 1e6 / ops,
+            'disabled_pct': disabled,
+            'ok': disabled < MAX_DISABLED_PCT,
+            })
+    return rows
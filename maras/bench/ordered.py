@@ -0,0 +1,78 @@
+'''
+Measure range queries through an ordered index against a full scan
+'''
+# Without an ordered index a range query has to scan every key of the
+# database and sort the keys which fall in the range. Every query is run
+# both ways and the results are checked to match. The scan is slow, so only
+# scan_queries of the queries are run both ways. The keys are flushed to a
+# sorted run first, so the index is read through its page cache.
+
+# Import python libs
+import random
+import shutil
+import timeit
+import tempfile
+
+# Import maras libs
+import maras.db
+import maras.bench.keys
+
+
+def scan_range(db, start, limit):
+    '''
+    Return the first limit keys from start by scanning every key
+    '''
+    return sorted(
+            key for key in db.scan(keys_only=True) if key >= start)[:limit]
+
+
+def bench(
+        num=20000,
+        seed=0,
+        value_size=64,
+        queries=50,
+        scan_queries=3,
+        limit=20,
+        **kwargs):
+    '''
+    Return the mean time of range queries of limit keys through the ordered
+    index and through a scan
+    '''
+    rnd = random.Random(seed)
+    keys = maras.bench.keys.KEY_SETS['nested'](num, rnd)
+    value = 'x' * value_size
+    starts = [rnd.choice(keys) for _ in range(queries)]
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    timer = timeit.default_timer
+    try:
+        db = maras.db.DB(path)
+        db.create(sync='none')
+        db.add_index('bench')
+        db.add_index('ordered', kind='ordered')
+        db.insert_many([(value, key) for key in keys])
+        # Queries read the sorted runs and not only the memory table
+        db.indexes['ordered'].flush()
+        found = []
+        start = timer()
+        for key in starts:
+            found.append(db.range(key, None, limit, keys_only=True))
+        index = (timer() - start) / queries
+        ok = True
+        start = timer()
+        for num_q, key in enumerate(starts[:scan_queries]):
+            ok = ok and scan_range(db, key, limit) == found[num_q]
+        scan = (timer() - start) / max(min(scan_queries, queries), 1)
+        stats = db.indexes['ordered'].stats()
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    return [{
+        'num': num,
+        'limit': limit,
+        'index_ms': index * 1000,
+        'scan_ms': scan * 1000,
+        'speedup': scan / index if index else 0.0,
+        'runs': stats['runs'],
+        'page_hit_ratio': stats['page_cache']['hit_ratio'],
+        'ok': ok,
+        }]
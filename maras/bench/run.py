@@ -0,0 +1,199 @@
+'''
+Measure insert and get throughput, latency, hash map fan-out and disk usage
+'''
+# Results are plain dicts which can be dumped as json, every result carries
+# the settings it was measured with so that runs can be compared later.
+
+# Import python libs
+import os
+import time
+import random
+import shutil
+import timeit
+import tempfile
+
+# Import maras libs
+import maras
+import maras.db
+import maras.bench.keys
+
+# Metrics compared between runs, True where a higher value is better
+METRICS = {
+        'insert.ops': True,
+        'insert.p50': False,
+        'insert.p99': False,
+        'get.ops': True,
+        'get.p50': False,
+        'get.p99': False,
+        'fanout.mean': False,
+        'disk.total': False,
+        }
+
+
+def percentile(lats, pct):
+    '''
+    Return the pct percentile of a sorted list of latencies
+    '''
+    if not lats:
+        return 0.0
+    return lats[min(len(lats) - 1, int(len(lats) * pct / 100.0))]
+
+
+def timings(lats, elapsed):
+    '''
+    Summarize the per operation latencies of a phase, in seconds
+    '''
+    lats.sort()
+    return {
+            'ops': len(lats) / elapsed if elapsed else 0.0,
+            'p50': percentile(lats, 50),
+            'p99': percentile(lats, 99),
+            'max': lats[-1] if lats else 0.0,
+            }
+
+
+def fanout(db, keys):
+    '''
+    Return how many midx files the probing of hash_map_ref walks to reach
+    each distinct key, as a histogram of the midx number holding the key
+    '''
+    index = db.indexes[db.primary]
+    hist = {}
+    for key in keys:
+        h_entry, fn_ = index.hash_map_ref(key, create=False)
+        num = int(fn_[fn_.rindex('midx_') + 5:])
+        hist[num] = hist.get(num, 0) + 1
+    total = sum(hist.values())
+    return {
+            'hist': dict((str(num), count) for num, count in hist.items()),
+            'mean': sum(num * count for num, count in hist.items())
+                    / float(total or 1),
+            'max': max(hist) if hist else 0,
+            }
+
+
+def disk_usage(path):
+    '''
+    Return the bytes on disk under path by file kind, the kind is the file
+    name up to the first _ or . and the number of hash map directories
+    '''
+    kinds = {}
+    dirs = 0
+    maps = 0
+    for root, subs, files in os.walk(path):
+        if any(fn_.startswith('midx_') for fn_ in files):
+            dirs += 1
+        for fn_ in files:
+            kind = fn_.split('.')[0].split('_')[0]
+            if kind == 'midx':
+                maps += 1
+            size = os.path.getsize(os.path.join(root, fn_))
+            kinds[kind] = kinds.get(kind, 0) + size
+    return {
+            'kinds': kinds,
+            'total': sum(kinds.values()),
+            'dirs': dirs,
+            'maps': maps,
+            }
+
+
+def bench(
+        key_set='flat',
+        num=10000,
+        value_size=64,
+        seed=0,
+        path=None,
+        keep=False,
+        **create):
+    '''
+    Run one benchmark of key_set and return its results. num records with
+    values of value_size bytes are inserted one at a time and every distinct
+    key is then read back in random order. The create kwargs are passed to
+    DB.create, such as hash_limit, fmt, key_delim and sync
+    '''
+    if key_set not in maras.bench.keys.KEY_SETS:
+        raise ValueError('Unknown key set {0}'.format(key_set))
+    rnd = random.Random(seed)
+    keys = maras.bench.keys.KEY_SETS[key_set](num, rnd)
+    value = 'x' * value_size
+    create.setdefault('sync', 'none')
+    tmp = path is None
+    if tmp:
+        path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path)
+        db.create(**create)
+        db.add_index('bench')
+        lats = []
+        timer = timeit.default_timer
+        start = timer()
+        for key in keys:
+            t_op = timer()
+            db.insert(value, key)
+            lats.append(timer() - t_op)
+        insert = timings(lats, timer() - start)
+        distinct = list(set(keys))
+        rnd.shuffle(distinct)
+        lats = []
+        start = timer()
+        for key in distinct:
+            t_op = timer()
+            db.get(key)
+            lats.append(timer() - t_op)
+        get = timings(lats, timer() - start)
+        fan = fanout(db, distinct)
+        db.close()
+        disk = disk_usage(path)
+    finally:
+        if tmp and not keep:
+            shutil.rmtree(path, True)
+    settings = dict(create)
+    settings.update({
+            'key_set': key_set,
+            'num': num,
+            'distinct': len(distinct),
+            'value_size': value_size,
+            'seed': seed,
+            })
+    return {
+            'version': maras.version,
+            'time': time.time(),
+            'settings': settings,
+            'insert': insert,
+            'get': get,
+            'fanout': fan,
+            'disk': disk,
+            }
+
+
+def metric(result, name):
+    '''
+    Return the value of a dotted metric name from a result
+    '''
+    val = result
+    for part in name.split('.'):
+        val = val[part]
+    return val
+
+
+def compare(old, new, threshold=0.1):
+    '''
+    Compare two lists of results matched by key set, returns a list of
+    (key_set, metric, old, new, change, regressed) tuples where change is
+    the relative change and regressed is set when the metric got worse by
+    more than threshold
+    '''
+    before = dict((res['settings']['key_set'], res) for res in old)
+    ret = []
+    for res in new:
+        key_set = res['settings']['key_set']
+        if key_set not in before:
+            continue
+        for name in sorted(METRICS):
+            o_val = metric(before[key_set], name)
+            n_val = metric(res, name)
+            change = (n_val - o_val) / float(o_val) if o_val else 0.0
+            worse = -change if METRICS[name] else change
+            ret.append(
+                    (key_set, name, o_val, n_val, change, worse > threshold))
+    return ret
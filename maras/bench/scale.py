@@ -0,0 +1,133 @@
+'''
+Measure how the cost of a lookup grows with the number of keys in a map
+'''
+# One database is filled in steps, at 1K keys and every power of ten up to
+# num a sample of the keys present and of missing keys is looked up. All of
+# the keys share the root hash map directory, so growable maps split pages
+# and fixed maps spill into further midx files as they fill. The full range
+# of 1K to 100M keys is run with --num 100000000, which takes hours and
+# several GB of disk. Keys are derived from their number so that they never
+# have to be held in memory. The meter is enabled to count the midx files
+# and bucket pages read per lookup, its overhead is the same at every size.
+
+# Import python libs
+import random
+import shutil
+import timeit
+import tempfile
+
+# Import maras libs
+import maras.db
+import maras.bench.run
+
+START = 1000
+BATCH = 1000
+# An odd multiplier spreads the key numbers over 64 bits without repeats
+SPREAD = 0x9e3779b97f4a7c15
+MASK = (1 << 64) - 1
+
+
+def key_of(ind):
+    '''
+    Return the key numbered ind
+    '''
+    return 'k{0:016x}'.format((ind * SPREAD) & MASK)
+
+
+def sizes(num):
+    '''
+    Return the key counts measured, from START up to num
+    '''
+    ret = []
+    size = START
+    while size < num:
+        ret.append(size)
+        size *= 10
+    ret.append(num)
+    return ret
+
+
+def hist_mean(hist):
+    '''
+    Return the mean value of a meter histogram
+    '''
+    total = sum(hist.values())
+    return sum(val * count for val, count in hist.items()) / float(total or 1)
+
+
+def lookups(db, size, rnd, samples):
+    '''
+    Look up samples present and missing keys and return the costs
+    '''
+    index = db.indexes[db.primary]
+    present = [key_of(rnd.randrange(size)) for _ in range(samples)]
+    missing = [key_of(size + rnd.randrange(size)) for _ in range(samples)]
+    db.meter.reset()
+    timer = timeit.default_timer
+    lats = []
+    found = 0
+    for key in present:
+        start = timer()
+        try:
+            db.get(key)
+            found += 1
+        except KeyError:
+            pass
+        lats.append(timer() - start)
+    hists = db.meter.stats()['hists']
+    start = timer()
+    for key in missing:
+        try:
+            db.get(key)
+        except KeyError:
+            pass
+    miss = (timer() - start) / samples
+    get = maras.bench.run.timings(lats, sum(lats))
+    return {
+            'size': size,
+            'get_us': 1e6 / get['ops'] if get['ops'] else 0.0,
+            'p99_us': get['p99'] * 1e6,
+            'miss_us': miss * 1e6,
+            'maps': len([fn_ for fn_ in index.maps if 'midx_' in fn_]),
+            'probe_depth': hist_mean(hists.get('probe_depth', {})),
+            'page_reads': hist_mean(hists.get('page_reads', {})),
+            'ok': found == samples,
+            }
+
+
+def bench(
+        num=100000,
+        seed=0,
+        value_size=64,
+        hash_limit=0xfffff,
+        growable=True,
+        samples=2000,
+        **kwargs):
+    '''
+    Return the lookup costs of present and missing keys at every size
+    '''
+    rnd = random.Random(seed)
+    value = 'x' * value_size
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    rows = []
+    try:
+        db = maras.db.DB(path, meter=True)
+        db.create(sync='none', hash_limit=hash_limit, growable=growable)
+        db.add_index('bench')
+        done = 0
+        for size in sizes(num):
+            while done < size:
+                end = min(done + BATCH, size)
+                db.insert_many([
+                    (value, key_of(ind)) for ind in range(done, end)])
+                done = end
+            row = lookups(db, size, rnd, samples)
+            row['growable'] = growable
+            row['disk_per_key'] = (
+                    maras.bench.run.disk_usage(path)['total'] /
+                    float(size))
+            rows.append(row)
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    return rows
@@ -0,0 +1,263 @@
+'''
+Stress and measure a database shared between processes
+'''
+# The stress run starts writer and reader processes on one shared database.
+# Writers insert revisions of their own keys, readers check that every read
+# returns the record of the key read and that revisions of a key never go
+# backwards, and that the ordered index and scans stay consistent. The
+# final state is then checked against a replay of the writes.
+# The reader run measures the total gets per second of a growing number of
+# reader processes, with and without a writer process inserting alongside.
+
+# Import python libs
+import time
+import random
+import shutil
+import tempfile
+import multiprocessing
+
+# Import maras libs
+import maras.db
+
+# Writes per writer process in the stress run
+STRESS_WRITES = 400
+# Keys per writer and directory
+STRESS_KEYS = 40
+STRESS_DIRS = 3
+READER_COUNTS = (1, 2, 4, 8)
+DIRS = 16
+
+
+def _open(path, storage='msgpack', shared=True, ordered=True):
+    '''
+    Open the shared database at path
+    '''
+    opts = {'block_size': 2048} if storage == 'zblock' else None
+    db = maras.db.DB(path, storage=storage, shared=shared, stor_opts=opts)
+    db.open_db()
+    db.add_index('bench')
+    if ordered:
+        db.add_index('ordered', 'ordered', flush_keys=300, max_runs=2)
+    return db
+
+
+def _writes(num):
+    '''
+    Yield the (seq, key) writes of writer num
+    '''
+    rnd = random.Random(num)
+    for seq in range(STRESS_WRITES):
+        yield seq, 'd{0}/w{1}_k{2}'.format(
+                seq % STRESS_DIRS,
+                num,
+                rnd.randint(0, STRESS_KEYS))
+
+
+def _stress_writer(path, storage, num):
+    '''
+    Insert the writes of writer num, every tenth one in a batch of two
+    '''
+    db = _open(path, storage)
+    for seq, key in _writes(num):
+        if seq % 10 == 0:
+            db.insert_many([
+                ({'w': num, 's': seq, 'k': key + 'b'}, key + 'b'),
+                ({'w': num, 's': seq, 'k': key}, key)])
+        else:
+            db.insert({'w': num, 's': seq, 'k': key}, key)
+    db.close()
+
+
+def _stress_reader(path, storage, num, writers, secs, queue):
+    '''
+    Read random keys for secs seconds and count the inconsistent reads
+    '''
+    db = _open(path, storage)
+    rnd = random.Random(100 + num)
+    seen = {}
+    reads = 0
+    errors = 0
+    end = time.time() + secs
+    while time.time() < end:
+        key = 'd{0}/w{1}_k{2}'.format(
+                rnd.randint(0, STRESS_DIRS - 1),
+                rnd.randint(0, writers - 1),
+                rnd.randint(0, STRESS_KEYS))
+        try:
+            entry = db.get(key)
+        except KeyError:
+            continue
+        reads += 1
+        if entry['d']['k'] != key:
+            errors += 1
+        if entry['d']['s'] < seen.get(key, -1):
+            errors += 1
+        seen[key] = entry['d']['s']
+        if reads % 200 == 0:
+            keys = db.range(keys_only=True)
+            if keys != sorted(set(keys)):
+                errors += 1
+            for key, entry in db.scan('d1/'):
+                if entry['d']['k'] != key:
+                    errors += 1
+    db.close()
+    queue.put((reads, errors))
+
+
+def stress_run(storage='msgpack', use_mmap=False, writers=4, readers=4,
+               secs=3):
+    '''
+    Run the writers and readers on a new database and check the reads and
+    the final state
+    '''
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path, shared=True)
+        db.create(sync='none', hash_limit=0x3f, use_mmap=use_mmap)
+        db.close()
+        queue = multiprocessing.Queue()
+        procs = [
+                multiprocessing.Process(
+                    target=_stress_writer,
+                    args=(path, storage, num))
+                for num in range(writers)]
+        procs.extend(
+                multiprocessing.Process(
+                    target=_stress_reader,
+                    args=(path, storage, num, writers, secs, queue))
+                for num in range(readers))
+        for proc in procs:
+            proc.start()
+        results = [queue.get() for _ in range(readers)]
+        for proc in procs:
+            proc.join()
+        final = {}
+        for num in range(writers):
+            for seq, key in _writes(num):
+                final[key] = seq
+                if seq % 10 == 0:
+                    final[key + 'b'] = seq
+        db = _open(path, storage)
+        bad = sum(
+                1 for key, seq in final.items()
+                if db.get(key)['d']['s'] != seq)
+        keys = db.range(keys_only=True)
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    errors = sum(result[1] for result in results)
+    return {
+            'storage': storage,
+            'use_mmap': use_mmap,
+            'writers': writers,
+            'readers': readers,
+            'reads': sum(result[0] for result in results),
+            'errors': errors,
+            'bad_final': bad,
+            'ok': (not errors and not bad and
+                   sorted(keys) == sorted(final) and
+                   all(proc.exitcode == 0 for proc in procs)),
+            }
+
+
+def stress(secs=3, **kwargs):
+    '''
+    Return the stress runs with msgpack and zblock storage, with and
+    without mmap
+    '''
+    return [
+            stress_run(storage, use_mmap, secs=secs)
+            for storage in ('msgpack', 'zblock')
+            for use_mmap in (False, True)]
+
+
+def _reader(path, num, keys, secs, shared, queue):
+    '''
+    Get random keys for secs seconds and report the number of gets
+    '''
+    db = _open(path, shared=shared, ordered=False)
+    rnd = random.Random(num)
+    count = 0
+    end = time.time() + secs
+    while time.time() < end:
+        db.get('s{0}/k{1}'.format(
+            rnd.randint(0, DIRS - 1),
+            rnd.randint(0, keys // DIRS - 1)))
+        count += 1
+    db.close()
+    queue.put(count)
+
+
+def _writer(path, keys, stop, queue):
+    '''
+    Insert new revisions until stop is set and report the number of
+    inserts
+    '''
+    db = _open(path, ordered=False)
+    count = 0
+    while not stop.is_set():
+        db.insert(
+                {'v': count},
+                's{0}/k{1}'.format(count % DIRS, count % (keys // DIRS)))
+        count += 1
+    db.close()
+    queue.put(count)
+
+
+def reader_run(path, keys, readers, writer=False, secs=2, shared=True):
+    '''
+    Return the gets per second of readers processes, and the inserts per
+    second of a writer process if writer is set
+    '''
+    queue = multiprocessing.Queue()
+    w_queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    procs = [
+            multiprocessing.Process(
+                target=_reader,
+                args=(path, num, keys, secs, shared, queue))
+            for num in range(readers)]
+    if writer:
+        procs.append(multiprocessing.Process(
+            target=_writer,
+            args=(path, keys, stop, w_queue)))
+    for proc in procs:
+        proc.start()
+    gets = sum(queue.get() for _ in range(readers))
+    stop.set()
+    inserts = w_queue.get() if writer else 0
+    for proc in procs:
+        proc.join()
+    return {
+            'readers': readers,
+            'shared': shared,
+            'writer': writer,
+            'gets': gets / float(secs),
+            'inserts': inserts / float(secs),
+            }
+
+
+def readers(num=20000, secs=2, reader_counts=READER_COUNTS, **kwargs):
+    '''
+    Return the read throughput of one unshared reader, then of every count
+    of shared readers alone and next to a writer
+    '''
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path)
+        db.create(sync='none', hash_limit=0xfff)
+        db.add_index('bench')
+        db.insert_many([
+            ({'v': ind}, 's{0}/k{1}'.format(ind % DIRS, ind // DIRS))
+            for ind in range(num)])
+        db.close()
+        rows = [reader_run(path, num, 1, secs=secs, shared=False)]
+        for writer in (False, True):
+            for count in reader_counts:
+                rows.append(reader_run(path, num, count, writer, secs))
+    finally:
+        shutil.rmtree(path, True)
+    cpus = multiprocessing.cpu_count()
+    for row in rows:
+        row['cpus'] = cpus
+    return rows
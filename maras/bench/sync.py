@@ -0,0 +1,58 @@
+'''
+Measure insert throughput in every durability mode
+'''
+# The group mode run also checks that a writer which goes idle with writes
+# pending has them synced within sync_interval.
+
+# Import python libs
+import time
+import random
+import shutil
+import timeit
+import tempfile
+
+# Import maras libs
+import maras.db
+import maras.utils.sync
+import maras.bench.keys
+
+
+def run_mode(mode, keys, value, sync_interval=0.05):
+    '''
+    Insert keys one at a time in mode and return the throughput and the
+    number of syncs
+    '''
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path)
+        db.create(sync=mode, sync_interval=sync_interval)
+        db.add_index('bench')
+        timer = timeit.default_timer
+        start = timer()
+        for key in keys:
+            db.insert(value, key)
+        elapsed = timer() - start
+        ret = {
+                'mode': mode,
+                'num': len(keys),
+                'ops': len(keys) / elapsed if elapsed else 0.0,
+                'syncs': db.syncer.syncs,
+                }
+        if mode == 'group':
+            db.insert(value, 'idle')
+            time.sleep(sync_interval * 4)
+            ret['idle_synced'] = not (db.syncer.stor or db.syncer.index)
+            ret['ok'] = ret['idle_synced']
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    return ret
+
+
+def bench(num=10000, seed=0, value_size=64, **kwargs):
+    '''
+    Return the insert throughput of num flat keys in every durability mode
+    '''
+    keys = maras.bench.keys.KEY_SETS['flat'](num, random.Random(seed))
+    value = 'x' * value_size
+    return [run_mode(mode, keys, value) for mode in maras.utils.sync.MODES]
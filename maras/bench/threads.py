@@ -0,0 +1,66 @@
+'''
+Measure how parallel per directory writes scale with the thread count
+'''
+# insert_many writes the batches of different hash map directories in
+# parallel on a pool of the database's threads, with fewer than 2 threads
+# they are written one after another. Every run checks that all of the
+# records can be read back.
+
+# Import python libs
+import shutil
+import timeit
+import tempfile
+import multiprocessing
+
+# Import maras libs
+import maras.db
+import maras.utils.sync
+
+THREAD_COUNTS = (0, 2, 4, 8)
+DIRS = 16
+BATCH = 400
+
+
+def run(sync, threads, num, value):
+    '''
+    Insert num records over DIRS directories in batches of BATCH and return
+    the records written per second
+    '''
+    path = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        db = maras.db.DB(path, threads=threads)
+        db.create(sync=sync, hash_limit=0xff)
+        db.add_index('bench')
+        keys = ['d{0}/k{1}'.format(ind % DIRS, ind) for ind in range(num)]
+        timer = timeit.default_timer
+        start = timer()
+        for pos in range(0, num, BATCH):
+            db.insert_many([(value, key) for key in keys[pos:pos + BATCH]])
+        elapsed = timer() - start
+        found, missing = db.get_many(keys)
+        db.close()
+    finally:
+        shutil.rmtree(path, True)
+    return {
+            'sync': sync,
+            'threads': threads,
+            'num': num,
+            'ops': num / elapsed if elapsed else 0.0,
+            'ok': not missing,
+            }
+
+
+def bench(num=8000, value_size=64, thread_counts=THREAD_COUNTS, **kwargs):
+    '''
+    Return the insert_many throughput for every durability mode and thread
+    count
+    '''
+    value = 'x' * value_size
+    rows = [
+            run(sync, threads, num, value)
+            for sync in maras.utils.sync.MODES
+            for threads in thread_counts]
+    cpus = multiprocessing.cpu_count()
+    for row in rows:
+        row['cpus'] = cpus
+    return rows
@@ -0,0 +1,301 @@
+'''
+Online compaction of hash map and storage files
+'''
+# Compaction sequence for a midx_N/stor_N pair:
+# 1. Note the current index tail, entries past it are new writes
+# 2. Copy the retained revisions of every bucket into a new storage
+#    generation and a temporary map file, yielding between bucket blocks.
+#    Growable maps are not split until the swap, a split moves keys between
+#    pages and the bucket walk would miss or repeat them
+# 3. Copy any entries appended to the old map since step 1
+# 4. Fsync the new files, drop the old id index and rename the new map
+#    into place, the new map header names the new storage generation, and
+#    the new bucket file generation of growable maps, so the rename is the
+#    single atomic switch
+# 5. Forget the pending syncs of the old storage and bucket files and
+#    remove them
+# A crash before step 4 leaves only unreferenced temporary files behind, a
+# crash inside step 4 leaves a map without an id index which is rebuilt on
+# first use
+
+# Import python libs
+import os
+import io
+import time
+import struct
+
+# Import maras libs
+import maras.index.dhm
+
+# Import third party libs
+import msgpack
+
+
+def disk_usage(fn_):
+    '''
+    Return the bytes allocated on disk for the file, map files are sparse
+    so the apparent size overstates their usage
+    '''
+    try:
+        return os.stat(fn_).st_blocks * 512
+    except OSError:
+        return 0
+
+
+class Compactor(object):
+    '''
+    Rewrite the map and storage files of a database keeping only the last
+    retain revisions of every key
+    '''
+    def __init__(self, db, index, retain=1, step=16, sample=100):
+        for stor in db.stores.values():
+            if not stor.compactable:
+                raise ValueError(
+                        'Compaction is not supported with {0} storage'.format(
+                            stor.prefix))
+        self.db = db
+        self.index = index
+        self.stor = db.stores['msgpack']
+        self.retain = retain
+        self.step = step
+        self.sample = sample
+
+    def run(self):
+        '''
+        Compact every map file under the database root. This is a generator,
+        it yields None after every step buckets have been copied so that
+        callers can keep serving reads between steps, and a report dict once
+        each map has been swapped in and once each secondary index which
+        can be compacted has been
+        '''
+        for fn_ in self._map_files():
+            for report in self.compact_map(fn_):
+                yield report
+        for name in self.db.secondary:
+            index = self.db.indexes[name]
+            if hasattr(index, 'compact'):
+                yield index.compact()
+
+    def _map_files(self):
+        '''
+        Return the paths of all map files in the database
+        '''
+        ret = []
+        for root, dirs, files in os.walk(self.db.dbpath):
+            for name in files:
+                if name.startswith('midx_') and name[5:].isdigit():
+                    ret.append(os.path.join(root, name))
+        return sorted(ret)
+
+    def _usage(self, fn_):
+        '''
+        Return the disk usage of a map, its id index and its storage
+        '''
+        map_data = self.index.maps[fn_]
+        ret = (
+                disk_usage(fn_) +
+                disk_usage(self.index._ids_fn(fn_)) +
+                disk_usage(self.stor._stor_fn(map_data)))
+        if map_data.get('grow'):
+            ret += disk_usage(self.index._bkt_fn(map_data))
+        return ret
+
+    def _read_latency(self, fn_, keys):
+        '''
+        Return the mean seconds taken to get the latest revision of keys
+        '''
+        if not keys:
+            return 0.0
+        start = time.time()
+        for key in keys:
+            ind, map_key = self.index.get_h_index(key)
+            self.stor.get(ind, self.index.maps[map_key])
+        return (time.time() - start) / len(keys)
+
+    def compact_map(self, fn_):
+        '''
+        Compact a single map file, see run for the values yielded
+        '''
+        index = self.index
+        self.db.syncer.flush()
+        if fn_ not in index.maps:
+            index.open_map(fn_)
+        old = index.maps[fn_]
+        before = self._usage(fn_)
+        gen = old.get('gen', 0) + 1
+        header = dict(
+                (key, val) for key, val in old.items()
+                if key not in maras.index.dhm.RUNTIME_KEYS)
+        header['gen'] = gen
+        # Entries are rewritten in the current binary version
+        header['i_ver'] = maras.index.dhm.ENTRY_VER
+        new_stor_fn = self.stor._stor_fn(header)
+        tmp_fn = '{0}.compact'.format(fn_)
+        tmp_ids_fn = '{0}.compact'.format(index._ids_fn(fn_))
+        m_fp = io.open(tmp_fn, 'w+b')
+        s_fp = io.open(new_stor_fn, 'w+b')
+        state = {
+                'old': old,
+                'new': header,
+                'buckets': {},
+                # The offset of the entry holding the key of each bucket
+                'heads': {},
+                'ids': [],
+                'tail': old['b_end'],
+                'kept': 0,
+                'dropped': 0,
+                }
+        m_fp.write(msgpack.dumps(header) + maras.index.dhm.HEADER_DELIM)
+        keys = []
+        start_tail = index._tail(old)
+        count = 0
+        old['no_split'] = True
+        try:
+            for h_entry in index.iter_buckets(fn_):
+                chain = []
+                prev = h_entry['prev']
+                key = None
+                while prev:
+                    entry = index._get_h_prev(prev, fn_, key)
+                    key = entry['key']
+                    # Entries appended during compaction are copied afterwards
+                    if prev < start_tail:
+                        chain.append(entry)
+                    prev = entry['p']
+                if not chain:
+                    continue
+                state['dropped'] += max(len(chain) - self.retain, 0)
+                chain = chain[:self.retain]
+                if len(keys) < self.sample:
+                    keys.append(chain[0]['key'])
+                # Growable maps get new buckets, their entries are grouped by
+                # bucket key instead of bucket position
+                b_ref = h_entry['key'] if old.get('grow') else h_entry['pos']
+                for entry in reversed(chain):
+                    self._copy_entry(
+                            entry,
+                            b_ref,
+                            h_entry['key'],
+                            state,
+                            m_fp,
+                            s_fp)
+                count += 1
+                if count % self.step == 0:
+                    yield None
+            # Catch up with revisions written while the old map was served,
+            # nothing is yielded from here until the swap is complete
+            end_tail = index._tail(old)
+            pos = start_tail
+            while pos < end_tail:
+                i_len = struct.unpack('>H', index._read(old, pos, 2))[0]
+                if not i_len:
+                    break
+                entry = index._get_h_prev(pos, fn_)
+                digest = index._key_digest(entry['key'])
+                if old.get('grow'):
+                    h_key = b_pos = digest[0]
+                else:
+                    h_key, b_pos = index._bucket_pos(old, entry['key'], digest)
+                self._copy_entry(entry, b_pos, h_key, state, m_fp, s_fp)
+                pos += 2 + i_len
+        finally:
+            old.pop('no_split', None)
+        read_before = self._read_latency(fn_, keys)
+        self._finish_map(header, state, m_fp, s_fp, tmp_ids_fn)
+        self._swap(fn_, old, tmp_fn, tmp_ids_fn)
+        yield {
+                'map': fn_,
+                'kept': state['kept'],
+                'dropped': state['dropped'],
+                'bytes_before': before,
+                'bytes_after': self._usage(fn_),
+                'read_before': read_before,
+                'read_after': self._read_latency(fn_, keys),
+                }
+
+    def _copy_entry(self, entry, b_pos, h_key, state, m_fp, s_fp):
+        '''
+        Copy a revision's storage record and index entry into the new files
+        '''
+        new = dict(entry)
+        new['st'] = s_fp.tell()
+        # Copied in chunks so that large records are never held whole
+        for raw in self.stor.iter_raw(entry, state['old']):
+            s_fp.write(raw)
+        bucket = state['buckets'].get(b_pos)
+        new['p'] = bucket[1] if bucket else 0
+        i_entry = self.index._pack_entry(
+                new,
+                state['new'],
+                state['heads'].get(b_pos, 0))
+        m_fp.seek(state['tail'])
+        m_fp.write(i_entry)
+        state['buckets'][b_pos] = (h_key, state['tail'])
+        state['heads'].setdefault(b_pos, state['tail'])
+        state['ids'].append(
+                (self.index.hash_func(entry['id']).hexdigest(), state['tail']))
+        state['tail'] += len(i_entry)
+        state['kept'] += 1
+
+    def _finish_map(self, header, state, m_fp, s_fp, tmp_ids_fn):
+        '''
+        Write the buckets and the mmap tail of the new map, write its id
+        index and fsync the new files
+        '''
+        entry_map = header['entry_map']
+        if header.get('grow'):
+            self.index.build_buckets(header, list(state['buckets'].values()))
+            state['buckets'] = {}
+        for b_pos in sorted(state['buckets']):
+            h_key, prev = state['buckets'][b_pos]
+            vals = {'key': h_key, 'prev': prev}
+            m_fp.seek(b_pos)
+            m_fp.write(struct.pack(
+                header['fmt'],
+                *[vals[name] for name in entry_map]))
+        m_fp.seek(header['header_len'] - maras.index.dhm.TAIL_SIZE)
+        m_fp.write(struct.pack(maras.index.dhm.TAIL_FMT, state['tail']))
+        with io.open(tmp_ids_fn, 'w+b') as i_fp:
+            i_fp.write(b''.join(
+                self.index.id_struct.pack(id_key, i_pos)
+                for id_key, i_pos in state['ids']))
+            i_fp.flush()
+            os.fsync(i_fp.fileno())
+        for fp_ in (s_fp, m_fp):
+            fp_.flush()
+            os.fsync(fp_.fileno())
+            fp_.close()
+
+    def _swap(self, fn_, old, tmp_fn, tmp_ids_fn):
+        '''
+        Atomically replace the old map with the compacted one and remove the
+        old storage file
+        '''
+        index = self.index
+        ids_fn = index._ids_fn(fn_)
+        old_stor_fn = self.stor._stor_fn(old)
+        removed = [old_stor_fn]
+        if old.get('grow'):
+            old_bkt_fn = index._bkt_fn(old)
+            removed.append(old_bkt_fn)
+            index.fd_cache.close(old_bkt_fn)
+        # Syncing a removed file would reopen, and so recreate, it
+        self.db.syncer.discard(removed)
+        index.fd_cache.close(fn_)
+        index.fd_cache.close(ids_fn)
+        self.stor.fd_cache.close(old_stor_fn)
+        self.stor.stores.discard(old_stor_fn)
+        if index.manifest is not None:
+            # The new header is listed again once the new map is opened
+            index.manifest.drop(fn_)
+        if os.path.exists(ids_fn):
+            os.remove(ids_fn)
+        os.rename(tmp_fn, fn_)
+        os.rename(tmp_ids_fn, ids_fn)
+        del index.maps[fn_]
+        index.open_map(fn_)
+        os.remove(old_stor_fn)
+        if old.get('grow'):
+            os.remove(old_bkt_fn)
+        if self.db.cache is not None:
+            self.db.cache.clear()
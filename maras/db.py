@@ -5,38 +5,125 @@ Simple database interface
 # 1. Get index data for key
 # 2. write storage using key index data
 # 3. write index using storage data return
+# A database opened with shared=True can be used by many processes at once.
+# Writers hold the exclusive lock of the hash map directory of every key
+# they write, readers take no locks and read a snapshot bounded by the map
+# tails at the start of each read.
+# A database opened with threads above 0 can be used from many threads the
+# same way, writers hold a per directory thread lock and all file access is
+# positional. insert_many then writes the batches of different hash map
+# directories in parallel on a pool of that many threads.
+# The hash map files and their headers are listed in the manifest at the
+# database root so opening a map does not have to stat and read it, see
+# maras.manifest.
 # Import python libs
 import os
 import io
+import threading
+import contextlib
+import multiprocessing.pool
 
 # Import maras libs
+import maras.compact
+import maras.manifest
 import maras.utils
+import maras.utils.cache
+import maras.utils.fdcache
+import maras.utils.lock
+import maras.utils.meter
+import maras.utils.sync
 import maras.index.dhm
+import maras.index.ordered
+import maras.index.value
 import maras.stor.mpack
+import maras.stor.zblock
 
 # Import third party libs
 import msgpack
 
+# Index types which can be added next to the primary hash index, these are
+# maintained on insert through their insert and insert_many methods
+INDEX_TYPES = {
+        'ordered': maras.index.ordered.OrderedIndex,
+        'value': maras.index.value.ValueIndex,
+        }
+
+# Storage engines, records stored by any engine other than msgpack are
+# tagged with the engine name in their index entry
+STOR_TYPES = {
+        'msgpack': maras.stor.mpack.MPack,
+        'zblock': maras.stor.zblock.ZBlock,
+        }
+
 
 class DB(object):
     '''
-    A simple single threaded database
+    A simple single threaded database, see shared and threads for use by
+    many processes and threads
     '''
     def __init__(
             self,
             path,
-            storage='msgpack',
-            serial='msgpack'):
+            storage=None,
+            serial='msgpack',
+            cache_bytes=0,
+            stor_opts=None,
+            shared=False,
+            threads=0,
+            meter=False,
+            manifest=True):
         self.dbpath = path
         self.path = os.path.join(path, 'maras_meta.db')
         self.serial = serial
         self.header_len = 1024
-        self.h_delim = '_||_||_'
+        self.h_delim = b'_||_||_'
         self.header = {}
         self.indexes = {}
-        self.default_storage = maras.stor.mpack.MPack(self.dbpath)
+        # The name of the hash index records are stored through, and the
+        # names of the indexes maintained alongside it
+        self.primary = None
+        self.secondary = []
+        # Index and storage files share one bounded pool of open handles,
+        # the limit is set from the open_fd header value
+        self.fd_cache = maras.utils.fdcache.FDCache(threadsafe=bool(threads))
+        # All files share one syncer so storage is always synced before
+        # the index entries that reference it
+        self.syncer = maras.utils.sync.Syncer()
+        # Held by every operation when the syncer's timer thread may flush
+        # files the caller's thread is using, see _configure
+        self.op_lock = None
+        # Processes and threads sharing the database serialize writes to each
+        # hash map directory through locks
+        self.shared = shared
+        self.threads = threads
+        if shared or threads:
+            self.locks = maras.utils.lock.ShardLocks(
+                    processes=shared,
+                    threads=bool(threads))
+        else:
+            self.locks = None
+        self.pool = None
+        # Optional instrumentation of the hot paths, see stats
+        if meter:
+            self.meter = maras.utils.meter.Meter()
+        else:
+            self.meter = None
+        # The storage engine new records are written with. Unless storage
+        # is passed the engine, and its options, saved by create are used
         self.stores = {}
-        self.stores[storage] = self.default_storage
+        self.add_storage('msgpack')
+        self.stor_opts = stor_opts or {}
+        self.pick_stor = storage is None
+        self._use_storage(storage or 'msgpack', self.stor_opts)
+        # Optional read through cache of decoded records, cache_bytes is the
+        # budget measured in serialized record bytes
+        if cache_bytes:
+            self.cache = maras.utils.cache.RecordCache(cache_bytes)
+        else:
+            self.cache = None
+        # The persisted list of hash maps, None when disabled
+        self.use_manifest = manifest
+        self.manifest = None
         self.opened = False
 
     def create(
@@ -48,13 +135,54 @@ class DB(object):
             header_len=1024,
             key_delim='/',
             open_fd=512,
-            sync=True):
+            sync=True,
+            use_mmap=False,
+            place_hash=None,
+            sync_bytes=4 * 1024 * 1024,
+            sync_interval=0.05,
+            growable=True,
+            bloom_fp=0.01):
         '''
         Create a new db, this will create the new database meta file, the
         meta file contains the default information to apply to new indexes
         allowing the database to be re-opened without needing to re-pass
         all of the index params
+
+        If use_mmap is True the hash map files are memory mapped and buckets
+        and index entries are read and written through the mapping rather
+        than with seek/read/write calls
+
+        place_hash selects the digest used to place keys in hash map buckets,
+        by default placement is derived from the key_hash digest. The
+        non-cryptographic 'crc32' checksum is also available here, but not
+        as key_hash since buckets only hold the key_hash digest of a key.
+        Growable maps always place keys by their key_hash digest, so
+        place_hash can only be set together with growable=False
+
+        sync sets the durability mode, 'none' never fsyncs, 'per-op' (or
+        True) fsyncs storage and then index files after every insert and
+        'group' fsyncs all dirty files together once sync_bytes have been
+        written or sync_interval seconds have passed since the last sync
+
+        growable maps start small and split their buckets as keys are added,
+        instead of holding hash_limit + 1 buckets and spilling collisions
+        into further map files. hash_limit only applies when growable is
+        False, databases created before growable maps keep fixed maps
+
+        bloom_fp is the false positive rate of the Bloom filter kept for
+        every hash map file, lookups of missing keys skip the maps whose
+        filter does not hold the key without reading them. 0 disables the
+        filters
         '''
+        maras.utils.sync.get_mode(sync)
+        maras.utils.get_hash_data(key_hash)
+        if place_hash:
+            maras.utils.get_hash_data(place_hash, place=True)
+            if growable:
+                raise ValueError(
+                        'place_hash can only be used with growable=False')
+        if bloom_fp and not 0 < bloom_fp < 1:
+            raise ValueError('bloom_fp must be between 0 and 1')
         if os.path.exists(self.path):
             raise ValueError('Database exists')
         dbdir = os.path.dirname(self.path)
@@ -70,61 +198,650 @@ class DB(object):
         self.header['key_delim'] = key_delim
         self.header['open_fd'] = open_fd
         self.header['sync'] = sync
+        self.header['use_mmap'] = use_mmap
+        self.header['place_hash'] = place_hash
+        self.header['sync_bytes'] = sync_bytes
+        self.header['sync_interval'] = sync_interval
+        self.header['growable'] = growable
+        self.header['bloom_fp'] = bloom_fp
+        self.header['storage'] = self.default_stor
+        self.header['stor_opts'] = self.stor_opts
+        self._configure()
         with io.open(self.path, 'w+b') as fp_:
-            header = '{0}{1}'.format(msgpack.dumps(self.header), self.h_delim)
+            header = msgpack.dumps(self.header) + self.h_delim
             fp_.write(header)
+        if self.use_manifest:
+            self.manifest = maras.manifest.Manifest(
+                    self.dbpath,
+                    self.shared,
+                    self.syncer.mode != 'none')
+            self.manifest.create()
         self.opened = True
         return self.header
 
-    def open_db(self):
+    def open_db(self, warm=0):
         '''
-        Open an existing index
+        Open an existing index, warm is the number of bytes of the files of
+        the most used hash maps of earlier sessions to read ahead, see warm
         '''
         if not os.path.isfile(self.path):
             raise ValueError('No Database Exists')
         with io.open(self.path, 'rb') as fp_:
             raw_head = fp_.read(self.header_len)
-            self.header = msgpack.loads(raw_head[:raw_head.index(self.h_delim)])
+            self.header = msgpack.loads(
+                    raw_head[:raw_head.index(self.h_delim)])
+        # Records already written with the saved engine must stay readable
+        # when another one is passed
+        storage = self.header.get('storage', 'msgpack')
+        opts = dict(self.header.get('stor_opts') or {})
+        opts.update(self.stor_opts)
+        if self.pick_stor:
+            self._use_storage(storage, opts)
+        elif storage not in self.stores:
+            self.add_storage(storage, **opts)
+        self._configure()
+        if self.use_manifest:
+            self.manifest = maras.manifest.Manifest(
+                    self.dbpath,
+                    self.shared,
+                    self.syncer.mode != 'none')
+            self.manifest.load()
         self.opened = True
+        if warm:
+            self.warm(warm)
         return self.header
 
-    def add_index(self, name):
+    def warm(self, max_bytes):
+        '''
+        Read the files of the hash maps with the most lookups in earlier
+        sessions into the page cache, hottest first, until max_bytes have
+        been read. Returns the number of bytes read
+        '''
+        if self.manifest is None:
+            raise ValueError('DB not opened with manifest')
+        return self.manifest.warm(max_bytes)
+
+    def _configure(self):
         '''
-        Add an index
+        Apply the header settings to the shared handle cache and syncer
+        '''
+        if self.threads and self.header.get('use_mmap'):
+            raise ValueError('use_mmap can not be used with threads')
+        self.fd_cache.limit = self.header.get('open_fd', self.fd_cache.limit)
+        self.syncer.mode = maras.utils.sync.get_mode(
+                self.header.get('sync', False))
+        self.syncer.group_bytes = self.header.get(
+                'sync_bytes',
+                self.syncer.group_bytes)
+        self.syncer.group_interval = self.header.get(
+                'sync_interval',
+                self.syncer.group_interval)
+        if self.syncer.mode == 'group':
+            # Writes left pending by an idle writer are synced from a timer
+            # thread, operations which do not expect other threads exclude
+            # it with op_lock
+            if not self.threads:
+                self.op_lock = threading.RLock()
+            self.syncer.idle_flush = self.sync
+
+    def add_index(self, name, kind='dhm', **kwargs):
+        '''
+        Add an index, the first hash index ('dhm') added is the primary index
+        records are stored through. Other kinds, listed in INDEX_TYPES, are
+        updated on every insert and are built from the existing keys when
+        they are first created
+
+        A 'value' index is passed the field of the records to index, a
+        dotted name reaches into nested dicts, or an extract function
+        returning the value of a record, and is queried with find
         '''
         if not self.opened:
             raise ValueError('DB not opened')
         if name in self.indexes:
             raise ValueError('Already has index')
-        ind = maras.index.dhm.DHM(self.dbpath, **self.header)
+        if kind == 'dhm':
+            ind = maras.index.dhm.DHM(
+                    self.dbpath,
+                    fd_cache=self.fd_cache,
+                    syncer=self.syncer,
+                    shared=self.shared,
+                    threadsafe=bool(self.threads),
+                    meter=self.meter,
+                    manifest=self.manifest,
+                    **self.header)
+            self.indexes[name] = ind
+            if self.primary is None:
+                self.primary = name
+            return ind
+        if kind not in INDEX_TYPES:
+            raise ValueError('Unknown index type {0}'.format(kind))
+        ind = INDEX_TYPES[kind](
+                self.dbpath,
+                name,
+                syncer=self.syncer,
+                locks=self.locks,
+                **kwargs)
+        if ind.new and self.primary is not None:
+            ind.insert_many(
+                    (key, entry['d'], entry['id_'], None)
+                    for key, entry in self.scan())
         self.indexes[name] = ind
+        self.secondary.append(name)
+        return ind
 
-    def insert(self, data, key, id_=None, stor='msgpack'):
+    def add_storage(self, name, kind=None, **kwargs):
         '''
-        Insert the given data into the db
+        Add a storage engine, kind is a key of STOR_TYPES and defaults to
+        name. The kwargs are passed to the engine, for zblock these are
+        codec, level, block_size and cache_bytes
         '''
-        if stor is None:
-            stor = self.default_storage
-        else:
-            stor = self.stores.get(stor, self.default_storage)
+        if name in self.stores:
+            raise ValueError('Already has storage')
+        kind = kind or name
+        if kind not in STOR_TYPES:
+            raise ValueError('Unknown storage type {0}'.format(kind))
+        self.stores[name] = STOR_TYPES[kind](
+                self.dbpath,
+                self.fd_cache,
+                self.syncer,
+                shared=self.shared,
+                meter=self.meter,
+                **kwargs)
+        return self.stores[name]
+
+    def _use_storage(self, name, opts):
+        '''
+        Write new records with the named storage engine, adding it with
+        opts if it is not added yet
+        '''
+        if name not in self.stores:
+            self.add_storage(name, **opts)
+        self.default_stor = name
+        self.default_storage = self.stores[name]
+
+    def _insert_stor(self, stor):
+        '''
+        Return the storage engine to insert with and the extra index entry
+        fields which record it
+        '''
+        if stor is None or stor not in self.stores:
+            stor = self.default_stor
+        if stor == 'msgpack':
+            return self.stores[stor], {}
+        return self.stores[stor], {'stor': stor}
+
+    def _ind_stor(self, stor_name):
+        '''
+        Return the storage engine an index entry was written with
+        '''
+        stor_name = stor_name or 'msgpack'
+        if stor_name not in self.stores:
+            raise ValueError('Storage {0} is not added'.format(stor_name))
+        return self.stores[stor_name]
+
+    def _primary(self):
+        '''
+        Return the primary hash index
+        '''
+        if self.primary is None:
+            raise ValueError('No hash index added')
+        return self.indexes[self.primary]
+
+    @contextlib.contextmanager
+    def _op(self):
+        '''
+        Bracket an operation so that file handles evicted by other threads
+        are not closed while it may still use them
+        '''
+        token = self.fd_cache.enter()
+        if self.op_lock is not None:
+            self.op_lock.acquire()
+        try:
+            yield
+        finally:
+            if self.op_lock is not None:
+                self.op_lock.release()
+            self.fd_cache.exit(token)
+
+    @contextlib.contextmanager
+    def _write_lock(self, index, keys):
+        '''
+        Hold the writer locks of the hash map directories of keys and pick
+        up the writes other processes made to their maps
+        '''
+        if self.locks is None:
+            yield
+            return
+        dirs = set(index._hm_dir(key) for key in keys)
+        with self.locks.write(dirs):
+            if self.shared:
+                for map_key, map_data in list(index.maps.items()):
+                    if map_data['dir'] not in dirs:
+                        continue
+                    index.refresh(map_key)
+                    for stor in self.stores.values():
+                        stor.refresh(map_data)
+            yield
+
+    def _snap(self):
+        '''
+        Return a new snapshot for a read when shared with other processes or
+        threads, see DHM.snapshot
+        '''
+        if self.shared or self.threads:
+            return {}
+        return None
+
+    def _cached(self, id_):
+        '''
+        Return True if the record cache can serve reads of id_, the latest
+        revision of a key can be changed by another process or thread so it
+        is only cached when not shared
+        '''
+        if self.cache is None:
+            return False
+        return bool(id_) or not (self.shared or self.threads)
+
+    def insert(self, data, key, id_=None, stor=None):
+        '''
+        Insert the given data into the db. data can also be a file like object
+        or an iterator of byte string chunks, which is stored chunk by chunk
+        as a byte string and can be read back with get_stream. Secondary
+        indexes are passed None as the data of streamed records
+        '''
+        if self.meter is not None:
+            t_start = self.meter.now()
+        stor, extra = self._insert_stor(stor)
+        stream = maras.stor.mpack.is_stream(data)
+        if stream and not stor.streams:
+            raise ValueError(
+                    'Streamed values are not supported with {0} '
+                    'storage'.format(stor.prefix))
         if not id_:
             id_ = maras.utils.rand_hex_str(64)
-        for name, index in self.indexes.items():
-            ind_ref, map_key = index.hash_map_ref(key)
-            size, start = stor.insert(key, data, id_, index.maps[map_key])
-            index.insert(key, id_, start, size, None, ind_ref, map_key)
-            ind_ref['start'] = start
-            ind_ref['size'] = size
-            return ind_ref
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        index = self._primary()
+        with self._op():
+            with self._write_lock(index, [key]):
+                ind_ref, map_key = index.hash_map_ref(key)
+                start, size = stor.insert(
+                        key, data, id_, index.maps[map_key])
+                self.syncer.barrier()
+                index.insert(
+                        key, id_, start, size, None, ind_ref, map_key,
+                        **extra)
+                ind_ref['start'] = start
+                ind_ref['size'] = size
+                for name in self.secondary:
+                    self.indexes[name].insert(
+                            key,
+                            None if stream else data,
+                            id_,
+                            ind_ref)
+                self.syncer.commit()
+        if self.meter is not None:
+            self.meter.timed('insert', t_start)
+        return ind_ref
+
+    def insert_many(self, records, stor=None):
+        '''
+        Insert a batch of records, each record is a (data, key) or
+        (data, key, id_) tuple. Records are grouped by their target hash map
+        file so that each storage and map file receives a single append,
+        with threads the groups of different hash map directories are
+        written in parallel. Returns the index references in the order the
+        records were passed
+        '''
+        if self.meter is not None:
+            t_start = self.meter.now()
+        stor, extra = self._insert_stor(stor)
+        index = self._primary()
+        recs = []
+        for rec in records:
+            id_ = rec[2] if len(rec) > 2 else None
+            if not id_:
+                id_ = maras.utils.rand_hex_str(64)
+            if self.cache is not None:
+                self.cache.invalidate(rec[1])
+            recs.append((len(recs), rec[0], rec[1], id_))
+        if self.threads > 1:
+            shards = {}
+            for rec in recs:
+                shards.setdefault(index._hm_dir(rec[2]), []).append(rec)
+            batches = list(shards.values())
+        else:
+            batches = [recs]
+        order = [None] * len(recs)
+        with self._op():
+            if len(batches) > 1:
+                if self.pool is None:
+                    self.pool = multiprocessing.pool.ThreadPool(self.threads)
+                results = self.pool.map(
+                        lambda batch: self._insert_batch(
+                            batch, stor, extra, index),
+                        batches)
+            else:
+                results = [
+                        self._insert_batch(batch, stor, extra, index)
+                        for batch in batches]
+            for result in results:
+                for num, ret in result:
+                    order[num] = ret
+            self.syncer.commit()
+        if self.meter is not None:
+            self.meter.timed('insert_many', t_start)
+        return order
+
+    def _insert_batch(self, recs, stor, extra, index):
+        '''
+        Write a batch of (num, data, key, id_) records to the primary and
+        secondary indexes holding the locks of their directories, so that the
+        secondary indexes see the writes to a key in the same order. Returns
+        the (num, ind_ref) of the records
+        '''
+        keys = [rec[2] for rec in recs]
+        with self._write_lock(index, keys):
+            index.reserve(keys)
+            groups = {}
+            pending = {}
+            for rec in recs:
+                ind_ref, map_key = index.hash_map_ref(rec[2], pending)
+                pending[(map_key, ind_ref['pos'])] = ind_ref
+                groups.setdefault(map_key, []).append((rec, ind_ref))
+            locs = {}
+            for map_key, group in groups.items():
+                locs[map_key] = stor.insert_many(
+                        [(rec[1], rec[3], rec[2]) for rec, ind_ref in group],
+                        index.maps[map_key])
+            self.syncer.barrier()
+            ret = []
+            for map_key, group in groups.items():
+                entries = []
+                for (rec, ind_ref), loc in zip(group, locs[map_key]):
+                    entries.append(
+                            (rec[2], rec[3], loc[0], loc[1], None, ind_ref))
+                index.insert_many(map_key, entries, **extra)
+                for (rec, ind_ref), loc in zip(group, locs[map_key]):
+                    i_ret = dict(ind_ref)
+                    i_ret['start'], i_ret['size'] = loc
+                    ret.append((rec[0], i_ret))
+            if self.secondary:
+                refs = dict(ret)
+                items = [(rec[2], rec[1], rec[3], refs[rec[0]])
+                         for rec in recs]
+                for name in self.secondary:
+                    self.indexes[name].insert_many(items)
+        return ret
 
     def get(self, key, id_=None):
         '''
         Retrive a database entry
         '''
-        for name, index in self.indexes.items():
-            ind, map_key = index.get_h_index(key, id_)
-            if 'stor' in ind:
-                stor = self.stores.get(ind['stor'], self.default_storage)
+        if self.meter is not None:
+            t_start = self.meter.now()
+        if self._cached(id_):
+            entry = self.cache.get(key, id_)
+            if entry is not None:
+                if self.meter is not None:
+                    self.meter.timed('get', t_start)
+                return entry
+        index = self._primary()
+        with self._op():
+            ind, map_key = index.get_h_index(key, id_, self._snap())
+            stor = self._ind_stor(ind.get('stor'))
+            entry = stor.get(ind, index.maps[map_key])
+        if self._cached(id_):
+            self.cache.set(key, id_, entry, ind['sz'])
+        if self.meter is not None:
+            self.meter.timed('get', t_start)
+        return entry
+
+    def get_stream(self, key, id_=None):
+        '''
+        Return a file like reader of the data of an entry stored as a byte
+        string. Large values, and values inserted from a stream, are read
+        from storage as the reader is read so they are never held whole
+        '''
+        index = self._primary()
+        with self._op():
+            ind, map_key = index.get_h_index(key, id_, self._snap())
+            stor = self._ind_stor(ind.get('stor'))
+            if stor.streams:
+                return stor.get_stream(ind, index.maps[map_key])
+            data = stor.get(ind, index.maps[map_key])['d']
+        if not isinstance(data, bytes):
+            raise ValueError('The data of the record is not a byte string')
+        return io.BytesIO(data)
+
+    def get_many(self, keys):
+        '''
+        Retrieve the latest entry for many keys at once. All index references
+        are resolved first and the storage reads are grouped per storage
+        file and coalesced in offset order. Returns a list of entries in the
+        order of the passed keys, with None for missing keys, and the list
+        of missing keys
+        '''
+        if self.meter is not None:
+            t_start = self.meter.now()
+        index = self._primary()
+        ret = [None] * len(keys)
+        missing = []
+        groups = {}
+        refs_ind = {}
+        snap = self._snap()
+        with self._op():
+            for num, key in enumerate(keys):
+                if self._cached(None):
+                    ret[num] = self.cache.get(key, None)
+                    if ret[num] is not None:
+                        continue
+                try:
+                    ind, map_key = index.get_h_index(key, snap=snap)
+                except KeyError:
+                    missing.append(key)
+                    continue
+                groups.setdefault(
+                        (ind.get('stor'), map_key),
+                        []).append((num, ind))
+                refs_ind[num] = ind
+            for (stor_name, map_key), refs in groups.items():
+                stor = self._ind_stor(stor_name)
+                found = stor.get_many(refs, index.maps[map_key])
+                for num, entry in found.items():
+                    ret[num] = entry
+                    if self._cached(None):
+                        ind = refs_ind[num]
+                        self.cache.set(keys[num], None, entry, ind['sz'])
+        if self.meter is not None:
+            self.meter.timed('get_many', t_start)
+        return ret, missing
+
+    def scan(self, prefix='', keys_only=False, batch=1024):
+        '''
+        Iterate over the latest revision of every key starting with prefix,
+        yielding (key, entry) pairs, or only the keys if keys_only is True in
+        which case the storage files are never read. Buckets are read batch
+        at a time and the storage reads of each batch are made in storage
+        offset order, so memory use is bounded by batch and not by the size
+        of the tree
+        '''
+        index = self._primary()
+        snap = self._snap()
+        with self._op():
+            for map_key in index.iter_prefix_maps(prefix):
+                refs = []
+                limit = index.snapshot(map_key, snap)
+                for h_entry in index.iter_buckets(map_key):
+                    ind = index.latest(h_entry['prev'], map_key, limit)
+                    if ind is None or not ind['key'].startswith(prefix):
+                        continue
+                    if keys_only:
+                        yield ind['key']
+                        continue
+                    refs.append((ind['key'], ind))
+                    if len(refs) >= batch:
+                        for item in self._scan_batch(index, map_key, refs):
+                            yield item
+                        refs = []
+                if refs:
+                    for item in self._scan_batch(index, map_key, refs):
+                        yield item
+        return
+
+    def _scan_batch(self, index, map_key, refs):
+        '''
+        Read a batch of scanned index references in storage offset order
+        '''
+        refs.sort(key=lambda ref: ref[1]['st'])
+        groups = {}
+        for ref in refs:
+            groups.setdefault(ref[1].get('stor'), []).append(ref)
+        for stor_name, group in groups.items():
+            stor = self._ind_stor(stor_name)
+            found = stor.get_many(group, index.maps[map_key])
+            for key, ind in group:
+                yield key, found[key]
+
+    def range(
+            self,
+            start=None,
+            end=None,
+            limit=None,
+            keys_only=False,
+            index=None):
+        '''
+        Return the keys from start, inclusive, to end, exclusive, in sorted
+        order from an ordered index, at most limit keys are returned. Unless
+        keys_only is set a list of (key, entry) pairs is returned. index
+        names the ordered index to use, by default the first one added
+        '''
+        if index is None:
+            for name in self.secondary:
+                if hasattr(self.indexes[name], 'range'):
+                    index = name
+                    break
             else:
-                stor = self.default_storage
-            return stor.get(ind, index.maps[map_key])
+                raise ValueError('No ordered index added')
+        keys = list(self.indexes[index].range(start, end, limit))
+        if keys_only:
+            return keys
+        entries, missing = self.get_many(keys)
+        return [(key, entry) for key, entry in zip(keys, entries)
+                if entry is not None]
+
+    def find(self, index, value):
+        '''
+        Return the sorted keys of the records the value index named index
+        holds under value, the records themselves are not read
+        '''
+        if not hasattr(self.indexes.get(index), 'find'):
+            raise ValueError('No value index {0}'.format(index))
+        return self.indexes[index].find(value)
+
+    def compact(self, retain=1, step=16):
+        '''
+        Compact the database files, keeping the last retain revisions of
+        every key. Returns a generator which compacts one step of buckets per
+        iteration, yielding None between steps so reads can be served, and
+        a report dict with the disk usage and read latency before and after
+        as each map file is swapped in. The logs of the value indexes are
+        rewritten last, yielding a report dict each
+        '''
+        if not self.opened:
+            raise ValueError('DB not opened')
+        if self.shared or self.threads:
+            raise ValueError(
+                    'Compaction needs the database to not be shared')
+        index = self._primary()
+        return self._steps(maras.compact.Compactor(
+            self,
+            index,
+            retain=retain,
+            step=step).run())
+
+    def _steps(self, steps):
+        '''
+        Run every step of a generator as an operation, the caller may use
+        the database between steps
+        '''
+        while True:
+            with self._op():
+                try:
+                    item = next(steps)
+                except StopIteration:
+                    return
+            yield item
+
+    def cache_stats(self):
+        '''
+        Return the record cache counters, hit ratio, evictions and bytes
+        held, or None if the cache is disabled
+        '''
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def sync(self):
+        '''
+        Fsync all writes that the durability mode has not synced yet
+        '''
+        with self._op():
+            self.syncer.flush()
+
+    def close(self):
+        '''
+        Close all open index and storage files
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.syncer.cancel()
+        with self._op():
+            self.syncer.flush()
+        for index in self.indexes.values():
+            index.close()
+        for stor in self.stores.values():
+            stor.close()
+        self.fd_cache.clear()
+        if self.manifest is not None:
+            hits = {}
+            for index in self.indexes.values():
+                for fn_, count in getattr(index, 'hits', {}).items():
+                    hits[fn_] = hits.get(fn_, 0) + count
+            self.manifest.close(hits)
+
+    def fd_stats(self):
+        '''
+        Return the open file handle cache counters, hits, misses and
+        evictions
+        '''
+        return self.fd_cache.stats()
+
+    def stats(self):
+        '''
+        Return the instrumentation counters, the probe_depth and chain_len
+        histograms and the operation timers, when the database was opened
+        with meter, next to the record cache, handle cache and lock counters
+        '''
+        ret = {
+                'cache': self.cache_stats(),
+                'fd': self.fd_stats(),
+                'locks': None,
+                'meter': None,
+                }
+        if self.locks is not None:
+            ret['locks'] = self.locks.stats()
+        if self.meter is not None:
+            ret['meter'] = self.meter.stats()
+        return ret
+
+    def add_hook(self, func):
+        '''
+        Call func(name, value) for every operation latency and histogram
+        value the meter records
+        '''
+        if self.meter is None:
+            raise ValueError('DB not opened with meter')
+        self.meter.add_hook(func)
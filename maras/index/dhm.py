@@ -6,26 +6,244 @@ A hash based index
 # 2. Write to associated storage file
 # 3. Write to associated index file
 # 4. Write to associated hash map file
+# Index entries are always written before the bucket pointing at them, so a
+# reader in another process which finds a bucket can read the whole chain.
+# Readers sharing the files bound each read by the tail of the map at the
+# start of the read and skip newer entries, giving a consistent snapshot.
+# Growable maps keep their buckets in a separate bkt_N file addressed with
+# linear hashing. The file holds the (level, split, count) state and pages of
+# slots, a map starts with a few pages and splits one page at a time as keys
+# are inserted. A key which does not fit its home page is stored in the
+# following pages and the spill flag of every full page it passed is set, so
+# lookups read pages until one without the flag. A split writes the moved
+# keys to their new page, then the new state and only then clears the old
+# slots, readers that miss while the state changed look again.
+# Every map can keep a Bloom filter of its keys in blm_N, readers skip the
+# maps whose filter does not hold the key without reading a bucket. The file
+# records the map tail the filter covers and is only written on close, the
+# entries appended past that tail, by a crash or by other processes, are
+# added from the map when the filter is loaded and before a shared reader
+# trusts a miss.
+# Maps created with an entry version write index entries as a fixed struct
+# head followed by the key, the id and any extra fields. Only the first entry
+# of a key's chain holds the key, later revisions hold the offset of that
+# entry instead. Entries still start with their 2 byte length and the version
+# byte can not start a msgpack map, so msgpack entries of older maps are read
+# alongside. Compaction rewrites every entry of a map in the current version.
 
 # Import python libs
+import binascii
 import struct
+import mmap
 import os
 import io
+import threading
 
 # Import maras libs
 import maras.utils
+import maras.utils.bloom
+import maras.utils.fdcache
+import maras.utils.pio
+import maras.utils.sync
 
 # Import third party libs
 import msgpack
 
-HEADER_DELIM = '_||_||_'
+HEADER_DELIM = b'_||_||_'
+# The mmap tail pointer lives in the last 8 bytes of the header region
+TAIL_FMT = '>Q'
+TAIL_SIZE = struct.calcsize(TAIL_FMT)
+# Grow mapped map files in 4MB steps
+MMAP_CHUNK = 4 * 1024 * 1024
+# Keys added to the map data at runtime which are not part of the header
+RUNTIME_KEYS = (
+        'fn',
+        'b_end',
+        'tail',
+        'ids',
+        'ids_ok',
+        'ids_len',
+        'lh',
+        'no_split',
+        'page_size',
+        'bloom',
+        'blm_tail',
+        'blm_dirty')
+# Number of buckets read at a time when scanning a whole map
+SCAN_BUCKETS = 4096
+# Bytes read for an index entry, longer entries need a second read
+ENTRY_READ = 512
+# Growable maps, the bucket file starts with the linear hashing state and
+# every page starts with its spill flag
+BKT_STATE = struct.Struct('>QQQ')
+BKT_HEAD = 64
+PAGE_FLAG = struct.Struct('>Q')
+PAGE_SLOTS = 32
+INIT_PAGES = 4
+# Split once the keys fill this fraction of the slots
+GROW_LOAD = 0.4
+# Bloom filter files start with the map generation and the map tail they
+# cover
+BLM_HEAD = struct.Struct('>QQ')
+# Bytes of index entries read at a time when adding them to a filter
+REPLAY_READ = 1024 * 1024
+# Binary index entries, the length, the version, flags, the storage start and
+# size, the revision, the previous entry, the entry holding the key or 0 if
+# this entry holds it and the key and id lengths
+ENTRY_VER = 1
+ENTRY_MARK = struct.pack('>B', ENTRY_VER)
+ENTRY_HEAD = struct.Struct('>HBBQQ8sQQHH')
+# The id is stored as the bytes of its lowercase hex digits
+ENTRY_HEX = 1
+# Extra fields follow the id as a msgpack map
+ENTRY_EXTRA = 2
+# The position of the fields of an Entry
+ENTRY_FIELDS = {
+        'key': 0,
+        'st': 1,
+        'sz': 2,
+        'rev': 3,
+        't': 4,
+        'p': 5,
+        'id': 6,
+        'kp': 7,
+        }
+HEX_DIGITS = b'0123456789abcdef'
+# The C long arithmetic of the python 2 string hash
+HASH_MASK = (1 << 64) - 1
+HASH_SIGN = 1 << 63
 
 
-def calc_position(key, hash_limit, bucket_size, header_len):
+def calc_position(h_val, hash_limit, bucket_size, header_len, f_num=1):
     '''
-    Calculate the hash map file's key position
+    Calculate the hash map file's key position from the key's placement
+    value. Each successive midx file probes a different bucket, the step is
+    taken from the placement bits above the hash_limit mask (double hashing)
     '''
-    return (abs(hash(key) & hash_limit) * bucket_size) + header_len
+    step = (h_val // (hash_limit + 1)) | 1
+    pos = (h_val + (f_num - 1) * step) & hash_limit
+    return (pos * bucket_size) + header_len
+
+
+def py2_hash(raw):
+    '''
+    Return the hash() of the byte string raw on 64 bit python 2 without
+    hash randomization, which python 3 randomizes in every process
+    '''
+    if not raw:
+        return 0
+    data = bytearray(raw)
+    val = data[0] << 7
+    for byte in data:
+        val = ((1000003 * val) ^ byte) & HASH_MASK
+    val ^= len(data)
+    if val & HASH_SIGN:
+        val -= HASH_MASK + 1
+    return -2 if val == -1 else val
+
+
+def legacy_position(key, hash_limit, bucket_size, header_len):
+    '''
+    Calculate the key position used by maps written before digest
+    placement, these used the python 2 hash() of the raw key
+    '''
+    h_val = py2_hash(maras.utils.to_bytes(key))
+    return (abs(h_val & hash_limit) * bucket_size) + header_len
+
+
+class Entry(tuple):
+    '''
+    A decoded binary index entry, fields are read by name like the dicts
+    msgpack entries decode to. Extra fields, such as the storage engine, are
+    held in a dict of their own
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return tuple.__getitem__(self, ENTRY_FIELDS[name])
+        except KeyError:
+            extra = tuple.__getitem__(self, 8)
+            if extra is None or name not in extra:
+                raise KeyError(name)
+            return extra[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        extra = tuple.__getitem__(self, 8)
+        return list(ENTRY_FIELDS) + list(extra or ())
+
+
+def unpack_entry(raw, offset=0, key=None):
+    '''
+    Decode the index entry starting with its length at offset in raw, which
+    must hold the whole entry. Binary entries which do not hold their key get
+    key, or None
+    '''
+    if raw[offset + 2:offset + 3] != ENTRY_MARK:
+        i_len = struct.unpack_from('>H', raw, offset)[0]
+        return msgpack.loads(raw[offset + 2:offset + 2 + i_len])
+    (i_len, ver, flags, start, size, rev, prev, k_pos, k_len,
+            id_len) = ENTRY_HEAD.unpack_from(raw, offset)
+    pos = offset + ENTRY_HEAD.size
+    if not k_pos:
+        key = maras.utils.to_str(raw[pos:pos + k_len])
+        pos += k_len
+    id_ = raw[pos:pos + id_len]
+    if flags & ENTRY_HEX:
+        id_ = binascii.hexlify(id_)
+    id_ = maras.utils.to_str(id_)
+    extra = None
+    type_ = None
+    if flags & ENTRY_EXTRA:
+        extra = msgpack.loads(raw[pos + id_len:offset + 2 + i_len])
+        type_ = extra.get('t')
+    return Entry((key, start, size, rev, type_, prev, id_, k_pos, extra))
+
+
+def pack_entry(entry, key_pos=0):
+    '''
+    Serialize an index entry dict as a binary entry, the key is written only
+    if key_pos is 0
+    '''
+    key = maras.utils.to_bytes(entry['key'])
+    id_ = maras.utils.to_bytes(entry['id'])
+    flags = 0
+    if id_ and not len(id_) % 2 and not id_.strip(HEX_DIGITS):
+        id_ = binascii.unhexlify(id_)
+        flags |= ENTRY_HEX
+    extra = dict(
+            (name, val) for name, val in entry.items()
+            if val is not None and (name == 't' or name not in ENTRY_FIELDS))
+    raw_extra = b''
+    if extra:
+        raw_extra = msgpack.dumps(extra)
+        flags |= ENTRY_EXTRA
+    if key_pos:
+        key = b''
+    i_len = ENTRY_HEAD.size - 2 + len(key) + len(id_) + len(raw_extra)
+    if i_len > 0xffff:
+        raise ValueError('Index entry is too long')
+    return b''.join([
+            ENTRY_HEAD.pack(
+                i_len,
+                ENTRY_VER,
+                flags,
+                entry['st'],
+                entry['sz'],
+                entry['rev'],
+                entry['p'] or 0,
+                key_pos,
+                len(key),
+                len(id_)),
+            key,
+            id_,
+            raw_extra])
 
 
 class DHM(object):
@@ -43,6 +261,16 @@ class DHM(object):
             key_delim='/',
             open_fd=512,
             sync=True,
+            use_mmap=False,
+            place_hash=None,
+            fd_cache=None,
+            syncer=None,
+            shared=False,
+            threadsafe=False,
+            meter=None,
+            growable=False,
+            bloom_fp=0,
+            manifest=None,
             **kwargs):
         if entry_map is None:
             entry_map = ['key', 'prev']
@@ -51,33 +279,80 @@ class DHM(object):
         self.hash_limit = hash_limit
         self.key_hash = key_hash
         self.hash_func, self.key_size = maras.utils.get_hash_data(key_hash)
+        # The bucket placement digest, by default placement is taken from
+        # the key_hash digest which is already computed for the bucket key
+        self.place_hash = place_hash or 'key'
+        if place_hash:
+            self.place_func = maras.utils.get_hash_data(
+                    place_hash,
+                    place=True)[0]
+        else:
+            self.place_func = None
         self.fmt = fmt.replace('K', str(self.key_size))
+        # ids_N records map an id digest to its index entry offset
+        self.id_struct = struct.Struct('>{0}sQ'.format(self.key_size))
         self.bucket_size = self.__calc_bucket_size()
         self.header_len = header_len
         self.key_delim = key_delim
         self.open_fd = open_fd
-        self.fds = []
+        if fd_cache is None:
+            fd_cache = maras.utils.fdcache.FDCache(open_fd)
+        self.fd_cache = fd_cache
         self.maps = {}
         self.sync = sync
+        if syncer is None:
+            syncer = maras.utils.sync.Syncer(sync)
+        self.syncer = syncer
+        self.use_mmap = use_mmap
+        # Files shared with other processes are unbuffered so every write
+        # is visible to them as soon as it returns
+        self.shared = shared
+        self.buffering = 0 if shared else -1
+        # Guards opening maps and loading id indexes when used from threads
+        self.threadsafe = threadsafe
+        self.lock = threading.RLock()
+        # Instrumentation, None when disabled, see maras.utils.meter
+        self.meter = meter
+        # New maps are created growable, existing maps keep their layout
+        self.growable = growable
+        # False positive rate of the per map Bloom filters, 0 disables them
+        self.bloom_fp = bloom_fp
+        # The persisted list of maps, see maras.manifest, and the lookups
+        # of each map in this session
+        self.manifest = manifest
+        self.hits = {}
         self.kwargs = kwargs
 
     def __calc_bucket_size(self):
         '''
         Calculate the size of the index buckets
         '''
-        return len(struct.pack(self.fmt, '', 1))
+        return len(struct.pack(self.fmt, b'', 1))
 
     def _hm_dir(self, key):
         '''
         Return the hashmap directory
         '''
         key = key.strip(self.key_delim)
+        if self.key_delim not in key:
+            return self.db_root
         root = key[:key.rfind(self.key_delim)].replace(self.key_delim, os.sep)
         return os.path.join(self.db_root, root)
 
-    def _i_entry(self, key, id_, start, size, type_, prev, **kwargs):
+    def _i_entry(
+            self,
+            map_data,
+            key,
+            id_,
+            start,
+            size,
+            type_,
+            prev,
+            key_pos=0,
+            **kwargs):
         '''
-        Contruct and return the index data entry as a serialized string
+        Contruct and return the index data entry as a serialized string,
+        key_pos is the offset of the entry holding the key in binary maps
         '''
         entry = {
                 'key': key,
@@ -92,17 +367,25 @@ class DHM(object):
             entry['id'] = maras.utils.rand_hex_str(self.key_size)
         else:
             entry['id'] = id_
+        return self._pack_entry(entry, map_data, key_pos)
+
+    def _pack_entry(self, entry, map_data=None, key_pos=0):
+        '''
+        Serialize an index entry dict with its length prefix, as a binary
+        entry if the map has an entry version
+        '''
+        if map_data is not None and map_data.get('i_ver'):
+            return pack_entry(entry, key_pos)
         packed = msgpack.dumps(entry)
         p_len = struct.pack('>H', len(packed))
-        return '{0}{1}'.format(p_len, packed)
+        return p_len + packed
 
-    def create_h_index(self, fn_):
+    def create_h_index(self, fn_, gen=0):
         '''
-        Create an index at the given location
+        Create an index at the given location, gen is the compaction
+        generation of the storage files the map refers to
         '''
         dirname = os.path.dirname(fn_)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
         header = {
                 'hash': self.key_hash,
                 'h_limit': self.hash_limit,
@@ -110,16 +393,58 @@ class DHM(object):
                 'fmt': self.fmt,
                 'bucket_size': self.bucket_size,
                 'entry_map': self.entry_map,
+                'place': self.place_hash,
                 'dir': os.path.dirname(fn_),
                 'num': int(fn_[fn_.rindex('_') + 1:]),
+                'i_ver': ENTRY_VER,
                 }
-        header_entry = '{0}{1}'.format(msgpack.dumps(header), HEADER_DELIM)
+        if gen:
+            header['gen'] = gen
+        if self.growable:
+            # Placement is taken from the bucket key so that the home page
+            # of a stored key can be found again when its page is split
+            header['place'] = 'key'
+            header['grow'] = True
+            header['pages'] = INIT_PAGES
+            header['slots'] = PAGE_SLOTS
+        header_entry = msgpack.dumps(header) + HEADER_DELIM
+        if len(header_entry) > self.header_len - TAIL_SIZE:
+            raise ValueError('Index header does not fit in header_len')
+        # The map is written under a temporary name and renamed into place so
+        # that other processes never open a map without its header
+        tmp_fn = '{0}.tmp'.format(fn_)
         try:
-            fp_ = io.open(fn_, 'r+b')
+            fp_ = io.open(tmp_fn, 'w+b')
         except IOError:
-            fp_ = io.open(fn_, 'w+b')
-        fp_.write(header_entry)
-        header['fp'] = fp_
+            # The directory is only checked for when the map can not be
+            # written
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+            fp_ = io.open(tmp_fn, 'w+b')
+        size = len(header_entry)
+        with fp_:
+            fp_.write(header_entry)
+            if self.use_mmap and not self.growable:
+                # Reserve the whole bucket region up front, the file stays
+                # sparse
+                size = (
+                        self.header_len +
+                        (self.hash_limit + 1) * self.bucket_size)
+                fp_.truncate(size)
+        # A new map starts with an empty id index, maps without one are
+        # rebuilt on first use
+        io.open(self._ids_fn(fn_), 'w+b').close()
+        if self.growable:
+            with io.open(self._bkt_fn(header), 'w+b') as fp_:
+                fp_.write(BKT_STATE.pack(0, 0, 0))
+        os.rename(tmp_fn, fn_)
+        if self.manifest is not None:
+            self.manifest.add(fn_, header, True, size)
+        header['fn'] = fn_
+        self._prep_map(header, (True, size))
         return header
 
     def open_map(self, fn_):
@@ -127,100 +452,1153 @@ class DHM(object):
         Attempt to open a map file, if the map file does not exist
         raise IOError
         '''
-        if not os.path.isfile(fn_):
-            raise IOError()
-        fp_ = io.open(fn_, 'r+b')
-        header = {'fp': fp_}
-        raw_head = ''
-        while True:
-            raw_read = fp_.read(self.header_len)
-            if not raw_read:
-                raise ValueError('Hit the end of the index file with no header!')
-            raw_head += raw_read
-            if HEADER_DELIM in raw_head:
-                header.update(
-                        msgpack.loads(
-                            raw_head[:raw_head.find(HEADER_DELIM)]
-                            )
-                        )
-                return header
-
-    def _get_h_entry(self, key, fn_):
+        with self.lock:
+            # Opened by another thread in the meantime
+            if fn_ in self.maps:
+                return self.maps[fn_]
+            header = {'fn': fn_}
+            if self.manifest is not None:
+                listed = self.manifest.header(fn_)
+                if listed is not None:
+                    header.update(listed)
+                    self._prep_map(header, self.manifest.file_state(fn_))
+                    return header
+                if self.manifest.exists(fn_) is False:
+                    raise IOError()
+            if not os.path.isfile(fn_):
+                raise IOError()
+            raw_head = b''
+            with io.open(fn_, 'rb') as fp_:
+                while True:
+                    raw_read = fp_.read(self.header_len)
+                    if not raw_read:
+                        raise ValueError(
+                                'Hit the end of the index file with no '
+                                'header!')
+                    raw_head += raw_read
+                    if HEADER_DELIM in raw_head:
+                        break
+            listed = msgpack.loads(raw_head[:raw_head.find(HEADER_DELIM)])
+            header.update(listed)
+            size = self._prep_map(header)
+            if self.manifest is not None:
+                self.manifest.add(fn_, listed, header['ids_ok'], size)
+            return header
+
+    def _prep_map(self, map_data, files=None):
+        '''
+        Calculate the end of the bucket region and register the map, if
+        running in mmap mode find the tail of the index entries. files is
+        whether the id index exists and the map file size, each None if
+        unknown, for maps whose files are known to exist, otherwise the
+        files are looked at. Returns the map file size if it is known
+        '''
+        if map_data.get('grow'):
+            map_data['b_end'] = map_data['header_len']
+            map_data['page_size'] = (
+                    PAGE_FLAG.size +
+                    map_data['slots'] * map_data['bucket_size'])
+            if files is None and not os.path.isfile(self._bkt_fn(map_data)):
+                raise ValueError(
+                        'Bucket file of {0} is missing'.format(map_data['fn']))
+            map_data['lh'] = self._read_state(map_data)
+        else:
+            map_data['b_end'] = (
+                    map_data['header_len'] +
+                    (map_data['h_limit'] + 1) * map_data['bucket_size'])
+        if files is None:
+            files = (os.path.isfile(self._ids_fn(map_data['fn'])), None)
+        # An unknown id index is looked for on first use
+        map_data['ids_ok'], size = files
+        map_data['ids'] = None
+        map_data['ids_len'] = 0
+        map_data['bloom'] = None
+        self.maps[map_data['fn']] = map_data
+        if not self.use_mmap:
+            return size
+        # Map files only grow, a recorded size past the bucket region holds
+        if size is None or size < map_data['b_end']:
+            size = os.path.getsize(map_data['fn'])
+            if size < map_data['b_end']:
+                # Reserve the whole bucket region up front, the file stays
+                # sparse
+                with io.open(map_data['fn'], 'r+b') as fp_:
+                    fp_.truncate(map_data['b_end'])
+                size = map_data['b_end']
+        map_data['tail'] = self._find_tail(map_data)
+        return size
+
+    def _find_tail(self, map_data):
+        '''
+        Return the tail of a mapped map file from its tail slot
+        '''
+        mm_ = self._open(map_data)['mm']
+        f_size = len(mm_)
+        tail_pos = map_data['header_len'] - TAIL_SIZE
+        tail = struct.unpack_from(TAIL_FMT, mm_, tail_pos)[0]
+        tail = max(tail, map_data['b_end'])
+        # Pick up any entries appended past the recorded tail while the
+        # file was opened without mmap
+        while tail + 2 <= f_size:
+            i_len = struct.unpack_from('>H', mm_, tail)[0]
+            if not i_len or tail + 2 + i_len > f_size:
+                break
+            tail += 2 + i_len
+        return tail
+
+    def refresh(self, map_key):
+        '''
+        Pick up the index entries and id records written to a map by other
+        processes, called by writers once they hold the map's lock
+        '''
+        map_data = self.maps[map_key]
+        if map_data['ids'] is not None:
+            self._read_ids(map_data)
+        if map_data.get('grow'):
+            map_data['lh'] = self._read_state(map_data)
+        if self.use_mmap:
+            self._remap(self._open(map_data))
+            map_data['tail'] = self._find_tail(map_data)
+
+    def snapshot(self, map_key, snap):
+        '''
+        Return the tail of the map as of the start of a read, entries at or
+        past it were written after the read started. snap is a dict holding
+        the tails of the maps read so far, None disables the bound
+        '''
+        if snap is None:
+            return None
+        if map_key not in snap:
+            map_data = self.maps[map_key]
+            handle = self._open(map_data)
+            if handle['mm'] is not None:
+                tail = struct.unpack_from(
+                        TAIL_FMT,
+                        handle['mm'],
+                        map_data['header_len'] - TAIL_SIZE)[0]
+            else:
+                tail = maras.utils.pio.size(handle['fp'])
+            snap[map_key] = max(tail, map_data['b_end'])
+        return snap[map_key]
+
+    def _open(self, map_data):
+        '''
+        Make sure the map file is open in the shared handle cache and return
+        its handle, a dict holding the file and in mmap mode the mapping
+        '''
+        return self.fd_cache.get(
+                map_data['fn'],
+                self._open_handle,
+                self._close_handle)
+
+    def _open_handle(self, fn_):
+        '''
+        Open the file handle, and the mapping in mmap mode, for a map file
+        '''
+        handle = {'fp': io.open(fn_, 'r+b', self.buffering), 'mm': None}
+        if self.use_mmap:
+            handle['mm'] = mmap.mmap(
+                    handle['fp'].fileno(),
+                    maras.utils.pio.size(handle['fp']))
+        return handle
+
+    def _close_handle(self, handle):
+        '''
+        Close the file handle and mapping of a map file
+        '''
+        if handle['mm'] is not None:
+            handle['mm'].flush()
+            handle['mm'].close()
+        handle['fp'].close()
+
+    def _read(self, map_data, pos, size):
+        '''
+        Read size bytes from the map file at the given position
+        '''
+        if self.meter is not None:
+            self.meter.io('index', 'read', size)
+        handle = self._open(map_data)
+        if handle['mm'] is not None:
+            if self.shared and pos + size > len(handle['mm']):
+                # Grown by another process
+                self._remap(handle)
+            return handle['mm'][pos:pos + size]
+        return maras.utils.pio.pread(handle['fp'], size, pos)
+
+    def _write(self, map_data, pos, data):
+        '''
+        Write data to the map file at the given position
+        '''
+        if self.meter is not None:
+            self.meter.io('index', 'write', len(data))
+        handle = self._open(map_data)
+        self.syncer.dirty_index(map_data['fn'], len(data), self._sync_file)
+        if handle['mm'] is not None:
+            handle['mm'][pos:pos + len(data)] = data
+            return
+        maras.utils.pio.pwrite(handle['fp'], data, pos)
+
+    def _append(self, map_data, data):
+        '''
+        Append data past the bucket region of the map file and return the
+        position it was written to
+        '''
+        if self.meter is not None:
+            self.meter.io('index', 'write', len(data))
+        pos = self._tail(map_data)
+        handle = self._open(map_data)
+        self.syncer.dirty_index(map_data['fn'], len(data), self._sync_file)
+        if handle['mm'] is None:
+            maras.utils.pio.pwrite(handle['fp'], data, pos)
+            return pos
+        end = pos + len(data)
+        if end > len(handle['mm']):
+            self._grow_mmap(handle, end)
+        handle['mm'][pos:end] = data
+        map_data['tail'] = end
+        tail_pos = map_data['header_len'] - TAIL_SIZE
+        struct.pack_into(TAIL_FMT, handle['mm'], tail_pos, end)
+        return pos
+
+    def _sync_file(self, fn_):
+        '''
+        Flush the map file, and its mapping, to disk
+        '''
+        handle = self._open(self.maps[fn_])
+        if handle['mm'] is not None:
+            handle['mm'].flush()
+        handle['fp'].flush()
+        os.fsync(handle['fp'].fileno())
+
+    def _tail(self, map_data):
+        '''
+        Return the position the next appended index entry will be written to
+        '''
+        handle = self._open(map_data)
+        if handle['mm'] is not None:
+            return map_data['tail']
+        return max(maras.utils.pio.size(handle['fp']), map_data['b_end'])
+
+    def _grow_mmap(self, handle, min_size):
+        '''
+        Extend the file and the mapping in MMAP_CHUNK steps so that it
+        covers at least min_size bytes
+        '''
+        new_size = ((min_size // MMAP_CHUNK) + 1) * MMAP_CHUNK
+        handle['mm'].close()
+        handle['fp'].truncate(new_size)
+        handle['fp'].flush()
+        handle['mm'] = mmap.mmap(handle['fp'].fileno(), new_size)
+
+    def _remap(self, handle):
+        '''
+        Extend the mapping to cover a file grown by another process
+        '''
+        size = maras.utils.pio.size(handle['fp'])
+        if size <= len(handle['mm']):
+            return
+        handle['mm'].close()
+        handle['mm'] = mmap.mmap(handle['fp'].fileno(), size)
+
+    def _key_digest(self, key):
+        '''
+        Return the bucket key and the placement value for the given key,
+        these are calculated once per key and reused across all of the
+        probed midx files
+        '''
+        h_key = self.hash_func(key).hexdigest()
+        if self.place_func is None:
+            h_val = int(h_key[:16], 16)
+        else:
+            h_val = int(self.place_func(key).hexdigest()[:16], 16)
+        return h_key, h_val
+
+    def _bucket_pos(self, map_data, key, digest):
+        '''
+        Return the bucket key and the bucket position of the key in the
+        given map
+        '''
+        if 'place' in map_data:
+            return digest[0], calc_position(
+                    digest[1],
+                    map_data['h_limit'],
+                    map_data['bucket_size'],
+                    map_data['header_len'],
+                    map_data['num'])
+        return maras.utils.to_bytes(key), legacy_position(
+                key,
+                map_data['h_limit'],
+                map_data['bucket_size'],
+                map_data['header_len'])
+
+    def _get_h_entry(self, key, fn_, digest, pending=None, create=True):
         '''
         Return the hash map entry from the given file name.
         If the entry is not present then return None
-        If the file is not present, create it
+        If the file is not present, create it, or return None, None unless
+        create is set
+        Buckets claimed by a batch that has not been written yet are looked
+        up in pending, keyed on (fn_, pos)
         '''
         if fn_ in self.maps:
             map_data = self.maps[fn_]
         else:
             try:
                 map_data = self.open_map(fn_)
-                self.maps[fn_] = map_data
             except IOError:
+                if not create:
+                    return None, None
                 map_data = self.create_h_index(fn_)
-                self.maps[fn_] = map_data
-        pos = calc_position(
-                key,
-                map_data['h_limit'],
-                map_data['bucket_size'],
-                map_data['header_len'])
-        raw_h_entry = map_data['fp'].read(map_data['bucket_size'])
+        if map_data.get('grow'):
+            return self._find_slot(map_data, digest[0], pending, create), True
+        h_key, pos = self._bucket_pos(map_data, key, digest)
+        if pending and (fn_, pos) in pending:
+            ret = pending[(fn_, pos)]
+            return ret, ret['key'] == h_key
+        raw_h_entry = self._read(map_data, pos, map_data['bucket_size'])
         try:
             comps = struct.unpack(map_data['fmt'], raw_h_entry)
         except Exception:
-            comps = ('\0', 0)
+            comps = (b'\0', 0)
         ret = {}
         ret['pos'] = pos
         for ind in range(len(map_data['entry_map'])):
             ret[map_data['entry_map'][ind]] = comps[ind]
-        if comps[0] == '\0' * len(comps[0]):
-            ret['key'] = key
-            return ret, map_data
-        return ret, map_data
+        ret['key'] = ret['key'].rstrip(b'\0')
+        if not ret['key']:
+            ret['key'] = h_key
+            return ret, True
+        return ret, ret['key'] == h_key
+
+    def _bkt_fn(self, map_data):
+        '''
+        Return the bucket file name of a growable map, compacted maps
+        reference a new generation of their bucket file
+        '''
+        name = 'bkt_{0}'.format(map_data['num'])
+        if map_data.get('gen'):
+            name = '{0}.{1}'.format(name, map_data['gen'])
+        return os.path.join(map_data['dir'], name)
+
+    def _open_bkt(self, fn_):
+        '''
+        Open a bucket file
+        '''
+        return io.open(fn_, 'r+b', self.buffering)
+
+    def _close_bkt(self, fp_):
+        '''
+        Close a bucket file
+        '''
+        fp_.close()
+
+    def _sync_bkt(self, fn_):
+        '''
+        Flush a bucket file to disk
+        '''
+        fp_ = self.fd_cache.get(fn_, self._open_bkt, self._close_bkt)
+        fp_.flush()
+        os.fsync(fp_.fileno())
+
+    def _bkt_read(self, map_data, pos, size):
+        '''
+        Read size bytes of the bucket file, past the end reads as empty
+        '''
+        if self.meter is not None:
+            self.meter.io('index', 'read', size)
+        fp_ = self.fd_cache.get(
+                self._bkt_fn(map_data),
+                self._open_bkt,
+                self._close_bkt)
+        raw = maras.utils.pio.pread(fp_, size, pos)
+        if len(raw) < size:
+            raw += b'\0' * (size - len(raw))
+        return raw
+
+    def _bkt_write(self, map_data, pos, data):
+        '''
+        Write data to the bucket file at the given position
+        '''
+        if self.meter is not None:
+            self.meter.io('index', 'write', len(data))
+        fn_ = self._bkt_fn(map_data)
+        fp_ = self.fd_cache.get(fn_, self._open_bkt, self._close_bkt)
+        maras.utils.pio.pwrite(fp_, data, pos)
+        self.syncer.dirty_index(fn_, len(data), self._sync_bkt)
 
-    def hash_map_ref(self, key):
+    def _read_state(self, map_data):
         '''
-        Return the hash map reference data
+        Return the (level, split, count) state of a growable map
+        '''
+        return BKT_STATE.unpack(self._bkt_read(map_data, 0, BKT_STATE.size))
+
+    def _home(self, map_data, state, h_key):
+        '''
+        Return the home page of a bucket key under the given state
+        '''
+        h_val = int(h_key[:16], 16)
+        base = map_data['pages'] << state[0]
+        page = h_val % base
+        if page < state[1]:
+            page = h_val % (base << 1)
+        return page
+
+    def _page_pos(self, map_data, page):
+        '''
+        Return the position of a page in the bucket file
+        '''
+        return BKT_HEAD + page * map_data['page_size']
+
+    def _read_page(self, map_data, page):
+        '''
+        Return the position, the raw data and the spill flag of a page
+        '''
+        pos = self._page_pos(map_data, page)
+        raw = self._bkt_read(map_data, pos, map_data['page_size'])
+        return pos, raw, PAGE_FLAG.unpack_from(raw)[0]
+
+    def _slot(self, map_data, raw, pos, offset):
+        '''
+        Return the slot at offset of a page read from pos
+        '''
+        comps = struct.unpack_from(map_data['fmt'], raw, offset)
+        entry_map = map_data['entry_map']
+        slot = {'pos': pos + offset}
+        for ind in range(len(entry_map)):
+            slot[entry_map[ind]] = comps[ind]
+        slot['key'] = slot['key'].rstrip(b'\0')
+        return slot
+
+    def _page_slots(self, map_data, pos, raw):
+        '''
+        Return all of the slots of a page
+        '''
+        return [
+                self._slot(map_data, raw, pos, offset)
+                for offset in range(
+                    PAGE_FLAG.size,
+                    len(raw),
+                    map_data['bucket_size'])]
+
+    def _page_match(self, map_data, pos, raw, h_key):
+        '''
+        Return the slot of h_key in a page or None, the page is searched for
+        the key before any slot is unpacked
+        '''
+        b_size = map_data['bucket_size']
+        ind = raw.find(h_key, PAGE_FLAG.size)
+        while ind != -1:
+            offset = ind - (ind - PAGE_FLAG.size) % b_size
+            slot = self._slot(map_data, raw, pos, offset)
+            if slot['key'] == h_key:
+                return slot
+            ind = raw.find(h_key, ind + 1)
+        return None
+
+    def _page_scan(self, map_data, pos, raw, h_key, pending=None, free=True):
+        '''
+        Return the slot of h_key in a page or None, and the first free slot
+        of the page or None if free is not set. Only the slots returned are
+        unpacked, free slots are all null bytes
+        '''
+        b_size = map_data['bucket_size']
+        claimed = {}
+        if pending:
+            for offset in range(PAGE_FLAG.size, len(raw), b_size):
+                ref = (map_data['fn'], pos + offset)
+                if ref in pending:
+                    if pending[ref]['key'] == h_key:
+                        return pending[ref], None
+                    claimed[offset] = pending[ref]
+        slot = self._page_match(map_data, pos, raw, h_key)
+        if slot is not None:
+            return slot, None
+        if not free:
+            return None, None
+        empty = b'\0' * b_size
+        for offset in range(PAGE_FLAG.size, len(raw), b_size):
+            if offset in claimed:
+                continue
+            if raw[offset:offset + b_size] == empty:
+                return None, self._slot(map_data, raw, pos, offset)
+        return None, None
+
+    def _find_slot(
+            self,
+            map_data,
+            h_key,
+            pending=None,
+            create=True,
+            page=None):
+        '''
+        Return the bucket of h_key in a growable map. Pages are read from
+        the home page, or page, for as long as their spill flag is set. A
+        missing key gets the first free slot, past the flagged pages if
+        needed, with the pages it spills past, unless create is False
+        '''
+        start = page
+        if self.shared and not create:
+            # Other processes may have split pages since the last read
+            map_data['lh'] = self._read_state(map_data)
+        while True:
+            state = map_data['lh']
+            page = start
+            if page is None:
+                page = self._home(map_data, state, h_key)
+            free = None
+            reads = 0
+            while True:
+                pos, raw, flag = self._read_page(map_data, page)
+                reads += 1
+                if create:
+                    slot, empty = self._page_scan(
+                            map_data,
+                            pos,
+                            raw,
+                            h_key,
+                            pending,
+                            free is None)
+                    if slot is not None:
+                        return slot
+                    free = free or empty
+                else:
+                    slot = self._page_match(map_data, pos, raw, h_key)
+                    if slot is not None:
+                        if self.meter is not None:
+                            self.meter.observe('page_reads', reads)
+                        return slot
+                if not flag:
+                    break
+                page += 1
+            if not create:
+                if (self.shared or self.threadsafe) and start is None:
+                    if self.shared:
+                        map_data['lh'] = self._read_state(map_data)
+                    if map_data['lh'][:2] != state[:2]:
+                        # Split while the pages were read
+                        continue
+                return {'key': h_key, 'prev': 0, 'pos': None}
+            spill = []
+            while free is None:
+                if not flag:
+                    spill.append(page)
+                page += 1
+                pos, raw, flag = self._read_page(map_data, page)
+                free = self._page_scan(map_data, pos, raw, h_key, pending)[1]
+            free['key'] = h_key
+            free['spill'] = spill
+            free['new'] = True
+            return free
+
+    def _write_bucket(self, map_data, h_data):
+        '''
+        Write a bucket entry, for growable maps the pages a new key spilled
+        past are flagged first. Returns 1 if a new key was added to a
+        growable map
+        '''
+        h_entry = struct.pack(
+                map_data['fmt'],
+                *[h_data[name] for name in map_data['entry_map']])
+        if not map_data.get('grow'):
+            self._write(map_data, h_data['pos'], h_entry)
+            return 0
+        for page in h_data.pop('spill', ()):
+            self._bkt_write(
+                    map_data,
+                    self._page_pos(map_data, page),
+                    PAGE_FLAG.pack(1))
+        self._bkt_write(map_data, h_data['pos'], h_entry)
+        return 1 if h_data.pop('new', False) else 0
+
+    def _grow(self, map_data, added, spare=0):
+        '''
+        Count the keys added to a growable map and split pages until the
+        load, with room for spare more keys, is below GROW_LOAD again. Maps
+        with no_split set are only counted, new keys spill past full pages
+        '''
+        if not added and not spare:
+            return
+        level, split, count = map_data['lh']
+        map_data['lh'] = (level, split, count + added)
+        while not map_data.get('no_split'):
+            level, split, count = map_data['lh']
+            buckets = (map_data['pages'] << level) + split
+            if count + spare <= GROW_LOAD * map_data['slots'] * buckets:
+                break
+            self._split(map_data)
+        self._bkt_write(map_data, 0, BKT_STATE.pack(*map_data['lh']))
+
+    def reserve(self, keys):
+        '''
+        Split the growable maps keys are stored in ahead of a batch insert,
+        the buckets of a batch are claimed before any of them is written so
+        the maps can not split while the batch is placed
+        '''
+        counts = {}
+        for key in keys:
+            hmdir = self._hm_dir(key)
+            counts[hmdir] = counts.get(hmdir, 0) + 1
+        for hmdir, num in counts.items():
+            fn_ = os.path.join(hmdir, 'midx_1')
+            if fn_ not in self.maps:
+                try:
+                    self.open_map(fn_)
+                except IOError:
+                    self.create_h_index(fn_)
+            map_data = self.maps[fn_]
+            if map_data.get('grow'):
+                self._grow(map_data, 0, num)
+
+    def _split(self, map_data):
+        '''
+        Split the next page of a growable map, the keys whose home moves
+        to the new page are written there before the state is advanced and
+        only then cleared from their old slots. Keys which spilled to the
+        new page or past it are already found from there and stay
+        '''
+        level, split, count = old = map_data['lh']
+        base = map_data['pages'] << level
+        if split + 1 < base:
+            new = (level, split + 1, count)
+        else:
+            new = (level + 1, 0, count)
+        moves = []
+        page = split
+        n_pos = self._page_pos(map_data, base + split)
+        while True:
+            pos, raw, flag = self._read_page(map_data, page)
+            for slot in self._page_slots(map_data, pos, raw):
+                if not slot['key']:
+                    continue
+                if self._home(map_data, old, slot['key']) != split:
+                    continue
+                if slot['pos'] >= n_pos:
+                    continue
+                if self._home(map_data, new, slot['key']) != split:
+                    moves.append(slot)
+            if not flag:
+                break
+            page += 1
+        for slot in moves:
+            h_data = self._find_slot(
+                    map_data,
+                    slot['key'],
+                    page=base + split)
+            h_data['prev'] = slot['prev']
+            for name in map_data['entry_map']:
+                if name not in ('key', 'prev'):
+                    h_data[name] = slot[name]
+            self._write_bucket(map_data, h_data)
+        map_data['lh'] = new
+        self._bkt_write(map_data, 0, BKT_STATE.pack(*new))
+        empty = b'\0' * map_data['bucket_size']
+        for slot in moves:
+            self._bkt_write(map_data, slot['pos'], empty)
+
+    def build_buckets(self, header, pairs):
+        '''
+        Write the bucket file of a growable map holding the (h_key, prev)
+        pairs, sized so that no split is needed to hold them. Used to
+        rebuild the buckets of a compacted map
+        '''
+        level = 0
+        while len(pairs) > GROW_LOAD * header['slots'] * (
+                header['pages'] << level):
+            level += 1
+        state = (level, 0, len(pairs))
+        pages = {}
+        flags = set()
+        for h_key, prev in pairs:
+            page = self._home(header, state, h_key)
+            while len(pages.setdefault(page, [])) >= header['slots']:
+                flags.add(page)
+                page += 1
+            pages[page].append((h_key, prev))
+        page_size = PAGE_FLAG.size + header['slots'] * header['bucket_size']
+        fn_ = self._bkt_fn(header)
+        with io.open(fn_, 'w+b') as fp_:
+            fp_.write(BKT_STATE.pack(*state))
+            for page in sorted(pages):
+                chunks = [PAGE_FLAG.pack(1 if page in flags else 0)]
+                for h_key, prev in pages[page]:
+                    vals = {'key': h_key, 'prev': prev}
+                    chunks.append(struct.pack(
+                        header['fmt'],
+                        *[vals[name] for name in header['entry_map']]))
+                fp_.seek(BKT_HEAD + page * page_size)
+                fp_.write(b''.join(chunks))
+            fp_.flush()
+            os.fsync(fp_.fileno())
+        return fn_
+
+    def hash_map_ref(self, key, pending=None, create=True):
+        '''
+        Return the hash map reference data, readers pass create=False so
+        that a missing map raises KeyError instead of being created
         '''
         hmdir = self._hm_dir(key)
+        digest = self._key_digest(key)
         f_num = 1
         while True:
             fn_ = os.path.join(hmdir, 'midx_{0}'.format(f_num))
-            h_entry, map_data = self._get_h_entry(key, fn_)
-            if not h_entry:
-                # This is a new key
-                break
-            if key == h_entry['key']:
-                # is the right key
+            if not create and self.bloom_fp:
+                has = self._bloom_has(fn_, digest[0])
+                if has is None:
+                    raise KeyError(key)
+                if not has:
+                    # Not in this map, its bucket is not read
+                    if self.meter is not None:
+                        self.meter.count('bloom_skips')
+                    f_num += 1
+                    continue
+            h_entry, match = self._get_h_entry(
+                    key,
+                    fn_,
+                    digest,
+                    pending,
+                    create)
+            if match is None:
+                raise KeyError(key)
+            if match:
+                # is the right key or a free bucket for a new key
                 break
             f_num += 1
+        if self.meter is not None:
+            self.meter.observe('probe_depth', f_num)
+        if self.manifest is not None:
+            self.hits[fn_] = self.hits.get(fn_, 0) + 1
         return h_entry, fn_
 
-    def _get_h_prev(self, prev, map_key):
+    def iter_buckets(self, map_key):
+        '''
+        Yield all of the populated bucket entries in the given map
+        '''
+        map_data = self.maps[map_key]
+        if map_data.get('grow'):
+            for slot in self._iter_slots(map_data):
+                yield slot
+            return
+        entry_map = map_data['entry_map']
+        prev_ind = entry_map.index('prev')
+        b_size = map_data['bucket_size']
+        step = b_size * SCAN_BUCKETS
+        for block in range(map_data['header_len'], map_data['b_end'], step):
+            raw = self._read(
+                    map_data,
+                    block,
+                    min(step, map_data['b_end'] - block))
+            for offset in range(0, len(raw) - b_size + 1, b_size):
+                comps = struct.unpack_from(map_data['fmt'], raw, offset)
+                if not comps[prev_ind]:
+                    continue
+                ret = {'pos': block + offset}
+                for ind in range(len(entry_map)):
+                    ret[entry_map[ind]] = comps[ind]
+                yield ret
+
+    def _iter_slots(self, map_data):
+        '''
+        Yield the populated slots of a growable map, slots left behind by a
+        split that has not cleared them yet are skipped
+        '''
+        state = map_data['lh']
+        fp_ = self.fd_cache.get(
+                self._bkt_fn(map_data),
+                self._open_bkt,
+                self._close_bkt)
+        n_pages = -(-(maras.utils.pio.size(fp_) - BKT_HEAD) //
+                    map_data['page_size'])
+        for page in range(n_pages):
+            pos, raw, flag = self._read_page(map_data, page)
+            for slot in self._page_slots(map_data, pos, raw):
+                if not slot['key'] or not slot['prev']:
+                    continue
+                if self._home(map_data, state, slot['key']) > page:
+                    continue
+                yield slot
+
+    def iter_prefix_maps(self, prefix=''):
+        '''
+        Yield the map files which can hold keys starting with prefix, one
+        hash map directory at a time in sorted order. Maps opened only for
+        the walk are released again once the caller moves on, unless other
+        threads may be using them
+        '''
+        prefix = prefix.lstrip(self.key_delim)
+        if self.key_delim in prefix:
+            top = os.path.join(
+                    self.db_root,
+                    prefix[:prefix.rfind(self.key_delim)].replace(
+                        self.key_delim, os.sep))
+        else:
+            top = self.db_root
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            nums = sorted(
+                    int(name[5:]) for name in files
+                    if name.startswith('midx_') and name[5:].isdigit())
+            for num in nums:
+                fn_ = os.path.join(root, 'midx_{0}'.format(num))
+                opened = fn_ not in self.maps
+                if opened:
+                    self.open_map(fn_)
+                yield fn_
+                if opened and fn_ in self.maps and not self.threadsafe:
+                    self.fd_cache.close(fn_)
+                    del self.maps[fn_]
+
+    def _get_h_prev(self, prev, map_key, key=None):
         '''
-        Get the index data from the given prev location
+        Get the index data from the given prev location. Pass the key of the
+        chain if it is known, else binary entries which do not hold the key
+        read it from the entry which does
         '''
         map_data = self.maps[map_key]
-        map_data['fp'].seek(prev)
-        i_len = struct.unpack('>H', map_data['fp'].read(2))
-        return msgpack.loads(map_data['fp'].read(i_len))
+        raw = self._read(map_data, prev, ENTRY_READ)
+        i_len = struct.unpack_from('>H', raw)[0]
+        if i_len + 2 > len(raw):
+            raw += self._read(
+                    map_data,
+                    prev + len(raw),
+                    i_len + 2 - len(raw))
+        entry = unpack_entry(raw, 0, key)
+        if entry['key'] is None:
+            key = self._get_h_prev(entry['kp'], map_key)['key']
+            entry = unpack_entry(raw, 0, key)
+        return entry
+
+    def _key_pos(self, map_data, h_data):
+        '''
+        Return the offset of the entry holding the key of the chain h_data
+        points at, 0 for a new chain or a map of msgpack entries. The offset
+        is kept in h_data for the following revisions of a batch
+        '''
+        prev = h_data.get('prev')
+        if not prev or not map_data.get('i_ver'):
+            return 0
+        if 'kp' not in h_data:
+            raw = self._read(map_data, prev, ENTRY_HEAD.size)
+            h_data['kp'] = ENTRY_HEAD.unpack_from(raw)[7] or prev
+        return h_data['kp']
+
+    def _ids_fn(self, fn_):
+        '''
+        Return the id index file name for the map file fn_
+        '''
+        dirname, basename = os.path.split(fn_)
+        return os.path.join(
+                dirname,
+                'ids_{0}'.format(basename[basename.rindex('_') + 1:]))
 
-    def get_h_index(self, key, id_=None):
+    def _open_ids(self, fn_):
         '''
-        Return the index value for the given key and id
+        Open an id index file
+        '''
+        try:
+            return io.open(fn_, 'r+b', self.buffering)
+        except IOError:
+            return io.open(fn_, 'w+b', self.buffering)
+
+    def _close_ids(self, fp_):
         '''
-        h_entry, map_key = self.hash_map_ref(key)
+        Close an id index file
+        '''
+        fp_.close()
+
+    def _sync_ids(self, fn_):
+        '''
+        Flush an id index file to disk
+        '''
+        fp_ = self.fd_cache.get(fn_, self._open_ids, self._close_ids)
+        fp_.flush()
+        os.fsync(fp_.fileno())
+
+    def _ids_ok(self, map_data):
+        '''
+        Return whether the id index of a map exists, maps opened without
+        knowing it look for the file on first use
+        '''
+        if map_data['ids_ok'] is None:
+            map_data['ids_ok'] = os.path.isfile(self._ids_fn(map_data['fn']))
+        return map_data['ids_ok']
+
+    def _load_ids(self, map_data):
+        '''
+        Return the id digest to index entry offset mapping for a map, the
+        ids file is read on first use and rebuilt if it is missing
+        '''
+        if map_data['ids'] is not None:
+            return map_data['ids']
+        with self.lock:
+            if map_data['ids'] is not None:
+                return map_data['ids']
+            if not self._ids_ok(map_data):
+                self.rebuild_ids(map_data['fn'])
+                return map_data['ids']
+            ids = {}
+            map_data['ids_len'] = 0
+            self._read_ids(map_data, ids)
+            map_data['ids'] = ids
+            return ids
+
+    def _read_ids(self, map_data, ids=None):
+        '''
+        Add the id records past the part of the id index already read to
+        ids, by default the loaded id index of the map
+        '''
+        if ids is None:
+            ids = map_data['ids']
+        fn_ = self._ids_fn(map_data['fn'])
+        with self.lock:
+            fp_ = self.fd_cache.get(fn_, self._open_ids, self._close_ids)
+            raw = maras.utils.pio.read_from(fp_, map_data['ids_len'])
+            rec_size = self.id_struct.size
+            for pos in range(0, len(raw) - rec_size + 1, rec_size):
+                id_key, i_pos = self.id_struct.unpack_from(raw, pos)
+                ids[id_key] = i_pos
+            map_data['ids_len'] += len(raw) - len(raw) % rec_size
+
+    def _add_ids(self, map_data, pairs):
+        '''
+        Append (id, index entry offset) pairs to the map's id index
+        '''
+        if not self._ids_ok(map_data):
+            self.rebuild_ids(map_data['fn'])
+        fn_ = self._ids_fn(map_data['fn'])
+        chunks = []
+        for id_, i_pos in pairs:
+            id_key = self.hash_func(id_).hexdigest()
+            chunks.append(self.id_struct.pack(id_key, i_pos))
+            if map_data['ids'] is not None:
+                map_data['ids'][id_key] = i_pos
+        data = b''.join(chunks)
+        fp_ = self.fd_cache.get(fn_, self._open_ids, self._close_ids)
+        maras.utils.pio.pwrite(fp_, data, maras.utils.pio.size(fp_))
+        self.syncer.dirty_index(fn_, len(data), self._sync_ids)
+
+    def rebuild_ids(self, map_key):
+        '''
+        Regenerate the id index of a map by walking every prev chain, the
+        new file is swapped in with a rename
+        '''
+        map_data = self.maps[map_key]
+        ids = {}
+        chunks = []
+        for h_entry in self.iter_buckets(map_key):
+            chain = []
+            prev = h_entry['prev']
+            key = None
+            while prev:
+                entry = self._get_h_prev(prev, map_key, key)
+                key = entry['key']
+                chain.append((self.hash_func(entry['id']).hexdigest(), prev))
+                prev = entry['p']
+            # Oldest first so that the newest entry for an id wins on load
+            for id_key, i_pos in reversed(chain):
+                chunks.append(self.id_struct.pack(id_key, i_pos))
+                ids[id_key] = i_pos
+        fn_ = self._ids_fn(map_key)
+        tmp_fn = '{0}.tmp'.format(fn_)
+        with io.open(tmp_fn, 'w+b') as fp_:
+            fp_.write(b''.join(chunks))
+            fp_.flush()
+            os.fsync(fp_.fileno())
+        self.fd_cache.close(fn_)
+        os.rename(tmp_fn, fn_)
+        map_data['ids'] = ids
+        map_data['ids_len'] = len(chunks) * self.id_struct.size
+        map_data['ids_ok'] = True
+        if self.manifest is not None:
+            self.manifest.ids_built(map_key)
+
+    def _blm_fn(self, fn_):
+        '''
+        Return the Bloom filter file name for the map file fn_
+        '''
+        dirname, basename = os.path.split(fn_)
+        return os.path.join(
+                dirname,
+                'blm_{0}'.format(basename[basename.rindex('_') + 1:]))
+
+    def _load_bloom(self, map_data):
+        '''
+        Return the Bloom filter of a map, the blm file is read on first use
+        and the keys appended past the tail it covers are added. A missing
+        file, or one written for an older generation of the map, is rebuilt
+        from all of the index entries
+        '''
+        if map_data['bloom'] is not None:
+            return map_data['bloom']
+        with self.lock:
+            if map_data['bloom'] is not None:
+                return map_data['bloom']
+            bloom = None
+            tail = map_data['b_end']
+            try:
+                with io.open(self._blm_fn(map_data['fn']), 'rb') as fp_:
+                    raw = fp_.read()
+                gen, f_tail = BLM_HEAD.unpack_from(raw)
+                if gen == map_data.get('gen', 0):
+                    bloom = maras.utils.bloom.Bloom.loads(raw[BLM_HEAD.size:])
+                    tail = max(f_tail, tail)
+            except (IOError, struct.error, ValueError):
+                pass
+            map_data['blm_dirty'] = bloom is None
+            if bloom is None:
+                bloom = maras.utils.bloom.Bloom(self.bloom_fp)
+            map_data['blm_tail'] = tail
+            self._bloom_catch_up(map_data, bloom)
+            # Only published once complete, other threads skip maps on it
+            map_data['bloom'] = bloom
+            return bloom
+
+    def _bloom_catch_up(self, map_data, bloom=None):
+        '''
+        Add the keys of the index entries appended to a map past the tail its
+        Bloom filter covers
+        '''
+        if bloom is None:
+            bloom = map_data['bloom']
+        pos = start = map_data['blm_tail']
+        end = self.snapshot(map_data['fn'], {})
+        while pos < end:
+            raw = self._read(map_data, pos, min(REPLAY_READ, end - pos))
+            offset = 0
+            while offset + 2 <= len(raw):
+                i_len = struct.unpack_from('>H', raw, offset)[0]
+                if not i_len or offset + 2 + i_len > len(raw):
+                    break
+                key = unpack_entry(raw, offset)['key']
+                # Later revisions of a key are covered by its first entry
+                if key is not None:
+                    bloom.add(self.hash_func(key).hexdigest())
+                offset += 2 + i_len
+            if not offset:
+                # The end of the entries, or one still being written
+                break
+            pos += offset
+        map_data['blm_tail'] = pos
+        if pos != start:
+            map_data['blm_dirty'] = True
+
+    def _bloom_has(self, fn_, h_key):
+        '''
+        Return False if the Bloom filter of the map fn_ does not hold the
+        bucket key digest h_key and None if there is no such map. Shared
+        readers add the keys other processes appended before trusting a miss
+        '''
+        if fn_ not in self.maps:
+            try:
+                self.open_map(fn_)
+            except IOError:
+                return None
+        map_data = self.maps[fn_]
+        bloom = self._load_bloom(map_data)
+        if h_key in bloom:
+            return True
+        if not self.shared:
+            return False
+        with self.lock:
+            self._bloom_catch_up(map_data)
+        return h_key in bloom
+
+    def _bloom_add(self, map_data, keys):
+        '''
+        Add keys to the Bloom filter of a map, called before their index
+        entries are appended so that a reader finding an entry also finds the
+        key in the filter
+        '''
+        if not self.bloom_fp:
+            return
+        bloom = self._load_bloom(map_data)
+        for key in keys:
+            if bloom.add(self.hash_func(key).hexdigest()):
+                map_data['blm_dirty'] = True
+
+    def _bloom_appended(self, map_data, pos, end):
+        '''
+        Move the tail the Bloom filter covers past entries appended from pos
+        to end, their keys were added by _bloom_add
+        '''
+        if map_data['bloom'] is not None and map_data['blm_tail'] == pos:
+            map_data['blm_tail'] = end
+
+    def _save_bloom(self, map_data):
+        '''
+        Write the Bloom filter of a map to its blm file if it changed. The map
+        is synced first so that the file never covers entries which did not
+        reach the disk
+        '''
+        if map_data['bloom'] is None or not map_data['blm_dirty']:
+            return
+        with self.lock:
+            self._bloom_catch_up(map_data)
+            self._sync_file(map_data['fn'])
+            fn_ = self._blm_fn(map_data['fn'])
+            # Processes sharing the map may save at the same time
+            tmp_fn = '{0}.{1}.tmp'.format(fn_, os.getpid())
+            with io.open(tmp_fn, 'w+b') as fp_:
+                fp_.write(BLM_HEAD.pack(
+                    map_data.get('gen', 0),
+                    map_data['blm_tail']))
+                fp_.write(map_data['bloom'].dumps())
+                fp_.flush()
+                os.fsync(fp_.fileno())
+            os.rename(tmp_fn, fn_)
+            map_data['blm_dirty'] = False
+
+    def latest(self, prev, map_key, limit=None):
+        '''
+        Return the newest index entry of the chain starting at prev which is
+        inside the snapshot limit, or None
+        '''
+        key = None
+        while prev:
+            entry = self._get_h_prev(prev, map_key, key)
+            if limit is None or prev < limit:
+                return entry
+            key = entry['key']
+            prev = entry['p']
+        return None
+
+    def get_h_index(self, key, id_=None, snap=None):
+        '''
+        Return the index value for the given key and id, snap bounds the
+        read to a snapshot, see snapshot
+        '''
+        h_entry, map_key = self.hash_map_ref(key, create=False)
+        limit = self.snapshot(map_key, snap)
+        if id_ and h_entry['prev']:
+            map_data = self.maps[map_key]
+            id_key = self.hash_func(id_).hexdigest()
+            ids = self._load_ids(map_data)
+            if id_key not in ids and self.shared:
+                self._read_ids(map_data)
+            i_pos = ids.get(id_key)
+            if i_pos and (limit is None or i_pos < limit):
+                entry = self._get_h_prev(i_pos, map_key)
+                if entry['id'] == id_ and entry['key'] == key:
+                    if self.meter is not None:
+                        self.meter.count('id_index_hits')
+                    return entry, map_key
+        # Fall back to walking the revisions, this covers ids written
+        # before a crash that did not make it into the id index
         prev = h_entry['prev']
+        hops = 0
         while True:
-            prev_i = self._get_h_prev(prev, map_key)
-            if id_:
-                if prev_i['id'] == id_:
-                    return prev_i, map_key
-                else:
-                    prev = prev_i['p']
-            else:
-                return prev_i, map_key
+            if not prev:
+                raise KeyError(key)
+            prev_i = self._get_h_prev(prev, map_key, key)
+            hops += 1
+            if limit is not None and prev >= limit:
+                prev = prev_i['p']
+                continue
+            if id_ and prev_i['id'] != id_:
+                prev = prev_i['p']
+                continue
+            if self.meter is not None:
+                self.meter.observe('chain_len', hops)
+            return prev_i, map_key
 
     def insert(
             self,
@@ -242,21 +1620,84 @@ class DHM(object):
         # 5. Construct hash table struct
         # 6. Write HT struct
         map_data = self.maps[map_key]
+        if not id_:
+            id_ = maras.utils.rand_hex_str(self.key_size)
         i_entry = self._i_entry(
+                map_data,
                 key,
                 id_,
                 start,
                 size,
                 type_,
                 h_data.get('prev', None),
+                self._key_pos(map_data, h_data),
                 **kwargs)
-        map_data['fp'].seek(0, 2)
-        i_pos = map_data['fp'].tell()
-        h_data['prev'] = i_pos
-        map_data['fp'].write(i_entry)
-        pack_args = []
-        for ind in range(len(map_data['entry_map'])):
-            pack_args.append(h_data[map_data['entry_map'][ind]])
-        h_entry = struct.pack(map_data['fmt'], *pack_args)
-        map_data['fp'].seek(h_data['pos'])
-        map_data['fp'].write(h_entry)
+        self._bloom_add(map_data, [key])
+        h_data['prev'] = self._append(map_data, i_entry)
+        self._bloom_appended(
+                map_data,
+                h_data['prev'],
+                h_data['prev'] + len(i_entry))
+        self._add_ids(map_data, [(id_, h_data['prev'])])
+        self._grow(map_data, self._write_bucket(map_data, h_data))
+
+    def insert_many(self, map_key, entries, **kwargs):
+        '''
+        Insert a batch of index entries into a single map file. entries is a
+        list of (key, id_, start, size, type_, h_data) tuples in insert order,
+        h_data dicts are shared between revisions of the same key so each
+        entry chains onto the one before it. All index entries are written
+        with a single append and the touched buckets are then written in
+        offset order. kwargs are added to every index entry
+        '''
+        map_data = self.maps[map_key]
+        base = self._tail(map_data)
+        chunks = []
+        offset = 0
+        buckets = {}
+        ids = []
+        for key, id_, start, size, type_, h_data in entries:
+            if not id_:
+                id_ = maras.utils.rand_hex_str(self.key_size)
+            key_pos = self._key_pos(map_data, h_data)
+            i_entry = self._i_entry(
+                    map_data,
+                    key,
+                    id_,
+                    start,
+                    size,
+                    type_,
+                    h_data.get('prev', None),
+                    key_pos,
+                    **kwargs)
+            if not key_pos and map_data.get('i_ver'):
+                h_data['kp'] = base + offset
+            h_data['prev'] = base + offset
+            ids.append((id_, h_data['prev']))
+            offset += len(i_entry)
+            chunks.append(i_entry)
+            buckets[h_data['pos']] = h_data
+        self._bloom_add(map_data, [entry[0] for entry in entries])
+        self._append(map_data, b''.join(chunks))
+        self._bloom_appended(map_data, base, base + offset)
+        self._add_ids(map_data, ids)
+        added = 0
+        for pos in sorted(buckets):
+            added += self._write_bucket(map_data, buckets[pos])
+        self._grow(map_data, added)
+
+    def close(self):
+        '''
+        Close all of the open map files
+        '''
+        for fn_, map_data in self.maps.items():
+            self._save_bloom(map_data)
+            self.fd_cache.close(fn_)
+            self.fd_cache.close(self._ids_fn(fn_))
+            if map_data.get('grow'):
+                self.fd_cache.close(self._bkt_fn(map_data))
+            if self.use_mmap and not self.shared:
+                # Drop the unused growth chunk so the file ends at the tail
+                with io.open(fn_, 'r+b') as fp_:
+                    fp_.truncate(map_data['tail'])
+        self.maps = {}
@@ -0,0 +1,424 @@
+'''
+An ordered key index made of sorted runs
+'''
+# Layout, under <db_root>/ordered_<name>/:
+#   log    - length prefixed keys added since the last flush
+#   run_N  - immutable sorted run, pages of sorted keys followed by a page
+#            table and the 8 byte offset of the page table
+# New keys go to the log and an in memory table, once the table holds
+# flush_keys keys it is written out as a new run. Once there are more than
+# max_runs runs they are merged into one. Ranges hold the runs they read, a
+# run replaced by a merge is closed and its pages dropped from the page
+# cache once the last range reading it is done.
+# When shared between processes writers hold the exclusive lock of the
+# index directory and readers the shared one. Every flush or merge changes
+# the set of runs, so a changed set means the log was emptied and must be
+# replayed from the start, otherwise only the new end of the log is read.
+
+# Import python libs
+import os
+import io
+import heapq
+import struct
+import bisect
+import threading
+
+# Import maras libs
+import maras.utils
+import maras.utils.cache
+import maras.utils.pio
+import maras.utils.sync
+
+# Import third party libs
+import msgpack
+
+LEN_FMT = '>I'
+LEN_SIZE = struct.calcsize(LEN_FMT)
+FOOT_FMT = '>Q'
+FOOT_SIZE = struct.calcsize(FOOT_FMT)
+
+
+def unique(keys):
+    '''
+    Drop repeated keys from a sorted iterator
+    '''
+    last = None
+    first = True
+    for key in keys:
+        if first or key != last:
+            yield key
+        first = False
+        last = key
+
+
+class Run(object):
+    '''
+    An immutable sorted run file
+    '''
+    def __init__(self, fn_, page_cache):
+        self.fn_ = fn_
+        self.page_cache = page_cache
+        # The handle stays open so the run can still be read after a merge
+        # has removed the file
+        self.fp_ = io.open(fn_, 'rb')
+        # Ranges reading the run, and whether it has left the index
+        self.readers = 0
+        self.retired = False
+        self.fp_.seek(-FOOT_SIZE, 2)
+        t_pos = struct.unpack(FOOT_FMT, self.fp_.read(FOOT_SIZE))[0]
+        self.fp_.seek(t_pos)
+        raw = self.fp_.read()[:-FOOT_SIZE]
+        # Each page table entry is [first_key, offset, size]
+        self.table = msgpack.loads(raw)
+        self.firsts = [page[0] for page in self.table]
+
+    @classmethod
+    def write(cls, fn_, keys, page_size, page_cache):
+        '''
+        Write the sorted keys out as a new run and return it, the file is
+        written under a temporary name and renamed into place
+        '''
+        tmp_fn = '{0}.tmp'.format(fn_)
+        table = []
+        with io.open(tmp_fn, 'w+b') as fp_:
+            page = []
+            p_size = 0
+            for key in keys:
+                page.append(key)
+                p_size += len(key) + 2
+                if p_size >= page_size:
+                    cls._write_page(fp_, page, table)
+                    page = []
+                    p_size = 0
+            if page:
+                cls._write_page(fp_, page, table)
+            t_pos = fp_.tell()
+            fp_.write(msgpack.dumps(table))
+            fp_.write(struct.pack(FOOT_FMT, t_pos))
+            fp_.flush()
+            os.fsync(fp_.fileno())
+        os.rename(tmp_fn, fn_)
+        return cls(fn_, page_cache)
+
+    @staticmethod
+    def _write_page(fp_, page, table):
+        '''
+        Write a page of keys and add it to the page table
+        '''
+        raw = msgpack.dumps(page)
+        table.append([page[0], fp_.tell(), len(raw)])
+        fp_.write(raw)
+
+    def page(self, num):
+        '''
+        Return the decoded keys of a page, pages are served from the shared
+        page cache when possible
+        '''
+        keys = self.page_cache.get(self.fn_, num)
+        if keys is not None:
+            return keys
+        first, offset, size = self.table[num]
+        keys = msgpack.loads(maras.utils.pio.pread(self.fp_, size, offset))
+        self.page_cache.set(self.fn_, num, keys, size)
+        return keys
+
+    def iter_from(self, start=None):
+        '''
+        Yield the keys of the run in order starting at start
+        '''
+        if not self.table:
+            return
+        num = 0
+        if start is not None:
+            num = max(bisect.bisect_right(self.firsts, start) - 1, 0)
+        while num < len(self.table):
+            keys = self.page(num)
+            ind = 0
+            if start is not None:
+                ind = bisect.bisect_left(keys, start)
+            for key in keys[ind:]:
+                yield key
+            num += 1
+
+    def release(self):
+        '''
+        Called when a range is done reading the run
+        '''
+        self.readers -= 1
+        if self.retired and not self.readers:
+            self.close()
+
+    def retire(self):
+        '''
+        Close the run once no range reads it, the run has been replaced
+        '''
+        self.retired = True
+        if not self.readers:
+            self.close()
+
+    def close(self):
+        '''
+        Close the run file and drop its pages from the page cache
+        '''
+        self.fp_.close()
+        self.page_cache.invalidate(self.fn_)
+
+
+class OrderedIndex(object):
+    '''
+    Keep every key of the database in sorted order to serve range queries
+    '''
+    def __init__(
+            self,
+            db_root,
+            name,
+            flush_keys=65536,
+            max_runs=4,
+            page_size=4096,
+            page_cache_bytes=4 * 1024 * 1024,
+            syncer=None,
+            locks=None,
+            **kwargs):
+        self.path = os.path.join(db_root, 'ordered_{0}'.format(name))
+        self.flush_keys = flush_keys
+        self.max_runs = max_runs
+        self.page_size = page_size
+        self.page_cache = maras.utils.cache.RecordCache(page_cache_bytes)
+        if syncer is None:
+            syncer = maras.utils.sync.Syncer()
+        self.syncer = syncer
+        # Shard locks when shared between processes, the thread lock guards
+        # the memory table and the run list
+        self.locks = locks
+        self.lock = threading.RLock()
+        # The memory table, a set for membership and a sorted list for
+        # range reads
+        self.mem = set()
+        self.mem_keys = []
+        self.runs = []
+        self.log_fn = os.path.join(self.path, 'log')
+        # Bytes of the log replayed into the memory table
+        self.log_pos = 0
+        self.new = not os.path.isdir(self.path)
+        if self.new:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        self._load()
+        self.log = io.open(self.log_fn, 'a+b', 0 if locks else -1)
+
+    def _run_fns(self):
+        '''
+        Return the file names of the runs on disk, oldest first
+        '''
+        nums = sorted(
+                int(name[4:]) for name in os.listdir(self.path)
+                if name.startswith('run_') and name[4:].isdigit())
+        return [os.path.join(self.path, 'run_{0}'.format(num))
+                for num in nums]
+
+    def _load(self):
+        '''
+        Open the existing runs and replay the log into the memory table
+        '''
+        for fn_ in self._run_fns():
+            self.runs.append(Run(fn_, self.page_cache))
+        self._replay()
+
+    def _replay(self):
+        '''
+        Add the keys in the log past log_pos to the memory table
+        '''
+        if not os.path.isfile(self.log_fn):
+            return
+        with io.open(self.log_fn, 'rb') as fp_:
+            fp_.seek(self.log_pos)
+            raw = fp_.read()
+        pos = 0
+        keys = []
+        while pos + LEN_SIZE <= len(raw):
+            k_len = struct.unpack_from(LEN_FMT, raw, pos)[0]
+            if pos + LEN_SIZE + k_len > len(raw):
+                # Torn write at the end of the log
+                break
+            keys.append(maras.utils.to_str(
+                raw[pos + LEN_SIZE:pos + LEN_SIZE + k_len]))
+            pos += LEN_SIZE + k_len
+        self.log_pos += pos
+        if not keys:
+            return
+        self.mem.update(keys)
+        self.mem_keys = sorted(self.mem)
+
+    def refresh(self):
+        '''
+        Pick up the keys and runs written by other processes, called with
+        the index directory locked
+        '''
+        fns = self._run_fns()
+        if fns != [run.fn_ for run in self.runs]:
+            old = dict((run.fn_, run) for run in self.runs)
+            self.runs = [old.pop(fn_, None) or Run(fn_, self.page_cache)
+                         for fn_ in fns]
+            # Merged away by another process
+            for run in old.values():
+                run.retire()
+            self.mem = set()
+            self.mem_keys = []
+            self.log_pos = 0
+        self._replay()
+
+    def _next_run_fn(self):
+        '''
+        Return the file name for the next run
+        '''
+        num = 1
+        if self.runs:
+            last = self.runs[-1].fn_
+            num = int(last[last.rindex('_') + 1:]) + 1
+        return os.path.join(self.path, 'run_{0}'.format(num))
+
+    def _sync_log(self, fn_):
+        '''
+        Flush the log to disk
+        '''
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def insert_keys(self, keys):
+        '''
+        Add keys to the index
+        '''
+        with self.lock:
+            if self.locks is None or not self.locks.processes:
+                return self._insert_keys(keys)
+            keys = list(keys)
+            with self.locks.write([self.path]):
+                self.refresh()
+                self._insert_keys(keys)
+
+    def _insert_keys(self, keys):
+        '''
+        Add keys to the memory table and the log
+        '''
+        chunks = []
+        for key in keys:
+            if key in self.mem:
+                continue
+            self.mem.add(key)
+            bisect.insort(self.mem_keys, key)
+            raw = maras.utils.to_bytes(key)
+            chunks.append(struct.pack(LEN_FMT, len(raw)))
+            chunks.append(raw)
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self.log.write(data)
+        self.log_pos += len(data)
+        self.syncer.dirty_index(self.log_fn, len(data), self._sync_log)
+        if len(self.mem) >= self.flush_keys:
+            self.flush()
+
+    def insert(self, key, data, id_, ind_ref):
+        '''
+        Called by the database for every inserted record
+        '''
+        self.insert_keys([key])
+
+    def insert_many(self, items):
+        '''
+        Called by the database with the (key, data, id_, ind_ref) items of a
+        batch insert
+        '''
+        self.insert_keys([item[0] for item in items])
+
+    def flush(self):
+        '''
+        Write the memory table out as a new sorted run and empty the log
+        '''
+        with self.lock:
+            if not self.mem:
+                return
+            self.runs.append(
+                    Run.write(
+                        self._next_run_fn(),
+                        self.mem_keys,
+                        self.page_size,
+                        self.page_cache))
+            self.mem = set()
+            self.mem_keys = []
+            self.log_pos = 0
+            self.log.seek(0)
+            self.log.truncate()
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            if len(self.runs) > self.max_runs:
+                self.merge()
+
+    def merge(self):
+        '''
+        Merge all runs into a single run
+        '''
+        old = self.runs
+        merged = Run.write(
+                self._next_run_fn(),
+                unique(heapq.merge(*[run.iter_from() for run in old])),
+                self.page_size,
+                self.page_cache)
+        self.runs = [merged]
+        # Open handles keep the old runs readable for ranges in progress
+        for run in old:
+            os.remove(run.fn_)
+            run.retire()
+
+    def range(self, start=None, end=None, limit=None):
+        '''
+        Yield keys in sorted order from start, inclusive, to end, exclusive
+        '''
+        with self.lock:
+            if self.locks is not None and self.locks.processes:
+                with self.locks.read([self.path]):
+                    self.refresh()
+            ind = 0
+            if start is not None:
+                ind = bisect.bisect_left(self.mem_keys, start)
+            # Copied so that inserts made while the range is read do not
+            # shift the keys under it
+            sources = [self.mem_keys[ind:]]
+            runs = list(self.runs)
+            for run in runs:
+                run.readers += 1
+                sources.append(run.iter_from(start))
+        count = 0
+        try:
+            for key in unique(heapq.merge(*sources)):
+                if end is not None and key >= end:
+                    return
+                if limit is not None and count >= limit:
+                    return
+                yield key
+                count += 1
+        finally:
+            with self.lock:
+                for run in runs:
+                    run.release()
+
+    def stats(self):
+        '''
+        Return the run count and page cache counters
+        '''
+        return {
+                'runs': len(self.runs),
+                'mem_keys': len(self.mem),
+                'page_cache': self.page_cache.stats(),
+                }
+
+    def close(self):
+        '''
+        Close the log and the runs
+        '''
+        self.log.close()
+        for run in self.runs:
+            run.close()
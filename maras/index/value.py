@@ -0,0 +1,295 @@
+'''
+An equality index on a field, or a derived value, of the stored records
+'''
+# Layout, under <db_root>/value_<name>/:
+#   log - length prefixed [key, values] records, the newest record of a key
+#         holds the values it is indexed under, [key] drops the key
+# The log is replayed into a value to keys table and a key to values table
+# when the index is opened. Once the log holds more superseded records than
+# live ones it is rewritten with only the live records and renamed into
+# place, compaction of the database rewrites it as well.
+# When shared between processes writers hold the exclusive lock of the
+# index directory and readers the shared one. A rewrite replaces the log
+# file, so a changed inode means the tables are rebuilt from the new log,
+# otherwise only the new end of the log is read.
+
+# Import python libs
+import os
+import io
+import struct
+import threading
+
+# Import maras libs
+import maras.utils.pio
+import maras.utils.sync
+
+# Import third party libs
+import msgpack
+
+LEN_FMT = '>I'
+LEN_SIZE = struct.calcsize(LEN_FMT)
+# Superseded log records tolerated before the log is rewritten
+MIN_DEAD = 65536
+
+
+def field_getter(field):
+    '''
+    Return a function extracting field from a record, a dotted field name
+    reaches into nested dicts
+    '''
+    path = field.split('.')
+
+    def getter(data):
+        for part in path:
+            if not isinstance(data, dict) or part not in data:
+                return None
+            data = data[part]
+        return data
+    return getter
+
+
+class ValueIndex(object):
+    '''
+    Map the values of a field, or the values returned by an extractor
+    function, to the keys of the records holding them. A record whose value
+    is a list is found under each of its items, records without the field,
+    or for which extract returns None, are not indexed
+    '''
+    def __init__(
+            self,
+            db_root,
+            name,
+            field=None,
+            extract=None,
+            syncer=None,
+            locks=None,
+            **kwargs):
+        if (field is None) == (extract is None):
+            raise ValueError('Pass either field or extract')
+        self.name = name
+        self.path = os.path.join(db_root, 'value_{0}'.format(name))
+        self.extract = extract or field_getter(field)
+        if syncer is None:
+            syncer = maras.utils.sync.Syncer()
+        self.syncer = syncer
+        # Shard locks when shared between processes, the thread lock guards
+        # the tables
+        self.locks = locks
+        self.lock = threading.RLock()
+        self.log_fn = os.path.join(self.path, 'log')
+        self.new = not os.path.isdir(self.path)
+        if self.new:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        self.log = None
+        self._open_log()
+
+    def _open_log(self):
+        '''
+        Open the log and replay it into empty tables
+        '''
+        if self.log is not None:
+            self.log.close()
+        self.log = io.open(self.log_fn, 'a+b', 0 if self.locks else -1)
+        self.log_ino = os.fstat(self.log.fileno()).st_ino
+        self.log_pos = 0
+        # value -> set of keys and key -> values
+        self.fwd = {}
+        self.rev = {}
+        self.dead = 0
+        self._replay()
+
+    def _replay(self):
+        '''
+        Apply the records in the log past log_pos to the tables
+        '''
+        raw = maras.utils.pio.read_from(self.log, self.log_pos)
+        pos = 0
+        while pos + LEN_SIZE <= len(raw):
+            r_len = struct.unpack_from(LEN_FMT, raw, pos)[0]
+            if pos + LEN_SIZE + r_len > len(raw):
+                # Torn write at the end of the log
+                break
+            rec = msgpack.loads(raw[pos + LEN_SIZE:pos + LEN_SIZE + r_len])
+            self._apply(rec[0], rec[1] if len(rec) > 1 else ())
+            pos += LEN_SIZE + r_len
+        self.log_pos += pos
+
+    def _apply(self, key, values):
+        '''
+        Index key under values in the tables, replacing its old values
+        '''
+        old = self.rev.pop(key, None)
+        if old is not None:
+            self.dead += 1
+            for value in old:
+                keys = self.fwd.get(value)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self.fwd[value]
+        if not values:
+            if old is not None:
+                # The drop record itself is superseded as well
+                self.dead += 1
+            return
+        self.rev[key] = tuple(values)
+        for value in values:
+            self.fwd.setdefault(value, set()).add(key)
+
+    def values(self, data):
+        '''
+        Return the values a record is indexed under, streamed records are
+        passed as None and are not indexed
+        '''
+        if data is None:
+            return ()
+        value = self.extract(data)
+        if value is None:
+            return ()
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        ret = []
+        for item in value:
+            if item is None or isinstance(item, (dict, list, tuple)):
+                continue
+            if item not in ret:
+                ret.append(item)
+        return ret
+
+    def refresh(self):
+        '''
+        Pick up the records written by other processes, called with the
+        index directory locked
+        '''
+        try:
+            ino = os.stat(self.log_fn).st_ino
+        except OSError:
+            ino = None
+        if ino != self.log_ino:
+            self._open_log()
+        else:
+            self._replay()
+
+    def _sync_log(self, fn_):
+        '''
+        Flush the log to disk
+        '''
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def insert_pairs(self, pairs):
+        '''
+        Index the (key, data) pairs, in insert order
+        '''
+        with self.lock:
+            if self.locks is None or not self.locks.processes:
+                return self._insert_pairs(pairs)
+            pairs = list(pairs)
+            with self.locks.write([self.path]):
+                self.refresh()
+                self._insert_pairs(pairs)
+
+    def _insert_pairs(self, pairs):
+        '''
+        Apply the pairs whose values changed to the tables and the log
+        '''
+        chunks = []
+        for key, data in pairs:
+            values = self.values(data)
+            if tuple(values) == self.rev.get(key, ()):
+                continue
+            if values:
+                raw = msgpack.dumps([key, values])
+            else:
+                raw = msgpack.dumps([key])
+            chunks.append(struct.pack(LEN_FMT, len(raw)))
+            chunks.append(raw)
+            self._apply(key, values)
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self.log.write(data)
+        self.log_pos += len(data)
+        self.syncer.dirty_index(self.log_fn, len(data), self._sync_log)
+        if self.dead > MIN_DEAD and self.dead > len(self.rev):
+            self._rewrite()
+
+    def insert(self, key, data, id_, ind_ref):
+        '''
+        Called by the database for every inserted record
+        '''
+        self.insert_pairs([(key, data)])
+
+    def insert_many(self, items):
+        '''
+        Called by the database with the (key, data, id_, ind_ref) items of a
+        batch insert
+        '''
+        self.insert_pairs((item[0], item[1]) for item in items)
+
+    def _rewrite(self):
+        '''
+        Replace the log with one holding only the live records
+        '''
+        tmp_fn = '{0}.tmp'.format(self.log_fn)
+        with io.open(tmp_fn, 'w+b') as fp_:
+            chunks = []
+            for key, values in self.rev.items():
+                raw = msgpack.dumps([key, list(values)])
+                chunks.append(struct.pack(LEN_FMT, len(raw)))
+                chunks.append(raw)
+            fp_.write(b''.join(chunks))
+            fp_.flush()
+            os.fsync(fp_.fileno())
+        os.rename(tmp_fn, self.log_fn)
+        self._open_log()
+
+    def compact(self):
+        '''
+        Rewrite the log, returns the bytes it held before and after
+        '''
+        with self.lock:
+            if self.locks is not None and self.locks.processes:
+                with self.locks.write([self.path]):
+                    self.refresh()
+                    before = self.log_pos
+                    self._rewrite()
+            else:
+                before = self.log_pos
+                self._rewrite()
+            return {
+                    'index': self.name,
+                    'bytes_before': before,
+                    'bytes_after': self.log_pos,
+                    }
+
+    def find(self, value):
+        '''
+        Return the sorted keys of the records indexed under value
+        '''
+        with self.lock:
+            if self.locks is not None and self.locks.processes:
+                with self.locks.read([self.path]):
+                    self.refresh()
+            return sorted(self.fwd.get(value, ()))
+
+    def stats(self):
+        '''
+        Return the number of values, keys and superseded log records
+        '''
+        return {
+                'values': len(self.fwd),
+                'keys': len(self.rev),
+                'dead': self.dead,
+                }
+
+    def close(self):
+        '''
+        Close the log
+        '''
+        self.log.close()
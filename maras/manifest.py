@@ -0,0 +1,374 @@
+'''
+A persisted list of the hash map files of a database and their headers
+'''
+# The manifest is a log at the database root, maras_manifest, of records
+# holding a kind, a map file path relative to the root and data:
+#   MAP    - the map exists, the data is its msgpack header or empty if the
+#            header has not been read yet, the header may be preceded by
+#            the FILES state of the map's files
+#   GONE   - the map was removed
+#   OPENED - a process opened the database
+#   CLOSED - the database was closed cleanly
+#   HOT    - the msgpack map of map paths to their decayed lookup counts
+# Maps are recorded once they are in place, so when the log ends with a
+# CLOSED record it lists every map and lookups of maps it does not list can
+# skip the file system. Otherwise the tree is walked once when the database
+# is opened and the listed headers, which may predate a map that was
+# replaced, are read again from the maps. The OPENED record is fsynced
+# before any map is touched, so a log cut short by a crash never ends with
+# the CLOSED record of the session before, and the records of added and
+# replaced maps are fsynced unless the database syncs nothing. Processes
+# sharing the database append to the log as well but never mark it closed,
+# and only use it for the headers of the maps it lists. Headers are stored
+# without their dir and num, which are taken from the map path, so the maps
+# of a database mostly share a few distinct headers and each of them is
+# only decoded once. The FILES state records whether the id index of a map
+# exists and the size of the map file, so opening a listed map does not
+# look at its files either. Like the headers it is only trusted when the
+# log was closed cleanly.
+
+# Import python libs
+import io
+import os
+import re
+import struct
+import threading
+
+# Import maras libs
+import maras.utils
+
+# Import third party libs
+import msgpack
+
+NAME = 'maras_manifest'
+REC = struct.Struct('>BHI')
+MAP = 1
+GONE = 2
+OPENED = 3
+CLOSED = 4
+HOT = 5
+# The state of a map's files, whether the id index exists and the map file
+# size or 0 if unknown, follows a mark which can not start a msgpack header
+FILES = struct.Struct('>?Q')
+FILES_MARK = b'\x00'
+MIDX_RE = re.compile(r'^midx_\d+$')
+# Bytes read at a time when prefetching without posix_fadvise
+WARM_READ = 1024 * 1024
+
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+
+class Manifest(object):
+    '''
+    The map files of a database with their headers and lookup counts
+    '''
+    def __init__(self, db_root, shared=False, sync=True):
+        self.db_root = db_root
+        self.fn = os.path.join(db_root, NAME)
+        self.shared = shared
+        # fsync the records of added and replaced maps
+        self.sync = sync
+        self.lock = threading.Lock()
+        # Map file name to its raw msgpack header or b''
+        self.maps = {}
+        # Raw msgpack header to its decoded form
+        self.decoded = {}
+        # Map file name to whether its id index exists and its size
+        self.files = {}
+        self.hot = {}
+        # True when every map of the database is listed
+        self.complete = False
+        self.records = 0
+        self.fp_ = None
+
+    def _rel(self, fn_):
+        '''
+        Return the path of a map relative to the database root
+        '''
+        return os.path.relpath(fn_, self.db_root)
+
+    def _pack(self, kind, fn_=None, data=b''):
+        '''
+        Return a log record
+        '''
+        path = maras.utils.to_bytes(self._rel(fn_)) if fn_ else b''
+        return b''.join([REC.pack(kind, len(path), len(data)), path, data])
+
+    def _append(self, data, sync=False):
+        '''
+        Append records to the log, fsync it if sync is set
+        '''
+        with self.lock:
+            self.fp_.write(data)
+            self.records += 1
+            if sync:
+                os.fsync(self.fp_.fileno())
+
+    def create(self):
+        '''
+        Start the manifest of a new database
+        '''
+        self._walk()
+        self._write_log()
+        self.complete = not self.shared
+
+    def load(self):
+        '''
+        Read the log, the tree is walked if the database was not closed
+        cleanly
+        '''
+        try:
+            with io.open(self.fn, 'rb') as fp_:
+                raw = fp_.read()
+        except IOError:
+            raw = None
+        closed = False
+        pos = 0
+        while raw and pos + REC.size <= len(raw):
+            kind, p_len, d_len = REC.unpack_from(raw, pos)
+            end = pos + REC.size + p_len + d_len
+            if end > len(raw):
+                # Torn write at the end of the log
+                break
+            start = pos + REC.size
+            path = maras.utils.to_str(raw[start:start + p_len])
+            data = raw[start + p_len:end]
+            fn_ = os.path.join(self.db_root, path)
+            if kind == MAP:
+                if data[:1] == FILES_MARK:
+                    self.files[fn_] = FILES.unpack_from(data, 1)
+                    data = data[1 + FILES.size:]
+                else:
+                    self.files.pop(fn_, None)
+                self.maps[fn_] = data
+            elif kind == GONE:
+                self.maps.pop(fn_, None)
+                self.files.pop(fn_, None)
+            elif kind == HOT:
+                self.hot = dict(
+                        (os.path.join(self.db_root, rel), count)
+                        for rel, count in msgpack.loads(data).items())
+            closed = kind == CLOSED
+            self.records += 1
+            pos = end
+        if self.shared:
+            # Other processes may be adding maps, only the listed headers
+            # are used
+            if raw is None:
+                self._walk()
+                self._write_log()
+            else:
+                self._open_log()
+                self._append(self._pack(OPENED), True)
+            return
+        if raw is None or not closed:
+            # The records of the last session may be lost or out of date
+            self.maps = dict.fromkeys(self.maps, b'')
+            self.files = {}
+            self._walk()
+            self._write_log()
+        else:
+            self._open_log()
+            self._append(self._pack(OPENED), True)
+        self.complete = True
+
+    def _walk(self):
+        '''
+        Bring the listed maps in line with the map files in the tree
+        '''
+        found = set()
+        for root, dirs, files in os.walk(self.db_root):
+            for name in files:
+                if MIDX_RE.match(name):
+                    found.add(os.path.join(root, name))
+        for fn_ in list(self.maps):
+            if fn_ not in found:
+                del self.maps[fn_]
+                self.files.pop(fn_, None)
+        for fn_ in found:
+            self.maps.setdefault(fn_, b'')
+
+    def _open_log(self):
+        '''
+        Open the log for appending
+        '''
+        self.fp_ = io.open(self.fn, 'ab', 0)
+
+    def _write_log(self, closed=False):
+        '''
+        Replace the log with one holding only the current state
+        '''
+        chunks = []
+        for fn_ in self.maps:
+            chunks.append(self._pack(MAP, fn_, self._map_data(fn_)))
+        if self.hot:
+            chunks.append(self._pack(HOT, None, msgpack.dumps(dict(
+                (self._rel(fn_), count)
+                for fn_, count in self.hot.items()))))
+        chunks.append(self._pack(CLOSED if closed else OPENED))
+        tmp_fn = '{0}.{1}.tmp'.format(self.fn, os.getpid())
+        with io.open(tmp_fn, 'w+b') as fp_:
+            fp_.write(b''.join(chunks))
+            fp_.flush()
+            os.fsync(fp_.fileno())
+        if self.fp_ is not None:
+            self.fp_.close()
+        os.rename(tmp_fn, self.fn)
+        self.records = len(chunks)
+        self._open_log()
+
+    def header(self, fn_):
+        '''
+        Return a copy of the header of a listed map, or None
+        '''
+        raw = self.maps.get(fn_)
+        if not raw:
+            return None
+        if raw not in self.decoded:
+            self.decoded[raw] = msgpack.loads(raw)
+        header = dict(self.decoded[raw])
+        dirname, basename = os.path.split(fn_)
+        header['dir'] = dirname
+        header['num'] = int(basename[basename.rindex('_') + 1:])
+        return header
+
+    def file_state(self, fn_):
+        '''
+        Return whether the id index of a listed map exists and the size of
+        the map file, None for either if it is not known
+        '''
+        ids_ok, size = self.files.get(fn_, (None, 0))
+        return ids_ok, size or None
+
+    def _map_data(self, fn_):
+        '''
+        Return the data of the MAP record of a map
+        '''
+        raw = self.maps[fn_]
+        if not raw or fn_ not in self.files:
+            return raw
+        ids_ok, size = self.files[fn_]
+        return FILES_MARK + FILES.pack(ids_ok, size) + raw
+
+    def exists(self, fn_):
+        '''
+        Return whether a map exists, or None if only the file system knows
+        '''
+        if not self.complete:
+            return None
+        return fn_ in self.maps
+
+    def add(self, fn_, header, ids_ok=None, size=None):
+        '''
+        Record a map which is in place and its header, and if known
+        whether its id index exists and the size of the map file
+        '''
+        header = dict(header)
+        header.pop('dir', None)
+        header.pop('num', None)
+        raw = msgpack.dumps(header)
+        self.maps[fn_] = raw
+        if ids_ok is None:
+            self.files.pop(fn_, None)
+        else:
+            self.files[fn_] = (ids_ok, size or 0)
+        self._append(self._pack(MAP, fn_, self._map_data(fn_)), self.sync)
+
+    def ids_built(self, fn_):
+        '''
+        Record that the id index of a listed map has been written
+        '''
+        if not self.maps.get(fn_):
+            return
+        size = self.files.get(fn_, (None, 0))[1]
+        self.files[fn_] = (True, size)
+        self._append(self._pack(MAP, fn_, self._map_data(fn_)), self.sync)
+
+    def drop(self, fn_):
+        '''
+        Forget the header of a map which is about to be replaced
+        '''
+        self.maps[fn_] = b''
+        self.files.pop(fn_, None)
+        self._append(self._pack(MAP, fn_), self.sync)
+
+    def hottest(self):
+        '''
+        Return the listed maps by their lookup counts, the hottest first
+        '''
+        return sorted(
+                (fn_ for fn_ in self.hot if fn_ in self.maps),
+                key=lambda fn_: -self.hot[fn_])
+
+    def map_files(self, fn_):
+        '''
+        Return the files of a map, the bucket and id files first
+        '''
+        dirname, basename = os.path.split(fn_)
+        num = basename[basename.rindex('_') + 1:]
+        names = []
+        header = self.header(fn_) or {}
+        if header.get('grow'):
+            name = 'bkt_{0}'.format(num)
+            if header.get('gen'):
+                name = '{0}.{1}'.format(name, header['gen'])
+            names.append(name)
+        names.extend(['ids_{0}'.format(num), 'blm_{0}'.format(num), basename])
+        return [os.path.join(dirname, name) for name in names]
+
+    def warm(self, max_bytes):
+        '''
+        Read the files of the hottest maps into the page cache until
+        max_bytes have been read, returns the bytes read
+        '''
+        done = 0
+        buf = bytearray(WARM_READ)
+        for fn_ in self.hottest():
+            for path in self.map_files(fn_):
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if done + size > max_bytes:
+                    return done
+                with io.open(path, 'rb', 0) as fp_:
+                    if HAS_FADVISE:
+                        os.posix_fadvise(
+                                fp_.fileno(),
+                                0,
+                                size,
+                                os.POSIX_FADV_WILLNEED)
+                    else:
+                        while fp_.readinto(buf):
+                            pass
+                done += size
+        return done
+
+    def close(self, hits=None):
+        '''
+        Add the lookup counts of the session to the halved counts of the
+        earlier ones and mark the log closed, the log is rewritten once it
+        holds more than twice the records it needs
+        '''
+        if self.fp_ is None:
+            return
+        hot = dict(
+                (fn_, count // 2) for fn_, count in self.hot.items()
+                if count > 1)
+        for fn_, count in (hits or {}).items():
+            hot[fn_] = hot.get(fn_, 0) + count
+        self.hot = hot
+        if self.shared:
+            self._append(self._pack(HOT, None, msgpack.dumps(dict(
+                (self._rel(fn_), count) for fn_, count in hot.items()))))
+        elif self.records > 2 * len(self.maps) + 64:
+            self._write_log(closed=True)
+        else:
+            self._append(b''.join([
+                self._pack(HOT, None, msgpack.dumps(dict(
+                    (self._rel(fn_), count)
+                    for fn_, count in hot.items()))),
+                self._pack(CLOSED)]))
+            os.fsync(self.fp_.fileno())
+        self.fp_.close()
+        self.fp_ = None
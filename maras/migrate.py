@@ -0,0 +1,81 @@
+'''
+Migrate existing databases to the current on disk layout
+'''
+# Maps written before digest placement located buckets using the
+# interpreter's hash() of the raw key, so the same key can land in a different
+# midx_N (and therefore stor_N) under the new placement. Migration replays
+# every revision of every key, oldest first, into a fresh database.
+
+# Import python libs
+import os
+import sys
+
+# Import maras libs
+import maras.db
+import maras.index.dhm
+
+
+def iter_map_files(db_root):
+    '''
+    Yield the path to every hash map file under the given database root
+    '''
+    for root, dirs, files in os.walk(db_root):
+        dirs.sort()
+        for fn_ in sorted(files):
+            if fn_.startswith('midx_'):
+                yield os.path.join(root, fn_)
+
+
+def iter_revs(index, map_key, prev):
+    '''
+    Walk the prev chain starting at prev and yield the index entries, newest
+    first
+    '''
+    key = None
+    while prev:
+        entry = index._get_h_prev(prev, map_key, key)
+        yield entry
+        key = entry['key']
+        prev = entry['p']
+
+
+def migrate(src, dst):
+    '''
+    Copy the database at src into a new database at dst, the new database
+    is created with the same meta header as src and all keys are placed
+    with the current placement scheme. Returns the number of revisions
+    copied
+    '''
+    s_db = maras.db.DB(src)
+    header = dict(s_db.open_db())
+    index = maras.index.dhm.DHM(src, fd_cache=s_db.fd_cache, **header)
+    # The storage engine is set on the database, not passed to create
+    d_db = maras.db.DB(
+            dst,
+            storage=header.pop('storage', 'msgpack'),
+            stor_opts=header.pop('stor_opts', None))
+    d_db.create(**header)
+    d_db.add_index('migrate')
+    count = 0
+    try:
+        for map_key in iter_map_files(src):
+            index.open_map(map_key)
+            for h_entry in index.iter_buckets(map_key):
+                revs = list(iter_revs(index, map_key, h_entry['prev']))
+                for entry in reversed(revs):
+                    stor = s_db._ind_stor(entry.get('stor'))
+                    data = stor.get(entry, index.maps[map_key])
+                    d_db.insert(data['d'], entry['key'], data['id_'])
+                    count += 1
+    finally:
+        index.close()
+        s_db.close()
+        d_db.close()
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: python -m maras.migrate <src> <dst>\n')
+        sys.exit(1)
+    print('Migrated {0} revisions'.format(migrate(sys.argv[1], sys.argv[2])))
@@ -0,0 +1,458 @@
+'''
+Rebuild the hash maps of a database from its storage files, or verify that
+the hash maps and the storage files agree
+
+    python -m maras.rebuild verify <db_root> [-j PROCESSES]
+    python -m maras.rebuild rebuild <db_root> [-j PROCESSES]
+'''
+# Storage records hold the key, the id and the data of every revision, so the
+# maps of a directory can be regenerated by reading its stor_N files front to
+# back. The records of stor_N are placed in midx_N in file order, which
+# chains the revisions of each key oldest first. Every directory of the tree
+# holds its own maps and storage files, so directories are rebuilt or
+# verified in parallel on a pool of processes, largest first.
+# Records written before the key was stored can not be placed. A map whose
+# storage file holds any of them is left alone by rebuild and reported.
+# Revisions get a new revision stamp when rebuilt, storage written through
+# the zblock engine is not read and the maps of directories holding it are
+# left alone as well. Secondary indexes are not touched, drop and add them
+# again after a rebuild.
+
+# Import python libs
+import io
+import os
+import re
+import sys
+import struct
+import argparse
+import multiprocessing
+
+# Import maras libs
+import maras.db
+import maras.manifest
+import maras.utils
+import maras.index.dhm
+import maras.stor.mpack
+
+# Import third party libs
+import msgpack
+
+STOR_RE = re.compile(r'^stor_(\d+)(?:\.(\d+))?$')
+# Files of a map which are regenerated, next to midx_N
+MAP_FILES = ('midx', 'ids', 'bkt', 'blm')
+
+
+def iter_dirs(db_root):
+    '''
+    Yield the directories under db_root holding storage or map files with
+    the bytes of storage they hold
+    '''
+    for root, dirs, files in os.walk(db_root):
+        dirs.sort()
+        size = 0
+        found = False
+        for fn_ in files:
+            if STOR_RE.match(fn_):
+                size += os.path.getsize(os.path.join(root, fn_))
+                found = True
+            elif fn_.startswith('midx_') or fn_.startswith('zstor_'):
+                found = True
+        if found:
+            yield root, size
+
+
+def stor_files(dirname):
+    '''
+    Return a dict of the map number to the (storage file, generation) of the
+    maps of a directory, and the list of the older generations which were
+    left behind. The newest generation of a map is the one compaction
+    swapped in
+    '''
+    found = {}
+    for fn_ in os.listdir(dirname):
+        match = STOR_RE.match(fn_)
+        if not match:
+            continue
+        num = int(match.group(1))
+        gen = int(match.group(2) or 0)
+        found.setdefault(num, []).append((gen, os.path.join(dirname, fn_)))
+    ret = {}
+    stale = []
+    for num, gens in found.items():
+        gens.sort()
+        ret[num] = (gens[-1][1], gens[-1][0])
+        stale.extend(fn_ for gen, fn_ in gens[:-1])
+    return ret, sorted(stale)
+
+
+def iter_records(fn_, read_size=maras.stor.mpack.CHUNK):
+    '''
+    Yield the (start, size, record) of every record in a storage file in
+    file order, the data of the records is skipped and given as None. The
+    file is read front to back read_size bytes at a time and only one record
+    is held at once. A torn or corrupt record ends the scan, check the end
+    of the last record against the size of the file
+    '''
+    with io.open(fn_, 'rb') as fp_:
+        unpacker = msgpack.Unpacker(
+                fp_,
+                read_size=read_size,
+                max_buffer_size=0)
+        start = 0
+        while True:
+            try:
+                rec = {}
+                for num in range(unpacker.read_map_header()):
+                    name = unpacker.unpack()
+                    if name == 'd':
+                        unpacker.skip()
+                        rec[name] = None
+                    else:
+                        rec[name] = unpacker.unpack()
+            except Exception:
+                # The end of the file, or a torn or corrupt record
+                return
+            end = unpacker.tell()
+            yield start, end - start, rec
+            start = end
+
+
+def _scan(fn_):
+    '''
+    Return the (key, id_, start, size) of the records of a storage file, the
+    key is None for records written without one, and the bytes past the
+    last whole record
+    '''
+    recs = []
+    end = 0
+    for start, size, rec in iter_records(fn_):
+        if 'id_' not in rec or 'd' not in rec:
+            break
+        recs.append((rec.get('k'), rec['id_'], start, size))
+        end = start + size
+    return recs, os.path.getsize(fn_) - end
+
+
+def _open(db_root):
+    '''
+    Return the database opened at db_root and a hash index over its maps
+    '''
+    # The manifest is left alone, workers must not rewrite it
+    db = maras.db.DB(db_root, manifest=False)
+    header = db.open_db()
+    index = maras.index.dhm.DHM(db_root, fd_cache=db.fd_cache, **header)
+    return db, index
+
+
+def _remove_map(dirname, num):
+    '''
+    Remove the map files of map num
+    '''
+    names = ['{0}_{1}'.format(prefix, num) for prefix in MAP_FILES]
+    for fn_ in os.listdir(dirname):
+        if fn_ in names or fn_.split('.')[0] in names:
+            os.remove(os.path.join(dirname, fn_))
+
+
+def _append(index, map_data, chunks, ids):
+    '''
+    Append a run of index entries and their ids to a new map
+    '''
+    index._append(map_data, b''.join(chunks))
+    index._add_ids(map_data, ids)
+    del chunks[:]
+    del ids[:]
+
+
+def _build(index, map_data, recs):
+    '''
+    Write the index entries of the (key, id_, start, size) records of a new
+    map in record order, then write every bucket once. Returns the number of
+    keys whose bucket is held by another key
+    '''
+    # Keys in the order of their first record, the offset of their first
+    # entry and of their last
+    keys = []
+    heads = {}
+    last = {}
+    chunks = []
+    ids = []
+    index._bloom_add(map_data, set(rec[0] for rec in recs))
+    base = pos = index._tail(map_data)
+    written = 0
+    for key, id_, start, size in recs:
+        entry = {
+                'key': key,
+                'st': start,
+                'sz': size,
+                'rev': maras.utils.gen_rev(),
+                't': None,
+                'p': last.get(key, 0),
+                'id': id_,
+                }
+        if key not in heads:
+            keys.append(key)
+        i_entry = index._pack_entry(entry, map_data, heads.get(key, 0))
+        heads.setdefault(key, pos)
+        last[key] = pos
+        chunks.append(i_entry)
+        ids.append((id_, pos))
+        pos += len(i_entry)
+        written += len(i_entry)
+        if written >= maras.stor.mpack.CHUNK:
+            _append(index, map_data, chunks, ids)
+            written = 0
+    if chunks:
+        _append(index, map_data, chunks, ids)
+    index._bloom_appended(map_data, base, pos)
+    conflicts = 0
+    if map_data.get('grow'):
+        index.build_buckets(
+                map_data,
+                [(index._key_digest(key)[0], last[key]) for key in keys])
+        return conflicts
+    buckets = {}
+    for key in keys:
+        h_key, b_pos = index._bucket_pos(
+                map_data,
+                key,
+                index._key_digest(key))
+        if b_pos in buckets:
+            conflicts += 1
+            continue
+        buckets[b_pos] = {'key': h_key, 'prev': last[key]}
+    for b_pos in sorted(buckets):
+        index._write(map_data, b_pos, struct.pack(
+            map_data['fmt'],
+            *[buckets[b_pos][name] for name in map_data['entry_map']]))
+    return conflicts
+
+
+def rebuild_dir(args):
+    '''
+    Regenerate the maps of one directory from its storage files, returns a
+    report dict for every map
+    '''
+    db_root, dirname = args
+    db, index = _open(db_root)
+    files, stale = stor_files(dirname)
+    ret = []
+    try:
+        zstor = any(fn_.startswith('zstor_') for fn_ in os.listdir(dirname))
+        for num in sorted(files):
+            stor_fn, gen = files[num]
+            fn_ = os.path.join(dirname, 'midx_{0}'.format(num))
+            report = {
+                    'map': fn_,
+                    'stor': stor_fn,
+                    'stale': stale,
+                    'rebuilt': False,
+                    }
+            ret.append(report)
+            if zstor:
+                report['error'] = 'zblock storage can not be rebuilt'
+                continue
+            recs, trailing = _scan(stor_fn)
+            unkeyed = sum(1 for rec in recs if rec[0] is None)
+            report.update({
+                'records': len(recs),
+                'unkeyed': unkeyed,
+                'trailing': trailing,
+                })
+            if unkeyed:
+                report['error'] = 'records without a key'
+                continue
+            _remove_map(dirname, num)
+            report['conflicts'] = _build(
+                    index,
+                    index.create_h_index(fn_, gen),
+                    recs)
+            report['rebuilt'] = True
+        index.syncer.flush()
+    finally:
+        index.close()
+        db.close()
+    return ret
+
+
+def _walk(index, fn_):
+    '''
+    Return the (key, id, size) of the entries of a map by storage start and
+    the number of entries in other storage engines, raises ValueError if a
+    chain does not lead back to the start of the map
+    '''
+    refs = {}
+    other = 0
+    for h_entry in index.iter_buckets(fn_):
+        prev = h_entry['prev']
+        key = None
+        while prev:
+            entry = index._get_h_prev(prev, fn_, key)
+            key = entry['key']
+            if entry.get('stor'):
+                other += 1
+            else:
+                refs[entry['st']] = (key, entry['id'], entry['sz'])
+            if entry['p'] and entry['p'] >= prev:
+                raise ValueError('Chain loops at {0}'.format(prev))
+            prev = entry['p']
+    return refs, other
+
+
+def verify_dir(args):
+    '''
+    Compare the maps of one directory with its storage files, returns a
+    report dict for every map. Entries are missing when a record is not
+    referenced by any entry and dangling when an entry does not point at a
+    record of its key and id
+    '''
+    db_root, dirname = args
+    db, index = _open(db_root)
+    files, stale = stor_files(dirname)
+    ret = []
+    try:
+        if any(fn_.startswith('zstor_') for fn_ in os.listdir(dirname)):
+            ret.append({
+                'map': dirname,
+                'error': 'zblock storage can not be verified'})
+        for num in sorted(files):
+            stor_fn, gen = files[num]
+            fn_ = os.path.join(dirname, 'midx_{0}'.format(num))
+            report = {
+                    'map': fn_,
+                    'stor': stor_fn,
+                    'stale': stale,
+                    }
+            ret.append(report)
+            try:
+                map_data = index.open_map(fn_)
+            except IOError:
+                report['error'] = 'map is missing'
+                continue
+            except ValueError as exc:
+                report['error'] = 'map is corrupt: {0}'.format(exc)
+                continue
+            if map_data.get('gen', 0) != gen:
+                report['error'] = 'map references generation {0}'.format(
+                        map_data.get('gen', 0))
+                continue
+            try:
+                refs, other = _walk(index, fn_)
+            except Exception as exc:
+                report['error'] = 'map is corrupt: {0}'.format(exc)
+                continue
+            entries = len(refs)
+            recs, trailing = _scan(stor_fn)
+            unkeyed = 0
+            missing = 0
+            for key, id_, start, size in recs:
+                if key is None:
+                    unkeyed += 1
+                ref = refs.pop(start, None)
+                if ref is None:
+                    missing += 1
+                elif ref[1:] != (id_, size) or key not in (None, ref[0]):
+                    # Left in refs to be counted as dangling
+                    refs[start] = ref
+            report.update({
+                'entries': entries,
+                'records': len(recs),
+                'unkeyed': unkeyed,
+                'trailing': trailing,
+                'other_stor': other,
+                'missing': missing,
+                'dangling': len(refs),
+                })
+    finally:
+        index.close()
+        db.close()
+    return ret
+
+
+def _run(func, db_root, processes=None):
+    '''
+    Run func over every directory of the database on a process pool,
+    returns the reports of all of the maps
+    '''
+    # Fails early if db_root does not hold a database
+    db, index = _open(db_root)
+    index.close()
+    db.close()
+    dirs = sorted(iter_dirs(db_root), key=lambda item: -item[1])
+    jobs = [(db_root, dirname) for dirname, size in dirs]
+    if processes == 1 or len(jobs) < 2:
+        results = [func(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(func, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    ret = []
+    for result in results:
+        ret.extend(result)
+    return ret
+
+
+def rebuild(db_root, processes=None):
+    '''
+    Regenerate the hash maps of the database at db_root from its storage
+    files, the database must not be open. processes defaults to the number
+    of cores. Returns a report dict for every map
+    '''
+    ret = _run(rebuild_dir, db_root, processes)
+    # The maps are listed again from the tree when the database is next
+    # opened
+    try:
+        os.remove(os.path.join(db_root, maras.manifest.NAME))
+    except OSError:
+        pass
+    return ret
+
+
+def verify(db_root, processes=None):
+    '''
+    Check the hash maps of the database at db_root against its storage
+    files, processes defaults to the number of cores. Returns a report dict
+    for every map
+    '''
+    return _run(verify_dir, db_root, processes)
+
+
+def problems(report):
+    '''
+    Return True if a map report shows a problem, records without a key are
+    only a problem for rebuild
+    '''
+    return bool(
+            report.get('error') or
+            report.get('trailing') or
+            report.get('missing') or
+            report.get('dangling') or
+            report.get('conflicts'))
+
+
+def main(argv=None):
+    '''
+    Run rebuild or verify from the command line, returns 1 if a map shows a
+    problem
+    '''
+    parser = argparse.ArgumentParser(prog='python -m maras.rebuild')
+    parser.add_argument('command', choices=('rebuild', 'verify'))
+    parser.add_argument('db_root')
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    opts = parser.parse_args(argv)
+    func = rebuild if opts.command == 'rebuild' else verify
+    status = 0
+    for report in func(opts.db_root, opts.processes):
+        if problems(report):
+            status = 1
+        print(' '.join(
+            '{0}={1}'.format(name, report[name]) for name in sorted(report)
+            if name != 'stale' or report[name]))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
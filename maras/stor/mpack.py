@@ -1,75 +1,440 @@
 '''
 Storage using msgpack for serialization
 '''
+# Records are msgpack maps of the id_, the key k and the data d, so that the
+# storage files alone describe every revision and the hash maps can be
+# rebuilt from them, see maras.rebuild. Records written before the key was
+# stored hold only id_ and d. Records whose data is a byte string of
+# BLOB_MIN bytes or more are blobs, laid out as the id_ and the key followed
+# by d encoded as a bin 32 so that the data starts at a known offset. Blobs
+# are read straight into the returned string without going through msgpack,
+# can be streamed in and out in chunks and are copied in chunks by
+# compaction. Other records are read with a single pread into a new string
+# and decoded by msgpack, get_many decodes them from views of the coalesced
+# read. Reading them with preadv into a buffer kept by every thread, and
+# decoding from a view of it, was measured 2-6% slower on get and no faster
+# on get_many for records of 64 bytes to 60KB, with the C msgpack on
+# python 3.11 and 2.7. The syscall and the view objects cost more than the
+# copy saved, so records below BLOB_MIN are not read in place.
 
 # Import python libs
 import io
 import os
+import struct
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+
+# Import maras libs
+import maras.utils.fdcache
+import maras.utils.pio
+import maras.utils.sync
 
 # Import third party libs
 import msgpack
 
+BLOB_MIN = 64 * 1024
+BLOB_LEN = struct.Struct('>I')
+# Bytes read at a time when streaming or copying a record
+CHUNK = 1024 * 1024
+
+
+def is_stream(data):
+    '''
+    Return True if data is a file like object or an iterator of chunks to be
+    stored as a blob
+    '''
+    return hasattr(data, 'read') or isinstance(data, Iterator)
+
+
+def iter_chunks(data):
+    '''
+    Yield the chunks of a file like object or an iterator
+    '''
+    if not hasattr(data, 'read'):
+        for chunk in data:
+            yield chunk
+        return
+    while True:
+        chunk = data.read(CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+class BlobReader(io.RawIOBase):
+    '''
+    A seekable file like reader of the data of a stored blob, the reader
+    holds its own handle so it stays readable after compaction
+    '''
+    def __init__(self, fn_, start, size):
+        io.RawIOBase.__init__(self)
+        self.fp_ = io.open(fn_, 'rb', 0)
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        num = min(len(buf), self.size - self.pos)
+        if num <= 0:
+            return 0
+        self.fp_.seek(self.start + self.pos)
+        num = self.fp_.readinto(memoryview(buf)[:num])
+        self.pos += num
+        return num
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = max(pos, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.fp_.close()
+        io.RawIOBase.close(self)
+
 
 class MPack(object):
     '''
     Store files using msgpack for data serialization
     '''
-    def __init__(self, db_root):
+    # Storage file name prefix, stor_N sits next to midx_N
+    prefix = 'stor'
+    # Records are stored raw by offset and can be copied by compaction
+    compactable = True
+    # Records can be written from and read back as streams
+    streams = True
+
+    def __init__(
+            self,
+            db_root,
+            fd_cache=None,
+            syncer=None,
+            shared=False,
+            meter=None,
+            **kwargs):
         self.db_root = db_root
-        self.stores = {}
+        if fd_cache is None:
+            fd_cache = maras.utils.fdcache.FDCache()
+        self.fd_cache = fd_cache
+        if syncer is None:
+            syncer = maras.utils.sync.Syncer()
+        self.syncer = syncer
+        # Unbuffered when shared with other processes, see DHM
+        self.buffering = 0 if shared else -1
+        self.meter = meter
+        self.stores = set()
+
+    def _stor_fn(self, map_):
+        '''
+        Return the storage file name for the given map, compacted maps
+        reference a new generation of their storage file
+        '''
+        if map_.get('gen'):
+            return os.path.join(
+                    map_['dir'],
+                    '{0}_{1}.{2}'.format(
+                        self.prefix,
+                        map_['num'],
+                        map_['gen']))
+        return os.path.join(
+                map_['dir'],
+                '{0}_{1}'.format(self.prefix, map_['num']))
 
     def get_stor(self, map_):
         '''
         Get the stor data and fp based on the ind_ref
         '''
-        fn_ = os.path.join(map_['dir'], 'stor_{0}'.format(map_['num']))
-        if fn_ in self.stores:
-            return self.stores[fn_]
-        return self.add_stor(fn_)
+        return self._get_fp(self._stor_fn(map_))
+
+    def _get_fp(self, fn_):
+        '''
+        Return the open storage file from the handle cache
+        '''
+        return self.fd_cache.get(fn_, self.add_stor, self._close_stor)
 
     def add_stor(self, fn_):
         '''
         Open up a new storage file and add it in
         '''
-        stor_dir = os.path.dirname(fn_)
-        if not os.path.exists(stor_dir):
-            os.makedirs(stor_dir)
+        # Existing files are opened without a stat of their directory
         try:
-            fp_ = io.open(fn_, 'r+b')
+            fp_ = io.open(fn_, 'r+b', self.buffering)
         except IOError:
-            fp_ = io.open(fn_, 'w+b')
-        self.stores[fn_] = fp_
+            stor_dir = os.path.dirname(fn_)
+            if not os.path.exists(stor_dir):
+                os.makedirs(stor_dir)
+            fp_ = io.open(fn_, 'w+b', self.buffering)
+        self.stores.add(fn_)
         return fp_
 
+    def _close_stor(self, fp_):
+        '''
+        Close a storage file evicted from the handle cache
+        '''
+        fp_.close()
+
+    def _sync_stor(self, fn_):
+        '''
+        Flush the storage file to disk
+        '''
+        fp_ = self._get_fp(fn_)
+        fp_.flush()
+        os.fsync(fp_.fileno())
+
+    def refresh(self, map_):
+        '''
+        Called once the writer lock of the map is held, records are only
+        ever appended so there is no state to reload
+        '''
+        return
+
     def insert(self, key, data, id_, ind_ref):
         '''
+        Append a record, returns its (start, size). Byte strings of BLOB_MIN
+        bytes or more, file like objects and iterators of chunks are stored
+        as blobs
         '''
-        stor = self.get_stor(ind_ref)
-        stor_str = self.data_in(data, id_)
-        stor.seek(0, 2)
-        start = stor.tell()
+        if is_stream(data):
+            return self.insert_stream(iter_chunks(data), id_, ind_ref, key)
+        if isinstance(data, bytes) and len(data) >= BLOB_MIN:
+            return self.insert_stream([data], id_, ind_ref, key)
+        fn_ = self._stor_fn(ind_ref)
+        stor = self._get_fp(fn_)
+        stor_str = self.data_in(data, id_, key)
+        start = maras.utils.pio.size(stor)
         size = len(stor_str)
-        stor.write(stor_str)
+        if self.meter is not None:
+            self.meter.io('stor', 'write', size)
+        maras.utils.pio.pwrite(stor, stor_str, start)
+        self.syncer.dirty_stor(fn_, size, self._sync_stor)
         return start, size
 
-    def get(self, ind_ref, map_):
+    def _blob_head(self, id_, key=None):
+        '''
+        Return the bytes a blob record of id_ and key starts with, up to the
+        length of its data. Without a key the head of the blobs written
+        before the key was stored is returned
+        '''
+        if key is None:
+            return b''.join([
+                    b'\x82',
+                    msgpack.dumps('id_'),
+                    msgpack.dumps(id_),
+                    msgpack.dumps('d'),
+                    b'\xc6'])
+        return b''.join([
+                b'\x83',
+                msgpack.dumps('id_'),
+                msgpack.dumps(id_),
+                msgpack.dumps('k'),
+                msgpack.dumps(key),
+                msgpack.dumps('d'),
+                b'\xc6'])
+
+    def insert_stream(self, chunks, id_, ind_ref, key=None):
+        '''
+        Append a blob record written chunk by chunk, the length of the data
+        is filled in once all of the chunks are written. Returns the (start,
+        size) of the record
+        '''
+        fn_ = self._stor_fn(ind_ref)
+        stor = self._get_fp(fn_)
+        head = self._blob_head(id_, key)
+        start = maras.utils.pio.size(stor)
+        maras.utils.pio.pwrite(stor, head + BLOB_LEN.pack(0), start)
+        pos = d_start = start + len(head) + BLOB_LEN.size
+        for chunk in chunks:
+            maras.utils.pio.pwrite(stor, chunk, pos)
+            pos += len(chunk)
+        if pos - d_start > 0xffffffff:
+            raise ValueError('Blobs are limited to 4GB')
+        maras.utils.pio.pwrite(
+                stor,
+                BLOB_LEN.pack(pos - d_start),
+                start + len(head))
+        if self.meter is not None:
+            self.meter.io('stor', 'write', pos - start)
+        self.syncer.dirty_stor(fn_, pos - start, self._sync_stor)
+        return start, pos - start
+
+    def _blob(self, ind_ref, map_):
         '''
-        Get the referenced data out of the storage file
+        Return the offset and length of the data of a blob record, or None
+        if the record is not a blob
+        '''
+        if ind_ref['sz'] < BLOB_MIN:
+            return None
+        heads = (
+                self._blob_head(ind_ref['id'], ind_ref['key']),
+                self._blob_head(ind_ref['id']))
+        raw = maras.utils.pio.pread(
+                self.get_stor(map_),
+                len(heads[0]) + BLOB_LEN.size,
+                ind_ref['st'])
+        for head in heads:
+            if raw.startswith(head) and len(raw) >= len(head) + BLOB_LEN.size:
+                break
+        else:
+            return None
+        size = BLOB_LEN.unpack_from(raw, len(head))[0]
+        start = ind_ref['st'] + len(head) + BLOB_LEN.size
+        if start + size != ind_ref['st'] + ind_ref['sz']:
+            return None
+        return start, size
+
+    def get_stream(self, ind_ref, map_):
+        '''
+        Return a file like reader of the data of a record, blobs are read
+        from the storage file as the reader is read and other byte strings
+        are decoded up front
+        '''
+        blob = self._blob(ind_ref, map_)
+        if blob is not None:
+            return BlobReader(self._stor_fn(map_), *blob)
+        data = self.get(ind_ref, map_)['d']
+        if not isinstance(data, bytes):
+            raise ValueError('The data of the record is not a byte string')
+        return io.BytesIO(data)
+
+    def iter_raw(self, ind_ref, map_):
+        '''
+        Yield the serialized record in chunks of at most CHUNK bytes
         '''
         stor = self.get_stor(map_)
-        stor.seek(ind_ref['start'])
-        raw = stor.read(ind_ref['size'])
+        pos = ind_ref['st']
+        end = pos + ind_ref['sz']
+        while pos < end:
+            raw = maras.utils.pio.pread(stor, min(CHUNK, end - pos), pos)
+            if not raw:
+                raise IOError('Storage entry is truncated')
+            if self.meter is not None:
+                self.meter.io('stor', 'read', len(raw))
+            yield raw
+            pos += len(raw)
+
+    def insert_many(self, items, ind_ref):
+        '''
+        Append a batch of (data, id_, key) items to one storage file with a
+        single write, return the list of (start, size) for the items
+        '''
+        fn_ = self._stor_fn(ind_ref)
+        stor = self._get_fp(fn_)
+        pos = maras.utils.pio.size(stor)
+        start = pos
+        chunks = []
+        ret = []
+        for data, id_, key in items:
+            stor_str = self.data_in(data, id_, key)
+            chunks.append(stor_str)
+            ret.append((start, len(stor_str)))
+            start += len(stor_str)
+        stor_str = b''.join(chunks)
+        if self.meter is not None:
+            self.meter.io('stor', 'write', len(stor_str))
+        maras.utils.pio.pwrite(stor, stor_str, pos)
+        self.syncer.dirty_stor(fn_, len(stor_str), self._sync_stor)
+        return ret
+
+    def get(self, ind_ref, map_):
+        '''
+        Get the referenced data out of the storage file, the data of blobs is
+        read without a copy through msgpack
+        '''
+        blob = self._blob(ind_ref, map_)
+        if blob is not None:
+            if self.meter is not None:
+                self.meter.io('stor', 'read', ind_ref['sz'])
+            data = maras.utils.pio.pread(self.get_stor(map_), blob[1], blob[0])
+            if len(data) < blob[1]:
+                raise IOError('Storage entry is truncated')
+            return {'d': data, 'id_': ind_ref['id']}
+        raw = self.get_raw(ind_ref, map_)
+        if len(raw) < ind_ref['sz']:
+            raise IOError('Storage entry is truncated')
         return self.data_out(raw)
 
-    def data_in(self, data, id_):
+    def close(self):
+        '''
+        Close all of the open storage files
+        '''
+        for fn_ in self.stores:
+            self.fd_cache.close(fn_)
+        self.stores = set()
+
+    def get_raw(self, ind_ref, map_):
+        '''
+        Return the serialized record without decoding it
+        '''
+        if self.meter is not None:
+            self.meter.io('stor', 'read', ind_ref['sz'])
+        return maras.utils.pio.pread(
+                self.get_stor(map_),
+                ind_ref['sz'],
+                ind_ref['st'])
+
+    def get_many(self, refs, map_, max_gap=4096, max_read=1024 * 1024):
+        '''
+        Get a batch of records out of one storage file. refs is a list of
+        (tag, ind_ref) pairs, the reads are sorted by offset and ranges that
+        are adjacent, or less than max_gap bytes apart, are merged into a
+        single read of at most max_read bytes. Returns a dict mapping each
+        tag to its decoded record
+        '''
+        stor = self.get_stor(map_)
+        refs = sorted(refs, key=lambda ref: ref[1]['st'])
+        ret = {}
+        ind = 0
+        while ind < len(refs):
+            start = refs[ind][1]['st']
+            end = start + refs[ind][1]['sz']
+            last = ind + 1
+            while last < len(refs):
+                n_ref = refs[last][1]
+                n_end = max(end, n_ref['st'] + n_ref['sz'])
+                if n_ref['st'] - end > max_gap or n_end - start > max_read:
+                    break
+                end = n_end
+                last += 1
+            if self.meter is not None:
+                self.meter.io('stor', 'read', end - start)
+            # Records are decoded from views of the read, not copies
+            raw = memoryview(maras.utils.pio.pread(stor, end - start, start))
+            for tag, ind_ref in refs[ind:last]:
+                r_start = ind_ref['st'] - start
+                r_raw = raw[r_start:r_start + ind_ref['sz']]
+                if len(r_raw) < ind_ref['sz']:
+                    raise IOError('Storage entry is truncated')
+                ret[tag] = self.data_out(r_raw)
+            ind = last
+        return ret
+
+    def data_in(self, data, id_, key=None):
         '''
         Serialize the data as it is sent in
         '''
         in_data = {'d': data, 'id_': id_}
+        if key is not None:
+            in_data['k'] = key
         return msgpack.dumps(in_data)
 
     def data_out(self, raw):
         '''
-        Return the processed data
+        Return the processed data, the key is only kept for rebuilds
         '''
-        return msgpack.loads(raw)
+        ret = msgpack.loads(raw)
+        ret.pop('k', None)
+        return ret
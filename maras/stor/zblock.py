@@ -0,0 +1,333 @@
+'''
+Storage packing msgpack records into compressed blocks
+'''
+# Files for each hash map, next to midx_N:
+#   zstor_N      - compressed blocks, each a 4 byte length and the data
+#   zstor_N.blk  - block table, the 8 byte offset of every block in zstor_N
+#   zstor_N.pend - the records of the open block, written raw after the
+#                  8 byte number of the block they belong to
+# A record's start is its block number shifted left by BLOCK_BITS plus its
+# offset inside the uncompressed block, so the index format is unchanged.
+# Records in the open block are served from memory until the block fills
+# and is compressed. The block table and open block are reloaded when a
+# record is past them, which happens when another process wrote it.
+
+# Import python libs
+import os
+import zlib
+import struct
+import threading
+
+# Import maras libs
+import maras.stor.mpack
+import maras.utils.cache
+import maras.utils.pio
+
+try:
+    import lzma
+    HAS_LZMA = True
+except ImportError:
+    HAS_LZMA = False
+
+BLOCK_BITS = 24
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+LEN_FMT = '>I'
+LEN_SIZE = struct.calcsize(LEN_FMT)
+OFF_FMT = '>Q'
+OFF_SIZE = struct.calcsize(OFF_FMT)
+
+
+class ZBlock(maras.stor.mpack.MPack):
+    '''
+    Store msgpack records in zlib or lzma compressed blocks
+    '''
+    prefix = 'zstor'
+    compactable = False
+    streams = False
+
+    def __init__(
+            self,
+            db_root,
+            fd_cache=None,
+            syncer=None,
+            codec='zlib',
+            level=6,
+            block_size=64 * 1024,
+            cache_bytes=4 * 1024 * 1024,
+            **kwargs):
+        super(ZBlock, self).__init__(db_root, fd_cache, syncer, **kwargs)
+        if codec == 'lzma' and not HAS_LZMA:
+            raise ValueError('lzma is not available')
+        if codec not in ('zlib', 'lzma'):
+            raise ValueError('Invalid codec {0}'.format(codec))
+        if block_size > BLOCK_MASK:
+            raise ValueError('block_size is limited to {0}'.format(BLOCK_MASK))
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.blocks = maras.utils.cache.RecordCache(cache_bytes)
+        self.state = {}
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def _stor_fn(self, map_):
+        '''
+        Return the block file name for the given map
+        '''
+        return os.path.join(
+                map_['dir'],
+                '{0}_{1}'.format(self.prefix, map_['num']))
+
+    def compress(self, raw):
+        '''
+        Compress a block
+        '''
+        if self.codec == 'lzma':
+            return lzma.compress(raw, preset=self.level)
+        return zlib.compress(raw, self.level)
+
+    def decompress(self, raw):
+        '''
+        Decompress a block
+        '''
+        if self.codec == 'lzma':
+            return lzma.decompress(raw)
+        return zlib.decompress(raw)
+
+    def _load(self, fn_):
+        '''
+        Read the block table and the open block of a block file
+        '''
+        # The pend file is read before the table, a block written out in
+        # between is then found in the table
+        p_raw = maras.utils.pio.read_from(
+                self._get_fp('{0}.pend'.format(fn_)),
+                0)
+        raw = maras.utils.pio.read_from(
+                self._get_fp('{0}.blk'.format(fn_)),
+                0)
+        table = [
+                struct.unpack_from(OFF_FMT, raw, pos)[0]
+                for pos in range(0, len(raw) - OFF_SIZE + 1, OFF_SIZE)]
+        pend = b''
+        is_open = False
+        if len(p_raw) >= OFF_SIZE:
+            # A pend file for an already written block is left over from a
+            # crash between writing the block and clearing the pend file
+            if struct.unpack_from(OFF_FMT, p_raw)[0] == len(table):
+                pend = p_raw[OFF_SIZE:]
+                is_open = True
+        # snap holds the block count and the open block together so that
+        # readers in other threads see a matching pair
+        return {
+                'table': table,
+                'pend': pend,
+                'open': is_open,
+                'snap': (len(table), pend),
+                }
+
+    def _state(self, fn_):
+        '''
+        Return the writer state of a block file, loading it on first use
+        '''
+        state = self.state.get(fn_)
+        if state is not None:
+            return state
+        with self.lock:
+            if fn_ not in self.state:
+                self.state[fn_] = self._load(fn_)
+            return self.state[fn_]
+
+    def refresh(self, map_):
+        '''
+        Drop the loaded state of a block file, called once the writer lock
+        of the map is held
+        '''
+        fn_ = self._stor_fn(map_)
+        with self.lock:
+            self.state.pop(fn_, None)
+            self.views.pop(fn_, None)
+
+    def _reset_pend(self, fn_, block):
+        '''
+        Start a new open block
+        '''
+        p_fn = '{0}.pend'.format(fn_)
+        p_fp = self._get_fp(p_fn)
+        p_fp.truncate(0)
+        maras.utils.pio.pwrite(p_fp, struct.pack(OFF_FMT, block), 0)
+        self.syncer.dirty_stor(p_fn, OFF_SIZE, self._sync_stor)
+
+    def _flush_block(self, fn_, state):
+        '''
+        Compress the open block, append it and its offset to the block
+        file and the table and start a new open block
+        '''
+        raw = state['pend']
+        comp = self.compress(raw)
+        if self.meter is not None:
+            self.meter.io('stor', 'write', LEN_SIZE + len(comp))
+        fp_ = self._get_fp(fn_)
+        offset = maras.utils.pio.size(fp_)
+        maras.utils.pio.pwrite(
+                fp_,
+                struct.pack(LEN_FMT, len(comp)) + comp,
+                offset)
+        t_fn = '{0}.blk'.format(fn_)
+        if self.syncer.mode != 'none':
+            # The block must be on disk before the pend file is cleared
+            self._sync_stor(fn_)
+        block = len(state['table'])
+        maras.utils.pio.pwrite(
+                self._get_fp(t_fn),
+                struct.pack(OFF_FMT, offset),
+                block * OFF_SIZE)
+        if self.syncer.mode != 'none':
+            self._sync_stor(t_fn)
+        state['table'].append(offset)
+        self.blocks.set(fn_, block, raw, len(raw))
+        state['pend'] = b''
+        state['snap'] = (block + 1, b'')
+        self._reset_pend(fn_, block + 1)
+
+    def _add(self, fn_, stor_strs):
+        '''
+        Add serialized records to the open block and return their starts,
+        the records are written with one append per block they fill
+        '''
+        state = self._state(fn_)
+        starts = []
+        chunk = []
+        size = len(state['pend'])
+        for stor_str in stor_strs:
+            starts.append((len(state['table']) << BLOCK_BITS) | size)
+            chunk.append(stor_str)
+            size += len(stor_str)
+            if size >= self.block_size:
+                self._append(fn_, state, b''.join(chunk))
+                self._flush_block(fn_, state)
+                chunk = []
+                size = 0
+        if chunk:
+            self._append(fn_, state, b''.join(chunk))
+        return starts
+
+    def _append(self, fn_, state, raw):
+        '''
+        Append serialized records to the open block
+        '''
+        if not state['open']:
+            self._reset_pend(fn_, len(state['table']))
+            state['open'] = True
+        p_fn = '{0}.pend'.format(fn_)
+        if self.meter is not None:
+            self.meter.io('stor', 'write', len(raw))
+        maras.utils.pio.pwrite(
+                self._get_fp(p_fn),
+                raw,
+                OFF_SIZE + len(state['pend']))
+        self.syncer.dirty_stor(p_fn, len(raw), self._sync_stor)
+        state['pend'] += raw
+        state['snap'] = (len(state['table']), state['pend'])
+
+    def insert(self, key, data, id_, ind_ref):
+        '''
+        Add a record, returns the record's start and size
+        '''
+        stor_str = self.data_in(data, id_, key)
+        return self._add(self._stor_fn(ind_ref), [stor_str])[0], len(stor_str)
+
+    def insert_many(self, items, ind_ref):
+        '''
+        Add a batch of (data, id_, key) items, return the list of (start,
+        size)
+        '''
+        stor_strs = [
+                self.data_in(data, id_, key) for data, id_, key in items]
+        starts = self._add(self._stor_fn(ind_ref), stor_strs)
+        return [
+                (start, len(stor_str))
+                for start, stor_str in zip(starts, stor_strs)]
+
+    def _holds(self, state, block, end):
+        '''
+        Return the table and the open block of state if they hold the
+        record, else None
+        '''
+        if state is None:
+            return None
+        n_blocks, pend = state['snap']
+        if block < n_blocks or (block == n_blocks and len(pend) >= end):
+            return state['table'], n_blocks, pend
+        return None
+
+    def _block(self, fn_, block, end):
+        '''
+        Return the uncompressed data of a block, which must be at least end
+        bytes long
+        '''
+        found = self._holds(self._state(fn_), block, end)
+        if found is None:
+            # Written by another process, readers keep their own copy of
+            # the state so the writer state is never replaced under a write
+            found = self._holds(self.views.get(fn_), block, end)
+            if found is None:
+                view = self._load(fn_)
+                self.views[fn_] = view
+                found = self._holds(view, block, end)
+                if found is None:
+                    raise IOError('Storage block {0} is missing'.format(block))
+        table, n_blocks, pend = found
+        if block == n_blocks:
+            return pend
+        raw = self.blocks.get(fn_, block)
+        if raw is not None:
+            return raw
+        fp_ = self._get_fp(fn_)
+        head = maras.utils.pio.pread(fp_, LEN_SIZE, table[block])
+        c_len = struct.unpack(LEN_FMT, head)[0]
+        if self.meter is not None:
+            self.meter.io('stor', 'read', LEN_SIZE + c_len)
+        raw = self.decompress(
+                maras.utils.pio.pread(fp_, c_len, table[block] + LEN_SIZE))
+        self.blocks.set(fn_, block, raw, len(raw))
+        return raw
+
+    def get_raw(self, ind_ref, map_):
+        '''
+        Return the serialized record, only its block is decompressed
+        '''
+        offset = ind_ref['st'] & BLOCK_MASK
+        block = self._block(
+                self._stor_fn(map_),
+                ind_ref['st'] >> BLOCK_BITS,
+                offset + ind_ref['sz'])
+        return block[offset:offset + ind_ref['sz']]
+
+    def get(self, ind_ref, map_):
+        '''
+        Get the referenced data out of the block file
+        '''
+        raw = self.get_raw(ind_ref, map_)
+        if len(raw) < ind_ref['sz']:
+            raise IOError('Storage entry is truncated')
+        return self.data_out(raw)
+
+    def get_many(self, refs, map_, **kwargs):
+        '''
+        Get a batch of (tag, ind_ref) records, each block is decompressed at
+        most once
+        '''
+        ret = {}
+        for tag, ind_ref in sorted(refs, key=lambda ref: ref[1]['st']):
+            ret[tag] = self.get(ind_ref, map_)
+        return ret
+
+    def close(self):
+        '''
+        Close the block files and drop the loaded block state
+        '''
+        super(ZBlock, self).close()
+        self.state = {}
+        self.views = {}
+        self.blocks.clear()
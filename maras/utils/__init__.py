@@ -4,22 +4,47 @@ Misc utilities
 
 # Import python libs
 import os
+import sys
+import zlib
 import time
 import struct
 import hashlib
 import binascii
 import datetime
+import functools
 
 # create a standard epoch so all platforms will count revs from
 # a standard epoch of jan 1 2014
 STD_EPOCH = time.mktime(datetime.datetime(2014, 1, 1).timetuple())
 
+# Keys and ids are text on Python 3 and are encoded where they are written
+# to or hashed from files, on Python 2 str is already a byte string
+PY3 = sys.version_info[0] >= 3
+
+
+def to_bytes(data):
+    '''
+    Return data as a byte string, text is utf-8 encoded
+    '''
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def to_str(data):
+    '''
+    Return a byte string read from a file as the native str type
+    '''
+    if PY3 and isinstance(data, bytes):
+        return data.decode('utf-8')
+    return data
+
 
 def rand_hex_str(size):
     '''
     Return a random string of the passed size using hex encoding
     '''
-    return binascii.hexlify(os.urandom(size/2))
+    return to_str(binascii.hexlify(os.urandom(size // 2)))
 
 
 def rand_raw_str(size):
@@ -34,15 +59,64 @@ def gen_rev():
     Return a revision based on timestamp
     '''
     r_time = time.time() - STD_EPOCH
-    return struct.pack('>Q', r_time * 1000000)
+    return struct.pack('>Q', int(r_time * 1000000))
+
+
+class ZHash(object):
+    '''
+    Wrap a zlib checksum function in the hashlib hexdigest interface so that
+    a fast, non-cryptographic checksum can be used for bucket placement
+    '''
+    def __init__(self, func, data=b''):
+        self.value = func(to_bytes(data)) & 0xffffffff
+
+    def hexdigest(self):
+        '''
+        Return the checksum as a hex byte string
+        '''
+        return to_bytes('{0:08x}'.format(self.value))
+
+
+class HexHash(object):
+    '''
+    Wrap a hashlib function so that it hashes text as its utf-8 encoding
+    and returns its hex digest as a byte string, the way it is stored in
+    the buckets. Only used on Python 3, where hashlib takes and returns
+    other types
+    '''
+    def __init__(self, func, data=b''):
+        self.obj = func(to_bytes(data))
+
+    def hexdigest(self):
+        '''
+        Return the digest as a hex byte string
+        '''
+        return self.obj.hexdigest().encode('ascii')
+
+
+# Buckets only hold the key_hash digest of a key and never the key, so two
+# keys with the same digest would read and overwrite each other. These are
+# only used to place keys, see place_hash
+NON_CRYPTO_HASHES = {
+        'crc32': zlib.crc32,
+        }
 
 
-def get_hash_data(key_hash):
+def get_hash_data(key_hash, place=False):
     '''
-    Return the key hash function and the hash size
+    Return the key hash function and the hash size, the non-cryptographic
+    hashes are only returned for bucket placement, when place is set. The
+    hexdigest of the hash objects is a byte string
     '''
+    if key_hash in NON_CRYPTO_HASHES:
+        if not place:
+            raise ValueError(
+                    '{0} can only be used as place_hash'.format(key_hash))
+        return functools.partial(ZHash, NON_CRYPTO_HASHES[key_hash]), 8
     if hasattr(hashlib, key_hash):
         func = getattr(hashlib, key_hash)
-        size = len(func('some garbage').hexdigest())
+        if PY3:
+            func = functools.partial(HexHash, func)
+        size = len(func(b'some garbage').hexdigest())
         return func, size
     raise ValueError('Hash not available')
@@ -0,0 +1,132 @@
+'''
+Scalable Bloom filters over bucket key digests
+'''
+# A filter is a list of stages, each a plain Bloom filter sized for twice the
+# keys of the stage before it. Keys are added to the newest stage and a new
+# stage is started once it holds its capacity, the false positive rate of
+# every stage is tightened by TIGHTEN so that the rate over all of the stages
+# stays below the rate the filter was created with. Bit positions are taken
+# from the last 32 hex digits of the digest the index already computes for
+# every key, shorter digests are rehashed to 32 digits first.
+
+# Import python libs
+import math
+import struct
+import hashlib
+
+HEAD = struct.Struct('>dQQ')
+# Keys held by the first stage
+BASE = 1024
+TIGHTEN = 0.8
+
+
+def stage_size(fp_rate, num):
+    '''
+    Return the capacity, the number of bits and the number of hashes of the
+    stage num of a filter with the given false positive rate
+    '''
+    cap = BASE << num
+    stage_fp = fp_rate * (1 - TIGHTEN) * TIGHTEN ** num
+    bits = int(math.ceil(cap * -math.log(stage_fp) / math.log(2) ** 2))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(bits / float(cap) * math.log(2))))
+    return cap, bits, hashes
+
+
+class Bloom(object):
+    '''
+    A scalable Bloom filter of hex digests, h_key in filter is False only
+    for digests which were never added
+    '''
+    def __init__(self, fp_rate):
+        if not 0 < fp_rate < 1:
+            raise ValueError(
+                    'Invalid false positive rate {0}'.format(fp_rate))
+        self.fp_rate = fp_rate
+        self.stages = []
+        # Keys held by the newest stage
+        self.count = 0
+        self._add_stage()
+
+    def _add_stage(self):
+        '''
+        Start a new, empty stage
+        '''
+        cap, bits, hashes = stage_size(self.fp_rate, len(self.stages))
+        self.stages.append((cap, bits, hashes, bytearray(bits // 8)))
+        self.count = 0
+
+    def _hashes(self, h_key):
+        '''
+        Return the two hash values the bit positions of h_key are derived
+        from, the second is never 0 so that the positions differ
+        '''
+        if len(h_key) < 32:
+            h_key = hashlib.md5(h_key).hexdigest()
+        return int(h_key[-16:], 16), int(h_key[-32:-16], 16) or 1
+
+    def __contains__(self, h_key):
+        h_1, h_2 = self._hashes(h_key)
+        # The newest stage is the largest, most keys are found there
+        for cap, bits, hashes, data in reversed(self.stages):
+            for ind in range(hashes):
+                pos = (h_1 + ind * h_2) % bits
+                if not data[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def add(self, h_key):
+        '''
+        Add a digest to the filter, returns False if it was already found
+        '''
+        if h_key in self:
+            return False
+        cap, bits, hashes, data = self.stages[-1]
+        if self.count >= cap:
+            self._add_stage()
+            cap, bits, hashes, data = self.stages[-1]
+        h_1, h_2 = self._hashes(h_key)
+        for ind in range(hashes):
+            pos = (h_1 + ind * h_2) % bits
+            data[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        return True
+
+    def size(self):
+        '''
+        Return the bytes held by the filter
+        '''
+        return sum(len(stage[3]) for stage in self.stages)
+
+    def dumps(self):
+        '''
+        Return the filter serialized to a string
+        '''
+        chunks = [HEAD.pack(self.fp_rate, len(self.stages), self.count)]
+        for stage in self.stages:
+            chunks.append(bytes(stage[3]))
+        return b''.join(chunks)
+
+    @classmethod
+    def loads(cls, raw):
+        '''
+        Return the filter serialized in raw, raises ValueError if raw does
+        not hold a whole filter
+        '''
+        if len(raw) < HEAD.size:
+            raise ValueError('Truncated filter')
+        fp_rate, num, count = HEAD.unpack_from(raw)
+        ret = cls(fp_rate)
+        ret.stages = []
+        pos = HEAD.size
+        for ind in range(num):
+            cap, bits, hashes = stage_size(fp_rate, ind)
+            if pos + bits // 8 > len(raw):
+                raise ValueError('Truncated filter')
+            ret.stages.append(
+                    (cap, bits, hashes, bytearray(raw[pos:pos + bits // 8])))
+            pos += bits // 8
+        ret.count = count
+        return ret
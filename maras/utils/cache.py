@@ -0,0 +1,97 @@
+'''
+A size bounded cache of decoded records
+'''
+# Import python libs
+import threading
+import collections
+
+
+class RecordCache(object):
+    '''
+    Least recently used cache of decoded records keyed on (key, id_). The
+    size of each record is the size of its serialized form, records are
+    evicted once the held size passes max_bytes
+    '''
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.records = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, id_):
+        '''
+        Return the cached record or None
+        '''
+        c_key = (key, id_)
+        with self.lock:
+            if c_key not in self.records:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self.records.pop(c_key)
+            self.records[c_key] = entry
+            return entry[0]
+
+    def set(self, key, id_, record, size):
+        '''
+        Add a record to the cache
+        '''
+        if size > self.max_bytes:
+            return
+        c_key = (key, id_)
+        with self.lock:
+            if c_key in self.records:
+                self._remove(c_key)
+            self.records[c_key] = (record, size)
+            self.ids.setdefault(key, set()).add(id_)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.records)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        '''
+        Drop all cached records for the given key
+        '''
+        with self.lock:
+            for id_ in list(self.ids.get(key, ())):
+                self._remove((key, id_))
+
+    def _remove(self, c_key):
+        '''
+        Remove an entry from the cache
+        '''
+        record, size = self.records.pop(c_key)
+        self.bytes -= size
+        ids = self.ids[c_key[0]]
+        ids.discard(c_key[1])
+        if not ids:
+            del self.ids[c_key[0]]
+
+    def clear(self):
+        '''
+        Drop all cached records
+        '''
+        with self.lock:
+            self.records.clear()
+            self.ids.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        Return the cache counters
+        '''
+        lookups = self.hits + self.misses
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'records': len(self.records),
+                }
@@ -0,0 +1,134 @@
+'''
+A bounded cache of open file handles shared by the index and storage files
+'''
+# When threads share the cache a handle evicted by one thread may still be
+# in use by another. Operations are then bracketed with enter and exit, and
+# an evicted handle is only closed once every operation which started
+# before its eviction has finished.
+
+# Import python libs
+import threading
+import collections
+
+
+class FDCache(object):
+    '''
+    Least recently used cache of open file handles. Handles are opened on
+    demand with the passed opener and closed with the passed closer when
+    they are evicted, callers must fetch the handle from the cache on every
+    access so that evicted files are transparently reopened
+    '''
+    def __init__(self, limit=512, threadsafe=False):
+        self.limit = limit
+        self.threadsafe = threadsafe
+        self.handles = collections.OrderedDict()
+        self.lock = threading.RLock()
+        # Start token of every operation in progress, and evicted handles
+        # waiting to be closed with the token count at eviction
+        self.ops = set()
+        self.token = 0
+        self.retired = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, fn_, opener, closer):
+        '''
+        Return the open handle for fn_, opening it if needed
+        '''
+        with self.lock:
+            if fn_ in self.handles:
+                self.hits += 1
+                # Re-insert to mark as most recently used
+                entry = self.handles.pop(fn_)
+                self.handles[fn_] = entry
+                return entry[0]
+            self.misses += 1
+            self.evict(self.limit - 1)
+            handle = opener(fn_)
+            self.handles[fn_] = (handle, closer)
+            return handle
+
+    def evict(self, size):
+        '''
+        Close the least recently used handles until at most size remain
+        '''
+        with self.lock:
+            while len(self.handles) > max(size, 0):
+                fn_, entry = self.handles.popitem(last=False)
+                self._retire(entry)
+                self.evictions += 1
+
+    def _retire(self, entry):
+        '''
+        Close a handle removed from the cache, or hold it until the
+        operations which may be using it have finished
+        '''
+        if not self.ops:
+            entry[1](entry[0])
+            return
+        self.retired.append((self.token, entry))
+
+    def enter(self):
+        '''
+        Mark the start of an operation, returns the token to pass to exit
+        '''
+        if not self.threadsafe:
+            return None
+        with self.lock:
+            self.token += 1
+            self.ops.add(self.token)
+            return self.token
+
+    def exit(self, token):
+        '''
+        Mark the end of an operation and close the retired handles no
+        running operation can hold
+        '''
+        if token is None:
+            return
+        with self.lock:
+            self.ops.discard(token)
+            if not self.retired:
+                return
+            oldest = min(self.ops) if self.ops else self.token + 1
+            keep = []
+            for retired in self.retired:
+                if retired[0] < oldest:
+                    retired[1][1](retired[1][0])
+                else:
+                    keep.append(retired)
+            self.retired = keep
+
+    def close(self, fn_):
+        '''
+        Close the handle for fn_ if it is open
+        '''
+        with self.lock:
+            entry = self.handles.pop(fn_, None)
+            if entry is not None:
+                self._retire(entry)
+
+    def clear(self):
+        '''
+        Close all open handles
+        '''
+        with self.lock:
+            while self.handles:
+                fn_, entry = self.handles.popitem(last=False)
+                entry[1](entry[0])
+            for retired in self.retired:
+                retired[1][1](retired[1][0])
+            self.retired = []
+
+    def stats(self):
+        '''
+        Return the cache counters
+        '''
+        return {
+                'open': len(self.handles),
+                'limit': self.limit,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
@@ -0,0 +1,118 @@
+'''
+Locks used to share a database between processes and threads
+'''
+# Every locked directory holds a LOCK_NAME file which is flocked, shared by
+# readers and exclusively by the single writer. Locks are taken on a fresh
+# descriptor and released by closing it. Between threads writers also hold
+# a per directory thread lock, readers rely on snapshots and take none.
+# Several directories are always locked in sorted order so that writers
+# never deadlock each other.
+
+# Import python libs
+import os
+import threading
+import contextlib
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+LOCK_NAME = 'shard.lock'
+
+
+class ShardLocks(object):
+    '''
+    Take shared and exclusive locks on directories of the database, between
+    processes if processes is set and between threads if threads is set
+    '''
+    def __init__(self, processes=True, threads=False):
+        if processes and not HAS_FCNTL:
+            raise ValueError('File locking is not available')
+        self.processes = processes
+        self.threads = threads
+        self.t_locks = {}
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.waits = 0
+
+    def write(self, dirs):
+        '''
+        Return a context manager holding the exclusive lock of every
+        directory in dirs
+        '''
+        return self._lock(dirs, True)
+
+    def read(self, dirs):
+        '''
+        Return a context manager holding the shared lock of every directory
+        in dirs
+        '''
+        return self._lock(dirs, False)
+
+    def _open(self, dirname):
+        '''
+        Open the lock file of a directory, creating the directory if needed
+        '''
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        return os.open(
+                os.path.join(dirname, LOCK_NAME),
+                os.O_RDWR | os.O_CREAT,
+                0o644)
+
+    def _thread_lock(self, dirname):
+        '''
+        Return the thread lock of a directory
+        '''
+        with self.lock:
+            if dirname not in self.t_locks:
+                self.t_locks[dirname] = threading.Lock()
+            return self.t_locks[dirname]
+
+    @contextlib.contextmanager
+    def _lock(self, dirs, exclusive):
+        '''
+        Lock the directories in sorted order and release them on exit
+        '''
+        held = []
+        fds = []
+        try:
+            for dirname in sorted(set(dirs)):
+                if self.threads and exclusive:
+                    t_lock = self._thread_lock(dirname)
+                    if not t_lock.acquire(False):
+                        self.waits += 1
+                        t_lock.acquire()
+                    held.append(t_lock)
+                if self.processes:
+                    fd_ = self._open(dirname)
+                    fds.append(fd_)
+                    op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+                    try:
+                        fcntl.flock(fd_, op | fcntl.LOCK_NB)
+                    except (IOError, OSError):
+                        self.waits += 1
+                        fcntl.flock(fd_, op)
+                self.acquired += 1
+            yield
+        finally:
+            for fd_ in reversed(fds):
+                os.close(fd_)
+            for t_lock in reversed(held):
+                t_lock.release()
+
+    def stats(self):
+        '''
+        Return the number of locks taken and how many had to wait
+        '''
+        return {
+                'acquired': self.acquired,
+                'waits': self.waits,
+                }
@@ -0,0 +1,189 @@
+'''
+Optional instrumentation of the database hot paths
+'''
+# Components hold a meter attribute which is None unless instrumentation is
+# enabled, so that a disabled meter costs a single attribute test per call.
+# Every thread records into its own shard, so the hot path takes no lock and
+# builds no strings, the shards are only merged, and the io counters named,
+# by stats. Operation latencies are kept in power of two microsecond
+# buckets, so the percentiles reported are the upper bound of the bucket
+# they fall in.
+
+# Import python libs
+import threading
+import timeit
+import collections
+
+
+def _hist():
+    '''
+    Return an empty histogram
+    '''
+    return collections.defaultdict(int)
+
+
+class _Shard(object):
+    '''
+    The counters of a single thread, only that thread writes to them
+    '''
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        # [count, bytes] by (kind, op)
+        self.io = {}
+        # Counts by (name, value) and by (name, latency bucket)
+        self.hists = collections.defaultdict(int)
+        self.timers = collections.defaultdict(int)
+        self.totals = collections.defaultdict(float)
+
+
+class Meter(object):
+    '''
+    Counters, histograms and operation latency timers. Hooks added with
+    add_hook are called with (name, value) for every histogram value and
+    timed operation, latencies are passed in seconds
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.now = timeit.default_timer
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        '''
+        Zero all of the counters, histograms and timers
+        '''
+        with self.lock:
+            self.local = threading.local()
+            self.shards = []
+
+    def _shard(self):
+        '''
+        Return the shard of the calling thread, the hot paths only call
+        this for the first record of a thread
+        '''
+        local = self.local
+        try:
+            return local.shard
+        except AttributeError:
+            shard = local.shard = _Shard()
+            with self.lock:
+                if local is self.local:
+                    self.shards.append(shard)
+            return shard
+
+    def add_hook(self, func):
+        '''
+        Call func(name, value) for every observed value and timed operation
+        '''
+        self.hooks.append(func)
+
+    def remove_hook(self, func):
+        '''
+        Stop calling func
+        '''
+        self.hooks.remove(func)
+
+    def count(self, name, num=1):
+        '''
+        Add num to a counter
+        '''
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard.counters[name] += num
+
+    def io(self, kind, op, size):
+        '''
+        Count a read or write of size bytes on a kind of file
+        '''
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._shard()
+        try:
+            ent = shard.io[kind, op]
+        except KeyError:
+            ent = shard.io[kind, op] = [0, 0]
+        ent[0] += 1
+        ent[1] += size
+
+    def observe(self, name, value):
+        '''
+        Add a value to a histogram
+        '''
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard.hists[name, value] += 1
+        if self.hooks:
+            for hook in self.hooks:
+                hook(name, value)
+
+    def timed(self, name, start):
+        '''
+        Record an operation which started at start, as returned by now
+        '''
+        elapsed = self.now() - start
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard.timers[name, int(elapsed * 1000000).bit_length()] += 1
+        shard.totals[name] += elapsed
+        if self.hooks:
+            for hook in self.hooks:
+                hook(name, elapsed)
+
+    def _percentile(self, buckets, count, pct):
+        '''
+        Return the upper bound in seconds of the bucket holding the pct
+        percentile
+        '''
+        seen = 0
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen * 100.0 >= count * pct:
+                return (1 << bucket) / 1000000.0
+        return 0.0
+
+    def stats(self):
+        '''
+        Return a copy of the counters and histograms and a summary of every
+        timer
+        '''
+        with self.lock:
+            shards = list(self.shards)
+        counters = collections.defaultdict(int)
+        hists = collections.defaultdict(_hist)
+        buckets = collections.defaultdict(_hist)
+        totals = collections.defaultdict(float)
+        # Each dict is copied in one step, its thread may be writing to it
+        for shard in shards:
+            for name, num in dict(shard.counters).items():
+                counters[name] += num
+            for (kind, op), ent in dict(shard.io).items():
+                counters['{0}.{1}s'.format(kind, op)] += ent[0]
+                counters['{0}.{1}_bytes'.format(kind, op)] += ent[1]
+            for src, dst in ((shard.hists, hists), (shard.timers, buckets)):
+                for (name, value), num in dict(src).items():
+                    dst[name][value] += num
+            for name, total in dict(shard.totals).items():
+                totals[name] += total
+        timers = {}
+        for name, hist in buckets.items():
+            count = sum(hist.values())
+            timers[name] = {
+                    'count': count,
+                    'mean': totals[name] / count,
+                    'p50': self._percentile(hist, count, 50),
+                    'p99': self._percentile(hist, count, 99),
+                    'max': self._percentile(hist, count, 100),
+                    }
+        return {
+                'counters': dict(counters),
+                'hists': dict(
+                    (name, dict(hist)) for name, hist in hists.items()),
+                'timers': timers,
+                }
@@ -0,0 +1,57 @@
+'''
+Positional file I/O which does not move a shared file position
+'''
+# os.pread and os.pwrite are used where the platform has them, otherwise the
+# seek and the read or write are made together under a lock. Files read and
+# written here must not be accessed through their own read and write
+# methods, the fallback writes are flushed so every handle of the file sees
+# them.
+
+# Import python libs
+import os
+import threading
+
+HAS_PIO = hasattr(os, 'pread')
+_LOCK = threading.Lock()
+
+
+def pread(fp_, size, pos):
+    '''
+    Read up to size bytes at pos
+    '''
+    if HAS_PIO:
+        return os.pread(fp_.fileno(), size, pos)
+    with _LOCK:
+        fp_.seek(pos)
+        return fp_.read(size)
+
+
+def pwrite(fp_, data, pos):
+    '''
+    Write data at pos
+    '''
+    if HAS_PIO:
+        view = memoryview(data)
+        while len(view):
+            written = os.pwrite(fp_.fileno(), view, pos)
+            view = view[written:]
+            pos += written
+        return
+    with _LOCK:
+        fp_.seek(pos)
+        fp_.write(data)
+        fp_.flush()
+
+
+def read_from(fp_, pos):
+    '''
+    Read everything from pos to the end of the file
+    '''
+    return pread(fp_, max(size(fp_) - pos, 0), pos)
+
+
+def size(fp_):
+    '''
+    Return the size of the file
+    '''
+    return os.fstat(fp_.fileno()).st_size
@@ -0,0 +1,179 @@
+'''
+Durability control for index and storage writes
+'''
+# Modes:
+# none   - Never fsync, the os decides when data reaches the disk
+# per-op - Fsync the storage files, then the index files, after every insert
+# group  - Collect dirty files and fsync them together once group_bytes have
+#          been written or group_interval seconds have passed. A writer which
+#          goes idle has its pending writes synced by a timer thread, through
+#          the idle_flush function of the owner of the files
+# Storage files are always synced before index files so that a synced index
+# entry never references storage data that is not on disk
+
+# Import python libs
+import time
+import threading
+
+MODES = ('none', 'per-op', 'group')
+
+
+def get_mode(sync):
+    '''
+    Return the durability mode for the sync header value, True and False
+    are accepted for databases created before the named modes
+    '''
+    if sync is True:
+        return 'per-op'
+    if not sync:
+        return 'none'
+    if sync not in MODES:
+        raise ValueError('Invalid sync mode {0}'.format(sync))
+    return sync
+
+
+class Syncer(object):
+    '''
+    Track dirty files and fsync them according to the durability mode
+    '''
+    def __init__(
+            self,
+            sync='none',
+            group_bytes=4 * 1024 * 1024,
+            group_interval=0.05):
+        self.mode = get_mode(sync)
+        self.group_bytes = group_bytes
+        self.group_interval = group_interval
+        self.stor = {}
+        self.index = {}
+        # lock guards the dirty files, sync_lock is held while syncing so a
+        # thread finding its files taken by another waits for their sync
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.pending = 0
+        self.last = time.time()
+        self.syncs = 0
+        # Called from the timer thread with no arguments to flush the
+        # pending writes, the timer is not used while it is None
+        self.idle_flush = None
+        self.timer = None
+
+    def dirty_stor(self, fn_, size, sync_func):
+        '''
+        Register a write of size bytes to the storage file fn_, sync_func
+        will be called with fn_ to fsync it
+        '''
+        if self.mode == 'none':
+            return
+        with self.lock:
+            self.stor[fn_] = sync_func
+            self.pending += size
+
+    def dirty_index(self, fn_, size, sync_func):
+        '''
+        Register a write of size bytes to the index file fn_
+        '''
+        if self.mode == 'none':
+            return
+        with self.lock:
+            self.index[fn_] = sync_func
+            self.pending += size
+
+    def barrier(self):
+        '''
+        Called between the storage and index writes of an operation, in
+        per-op mode the storage is synced before the index is touched
+        '''
+        if self.mode == 'per-op':
+            with self.sync_lock:
+                with self.lock:
+                    stor = self._take(self.stor)
+                self._sync(stor)
+
+    def commit(self):
+        '''
+        Called at the end of a write operation
+        '''
+        if self.mode == 'none':
+            return
+        if self.mode == 'group':
+            if (self.pending < self.group_bytes and
+                    time.time() - self.last < self.group_interval):
+                self._arm()
+                return
+        self.flush()
+
+    def _arm(self):
+        '''
+        Start the timer which flushes the pending writes once
+        group_interval has passed since the last sync
+        '''
+        with self.lock:
+            if self.timer is not None or self.idle_flush is None:
+                return
+            delay = max(self.group_interval - (time.time() - self.last), 0)
+            self.timer = threading.Timer(delay, self._idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _idle(self):
+        '''
+        Flush the pending writes from the timer thread
+        '''
+        with self.lock:
+            self.timer = None
+        self.idle_flush()
+
+    def cancel(self):
+        '''
+        Stop the timer, the pending writes are left to the next flush
+        '''
+        with self.lock:
+            timer = self.timer
+            self.timer = None
+        if timer is not None:
+            timer.cancel()
+
+    def flush(self):
+        '''
+        Fsync all dirty files, storage first. The dirty files are taken
+        together so that when called from many threads every index file is
+        synced after the storage written before it
+        '''
+        with self.sync_lock:
+            with self.lock:
+                if not self.stor and not self.index:
+                    return
+                stor = self._take(self.stor)
+                index = self._take(self.index)
+                self.pending = 0
+                self.last = time.time()
+                self.syncs += 1
+            self._sync(stor)
+            self._sync(index)
+
+    def discard(self, fns):
+        '''
+        Forget the pending writes to files which are about to be removed,
+        a sync already under way is waited for
+        '''
+        with self.sync_lock:
+            with self.lock:
+                for fn_ in fns:
+                    self.stor.pop(fn_, None)
+                    self.index.pop(fn_, None)
+
+    def _take(self, files):
+        '''
+        Return the dirty files and forget them
+        '''
+        taken = list(files.items())
+        files.clear()
+        return taken
+
+    def _sync(self, files):
+        '''
+        Fsync the given dirty files
+        '''
+        for fn_, sync_func in files:
+            sync_func(fn_)
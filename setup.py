@@ -35,6 +35,7 @@ setup(name=NAME,
           ],
       packages=[
           'maras',
+          'maras.bench',
           'maras.index',
           'maras.stor',
           'maras.utils',
@@ -0,0 +1,148 @@
+'''
+Test the asyncio front end against a real database
+'''
+# The tests drive the event loop with run_until_complete and futures, no
+# coroutine syntax is used so that the file still imports on Python 2.
+
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.aio
+
+# Import third party libs
+if maras.aio.HAS_ASYNCIO:
+    import asyncio
+
+
+@unittest.skipIf(not maras.aio.HAS_ASYNCIO, 'asyncio is not available')
+class TestAsyncDB(unittest.TestCase):
+    '''
+    Run AsyncDB operations on an event loop over a database on disk
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.path, True)
+
+    def _open(self, create=True, **kwargs):
+        db = maras.db.DB(self.path, threads=4)
+        if create:
+            db.create(sync='none')
+        else:
+            db.open_db()
+        db.add_index('test')
+        return maras.aio.AsyncDB(db, **kwargs)
+
+    def _run(self, fut):
+        return self.loop.run_until_complete(fut)
+
+    def _gather(self, futs):
+        return self._run(asyncio.gather(*futs))
+
+    def test_insert_get(self):
+        adb = self._open()
+        self._gather([
+            adb.insert({'n': ind}, 'd{0}/k{1}'.format(ind % 4, ind))
+            for ind in range(100)])
+        entries = self._gather([
+            adb.get('d{0}/k{1}'.format(ind % 4, ind)) for ind in range(100)])
+        self.assertEqual([entry['d']['n'] for entry in entries],
+                         list(range(100)))
+        with self.assertRaises(KeyError):
+            self._run(adb.get('d0/missing'))
+        self._run(adb.close())
+        # The writes are on disk once close resolves
+        adb = self._open(False)
+        self.assertEqual(self._run(adb.get('d3/k99'))['d']['n'], 99)
+        self._run(adb.close())
+
+    def test_coalesced_gets(self):
+        adb = self._open()
+        self._run(adb.insert({'v': 1}, 'key'))
+        entries = self._gather([adb.get('key') for _ in range(8)])
+        self.assertEqual(entries, [entries[0]] * 8)
+        self.assertEqual(entries[0]['d'], {'v': 1})
+        stats = adb.stats()
+        self.assertEqual(stats['reads'] + stats['coalesced'], 8)
+        self.assertTrue(stats['coalesced'] > 0)
+        self._run(adb.close())
+
+    def test_write_order(self):
+        adb = self._open()
+        for ind in range(50):
+            adb.insert({'v': ind}, 'key')
+        self._run(adb.flush())
+        self.assertEqual(self._run(adb.get('key'))['d']['v'], 49)
+        self._run(adb.close())
+
+    def test_drain(self):
+        adb = self._open(max_writes=2)
+        futs = [adb.insert({'v': ind}, 'k{0}'.format(ind % 3))
+                for ind in range(12)]
+        # Only max_writes writes are admitted, the rest are held back
+        stats = adb.stats()
+        self.assertEqual(stats['writes'] + stats['queued'], 2)
+        self.assertEqual(stats['held'], 10)
+        drain = adb.drain()
+        self.assertFalse(drain.done())
+        self.assertFalse(futs[-1].done())
+        self._run(drain)
+        stats = adb.stats()
+        self.assertEqual(stats['held'], 0)
+        self.assertTrue(stats['writes'] + stats['queued'] <= 2)
+        self.assertEqual(stats['drain_waits'], 1)
+        self._gather(futs)
+        entries, missing = self._run(adb.get_many(['k0', 'k1', 'k2']))
+        self.assertFalse(missing)
+        self.assertEqual(
+                [entry['d']['v'] for entry in entries],
+                [9, 10, 11])
+        self._run(adb.close())
+
+    def test_bounded_writes(self):
+        adb = self._open(max_writes=4)
+        admitted = []
+
+        def _check(fut):
+            stats = adb.stats()
+            admitted.append(stats['writes'] + stats['queued'])
+        futs = []
+        for ind in range(200):
+            fut = adb.insert({'v': ind}, 'k{0}'.format(ind % 7))
+            fut.add_done_callback(_check)
+            futs.append(fut)
+        self._gather(futs)
+        self.assertTrue(max(admitted) <= 4)
+        self.assertEqual(adb.stats()['held'], 0)
+        self._run(adb.flush())
+        entries, missing = self._run(
+                adb.get_many(['k{0}'.format(ind) for ind in range(7)]))
+        self.assertEqual(
+                sorted(entry['d']['v'] for entry in entries),
+                list(range(193, 200)))
+        self._run(adb.close())
+
+    def test_scan(self):
+        adb = self._open()
+        self._run(adb.insert_many(
+            [({'v': ind}, 'd1/k{0:02}'.format(ind)) for ind in range(30)] +
+            [({'v': ind}, 'd2/k{0:02}'.format(ind)) for ind in range(5)]))
+        scan = adb.scan('d1/', keys_only=True, batch=7)
+        keys = []
+        while True:
+            try:
+                keys.append(self._run(scan.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(
+                sorted(keys), ['d1/k{0:02}'.format(ind) for ind in range(30)])
+        self._run(adb.close())
@@ -0,0 +1,102 @@
+'''
+Test the NumPy analysis of the hash maps
+'''
+# Import python libs
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.analyze
+
+KEYS = 300
+
+
+@unittest.skipIf(not maras.analyze.HAS_NUMPY, 'numpy is not available')
+class TestAnalyze(unittest.TestCase):
+    '''
+    Compare the map statistics with the keys written
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _create(self, **kwargs):
+        db = maras.db.DB(self.path)
+        db.create(sync='none', **kwargs)
+        db.add_index('test')
+        for rev in range(2):
+            db.insert_many(
+                    [({'rev': rev}, 'd{0}/k{1}'.format(num % 2, num))
+                     for num in range(KEYS)])
+        return db
+
+    def test_fixed(self):
+        db = self._create(growable=False, hash_limit=0xff)
+        ret = maras.analyze.analyze(db)
+        totals = ret['totals']
+        # Revisions share the bucket of their key
+        self.assertEqual(totals['used'], KEYS)
+        self.assertEqual(sum(totals['depth'].values()), KEYS)
+        self.assertEqual(totals['overflow'], KEYS - totals['depth'][1])
+        self.assertTrue(totals['max_depth'] > 1)
+        self.assertEqual(totals['dirs'], 2)
+        self.assertEqual(totals['buckets'], totals['maps'] * 256)
+        self.assertTrue(totals['prev']['min'] > 0)
+        for stats in ret['maps']:
+            self.assertFalse(stats['grow'])
+            self.assertEqual(
+                    stats['occupancy'],
+                    float(stats['used']) / stats['buckets'])
+        only = maras.analyze.analyze(db, 'd1/')
+        self.assertEqual(only['totals']['used'], KEYS // 2)
+        self.assertEqual(only['totals']['dirs'], 1)
+        db.close()
+
+    def test_growable(self):
+        db = self._create(growable=True)
+        ret = maras.analyze.analyze(db)
+        self.assertEqual(ret['totals']['used'], KEYS)
+        self.assertEqual(ret['totals']['max_depth'], 1)
+        for stats in ret['maps']:
+            self.assertTrue(stats['grow'])
+            self.assertEqual(stats['count'], stats['used'])
+            self.assertEqual(sum(stats['page_fill']), stats['pages'])
+            self.assertEqual(
+                    stats['buckets'], stats['pages'] * stats['slots'])
+        db.close()
+
+    def test_contains(self):
+        for growable in (False, True):
+            db = self._create(growable=growable, hash_limit=0x3f)
+            stored = ['d{0}/k{1}'.format(num % 2, num)
+                      for num in range(0, KEYS, 3)]
+            missing = ['d{0}/k{1}'.format(num % 2, num)
+                       for num in range(KEYS, KEYS * 2, 3)]
+            missing.extend(['d5/k1', 'top'])
+            found = maras.analyze.contains(db, missing + stored)
+            self.assertEqual(
+                    found.tolist(),
+                    [False] * len(missing) + [True] * len(stored))
+            db.close()
+            shutil.rmtree(self.path)
+
+    def test_main(self):
+        self._create(growable=False, hash_limit=0xff).close()
+        devnull = open(os.devnull, 'w')
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            self.assertEqual(maras.analyze.main([self.path]), 0)
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
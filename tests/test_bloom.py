@@ -0,0 +1,50 @@
+'''
+Test the Bloom filters
+'''
+# Import python libs
+import zlib
+import hashlib
+import unittest
+
+# Import maras libs
+import maras.utils.bloom
+
+
+def crc_hex(key):
+    '''
+    Return the 8 digit crc32 hex digest of key
+    '''
+    return '{0:08x}'.format(zlib.crc32(key) & 0xffffffff).encode('ascii')
+
+
+class TestBloom(unittest.TestCase):
+    '''
+    Add digests to filters and look them up again
+    '''
+    def test_short_digests(self):
+        bloom = maras.utils.bloom.Bloom(0.01)
+        keys = [crc_hex('k{0}'.format(num).encode()) for num in range(5000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertTrue(key in bloom)
+        false = sum(
+                1 for num in range(10000)
+                if crc_hex('m{0}'.format(num).encode()) in bloom)
+        self.assertTrue(false < 300)
+
+    def test_zero_digest(self):
+        bloom = maras.utils.bloom.Bloom(0.01)
+        bloom.add(b'0' * 40)
+        self.assertTrue(b'0' * 40 in bloom)
+        self.assertNotEqual(bloom._hashes(b'0' * 40)[1], 0)
+
+    def test_stored_positions(self):
+        h_key = hashlib.sha1(b'key').hexdigest().encode('ascii')
+        self.assertEqual(
+                maras.utils.bloom.Bloom(0.01)._hashes(h_key),
+                (int(h_key[-16:], 16), int(h_key[-32:-16], 16)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+'''
+Test the record cache
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestCache(unittest.TestCase):
+    '''
+    Serve reads from the record cache and drop records on writes
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _create(self, cache_bytes=64 * 1024):
+        db = maras.db.DB(self.path, cache_bytes=cache_bytes, meter=True)
+        db.create(sync='none')
+        db.add_index('test')
+        return db
+
+    def test_hits(self):
+        db = self._create()
+        db.insert({'v': 1}, 'key', 'id1')
+        self.assertEqual(db.get('key')['d'], {'v': 1})
+        db.meter.reset()
+        for _ in range(3):
+            self.assertEqual(db.get('key')['d'], {'v': 1})
+        self.assertEqual(db.get('key', 'id1')['d'], {'v': 1})
+        stats = db.cache_stats()
+        self.assertEqual(stats['hits'], 3)
+        # The latest revision and a named revision are cached apart
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(db.stats()['meter']['counters']['stor.reads'], 1)
+        db.close()
+
+    def test_invalidate_on_insert(self):
+        db = self._create()
+        db.insert({'v': 1}, 'key', 'id1')
+        db.get('key')
+        db.get('key', 'id1')
+        db.insert({'v': 2}, 'key', 'id2')
+        self.assertEqual(db.get('key')['d'], {'v': 2})
+        self.assertEqual(db.get('key', 'id1')['d'], {'v': 1})
+        db.insert_many([({'v': 3}, 'key'), ({'o': 1}, 'other')])
+        self.assertEqual(db.get('key')['d'], {'v': 3})
+        entries, missing = db.get_many(['key', 'other'])
+        self.assertEqual([entry['d'] for entry in entries],
+                         [{'v': 3}, {'o': 1}])
+        db.insert({'v': 4}, 'key')
+        entries, missing = db.get_many(['key'])
+        self.assertEqual(entries[0]['d'], {'v': 4})
+        db.close()
+
+    def test_eviction(self):
+        db = self._create(cache_bytes=1024)
+        for num in range(100):
+            db.insert({'pad': 'x' * 40}, 'k{0}'.format(num))
+        for num in range(100):
+            db.get('k{0}'.format(num))
+        stats = db.cache_stats()
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertTrue(0 < stats['bytes'] <= 1024)
+        db.close()
+
+    def test_disabled(self):
+        db = self._create(cache_bytes=0)
+        db.insert({'v': 1}, 'key')
+        self.assertEqual(db.get('key')['d'], {'v': 1})
+        self.assertEqual(db.cache_stats(), None)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''
+Test online compaction
+'''
+# Import python libs
+import os
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestCompact(unittest.TestCase):
+    '''
+    Compact databases while inserting between the compaction steps
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _files(self, prefix):
+        '''
+        Return the names of the files under the database starting with
+        prefix
+        '''
+        return sorted(
+                name for root, dirs, files in os.walk(self.path)
+                for name in files if name.startswith(prefix))
+
+    def _interleaved(self, growable, sync='none'):
+        '''
+        Write 3 revisions of 400 keys and compact them 4 buckets at a time
+        with 10 new keys inserted after every step, all of the keys must
+        be found with their latest revision afterwards
+        '''
+        db = maras.db.DB(self.path)
+        db.create(sync=sync, growable=growable)
+        db.add_index('test')
+        for rev in range(3):
+            for num in range(400):
+                db.insert({'rev': rev}, 'k{0}'.format(num))
+        new = 0
+        reports = 0
+        for report in db.compact(step=4):
+            if report is None:
+                for _ in range(10):
+                    db.insert({'rev': 0}, 'new{0}'.format(new))
+                    new += 1
+            else:
+                reports += 1
+        self.assertTrue(new > 0)
+        self.assertTrue(reports > 0)
+        # The writes to the removed files must not be synced, or recreate
+        # them, after the swap
+        db.sync()
+        self.assertEqual(
+                len(self._files('stor_')),
+                len(self._files('midx_')))
+        for num in range(400):
+            self.assertEqual(db.get('k{0}'.format(num))['d']['rev'], 2)
+        for num in range(new):
+            self.assertEqual(db.get('new{0}'.format(num))['d']['rev'], 0)
+        db.close()
+        db = maras.db.DB(self.path)
+        db.open_db()
+        db.add_index('test')
+        keys = ['k{0}'.format(num) for num in range(400)]
+        self.assertEqual(db.get_many(keys)[1], [])
+        db.close()
+
+    def test_interleaved_growable(self):
+        self._interleaved(True)
+
+    def test_interleaved_fixed(self):
+        self._interleaved(False)
+
+    def test_interleaved_group_growable(self):
+        self._interleaved(True, 'group')
+
+    def test_interleaved_group_fixed(self):
+        self._interleaved(False, 'group')
+
+
+if __name__ == '__main__':
+    unittest.main()
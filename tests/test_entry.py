@@ -0,0 +1,105 @@
+'''
+Test the binary index entries
+'''
+# Import python libs
+import struct
+import unittest
+
+# Import maras libs
+import maras.utils
+import maras.index.dhm
+
+# Import third party libs
+import msgpack
+
+
+class TestEntry(unittest.TestCase):
+    '''
+    Pack index entries and read them back
+    '''
+    def _entry(self, **kwargs):
+        entry = {
+                'key': 'd1/key',
+                'st': 1234,
+                'sz': 56,
+                'rev': maras.utils.gen_rev(),
+                't': None,
+                'p': 789,
+                'id': maras.utils.rand_hex_str(64),
+                }
+        entry.update(kwargs)
+        return entry
+
+    def _check(self, entry, unpacked):
+        self.assertEqual(unpacked['key'], entry['key'])
+        for name in ('st', 'sz', 'rev', 't', 'id'):
+            self.assertEqual(unpacked[name], entry[name])
+        self.assertEqual(unpacked['p'], entry['p'] or 0)
+
+    def test_round_trip(self):
+        for id_ in (
+                maras.utils.rand_hex_str(64),
+                'abc',
+                'ABCD',
+                'not hex',
+                'a-b-c',
+                ''):
+            entry = self._entry(id=id_)
+            raw = maras.index.dhm.pack_entry(entry)
+            self.assertEqual(
+                    struct.unpack_from('>H', raw)[0] + 2, len(raw))
+            self._check(entry, maras.index.dhm.unpack_entry(raw))
+        # Hex ids are stored as half as many bytes
+        hexed = maras.index.dhm.pack_entry(self._entry(id='ab' * 32))
+        plain = maras.index.dhm.pack_entry(self._entry(id='AB' * 32))
+        self.assertEqual(len(plain) - len(hexed), 32)
+
+    def test_extra(self):
+        entry = self._entry(t='blob', stor='zblock', p=None)
+        unpacked = maras.index.dhm.unpack_entry(
+                maras.index.dhm.pack_entry(entry))
+        self._check(entry, unpacked)
+        self.assertEqual(unpacked['stor'], 'zblock')
+        self.assertEqual(unpacked.get('stor'), 'zblock')
+        self.assertEqual(unpacked.get('missing', 1), 1)
+        self.assertTrue('stor' in unpacked.keys())
+        with self.assertRaises(KeyError):
+            unpacked['missing']
+        self.assertEqual(
+                maras.index.dhm.unpack_entry(
+                    maras.index.dhm.pack_entry(self._entry())).get('stor'),
+                None)
+
+    def test_key_pos(self):
+        entry = self._entry()
+        with_key = maras.index.dhm.pack_entry(entry)
+        raw = maras.index.dhm.pack_entry(entry, key_pos=4096)
+        self.assertEqual(len(with_key) - len(raw), len(entry['key']))
+        unpacked = maras.index.dhm.unpack_entry(raw, key='d1/key')
+        self._check(entry, unpacked)
+        self.assertEqual(unpacked['kp'], 4096)
+        self.assertEqual(maras.index.dhm.unpack_entry(raw)['key'], None)
+
+    def test_offset(self):
+        entries = [self._entry(key='k{0}'.format(num), st=num)
+                   for num in range(5)]
+        raw = b''.join(maras.index.dhm.pack_entry(entry) for entry in entries)
+        pos = 0
+        for entry in entries:
+            self._check(entry, maras.index.dhm.unpack_entry(raw, pos))
+            pos += struct.unpack_from('>H', raw, pos)[0] + 2
+        self.assertEqual(pos, len(raw))
+
+    def test_msgpack_entry(self):
+        entry = self._entry(p=None)
+        packed = msgpack.dumps(entry)
+        raw = b'pad' + struct.pack('>H', len(packed)) + packed
+        self.assertEqual(maras.index.dhm.unpack_entry(raw, 3), entry)
+
+    def test_too_long(self):
+        with self.assertRaises(ValueError):
+            maras.index.dhm.pack_entry(self._entry(key='k' * 0x10000))
+
+
+if __name__ == '__main__':
+    unittest.main()
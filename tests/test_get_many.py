@@ -0,0 +1,61 @@
+'''
+Test bulk reads
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestGetMany(unittest.TestCase):
+    '''
+    Read many keys at once from coalesced storage reads
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        self.db = maras.db.DB(self.path, meter=True)
+        self.db.create(sync='none')
+        self.db.add_index('test')
+        self.db.insert_many(
+                [({'n': num}, 'd{0}/k{1}'.format(num % 4, num))
+                 for num in range(100)])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path, True)
+
+    def test_order(self):
+        keys = ['d{0}/k{1}'.format(num % 4, num) for num in range(99, -1, -3)]
+        keys.insert(5, 'd0/missing')
+        keys.append(keys[0])
+        entries, missing = self.db.get_many(keys)
+        self.assertEqual(missing, ['d0/missing'])
+        self.assertEqual(len(entries), len(keys))
+        self.assertEqual(entries[5], None)
+        for key, entry in zip(keys, entries):
+            if key == 'd0/missing':
+                continue
+            self.assertEqual(entry['d'], {'n': int(key.split('/k')[1])})
+
+    def test_coalesced(self):
+        self.db.meter.reset()
+        keys = ['d{0}/k{1}'.format(num % 4, num) for num in range(100)]
+        entries, missing = self.db.get_many(keys)
+        self.assertEqual(missing, [])
+        # The records of a storage file were appended together and are
+        # read back in a single read per file
+        counters = self.db.stats()['meter']['counters']
+        self.assertEqual(counters['stor.reads'], 4)
+
+    def test_latest(self):
+        self.db.insert({'n': -1}, 'd1/k1')
+        entries, missing = self.db.get_many(['d1/k1', 'd2/k2'])
+        self.assertEqual([entry['d'] for entry in entries],
+                         [{'n': -1}, {'n': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Test lookups of revision ids through the id index
+'''
+# Import python libs
+import os
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestIds(unittest.TestCase):
+    '''
+    Look up every revision of keys sharing buckets and map files
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _create(self, **kwargs):
+        db = maras.db.DB(self.path, meter=True)
+        db.create(sync='none', **kwargs)
+        db.add_index('test')
+        return db
+
+    def _fill(self, db):
+        # Four buckets per map, so keys collide and spill into more maps
+        for rev in range(4):
+            for num in range(40):
+                db.insert(
+                        {'n': num, 'rev': rev},
+                        'k{0}'.format(num),
+                        'id{0}.{1}'.format(num, rev))
+
+    def _check(self, db):
+        for rev in range(4):
+            for num in range(40):
+                entry = db.get(
+                        'k{0}'.format(num),
+                        'id{0}.{1}'.format(num, rev))
+                self.assertEqual(entry['d'], {'n': num, 'rev': rev})
+
+    def test_collisions(self):
+        for growable in (False, True):
+            db = self._create(growable=growable, hash_limit=0x3)
+            self._fill(db)
+            if not growable:
+                self.assertTrue(len(db.indexes['test'].maps) > 1)
+            db.meter.reset()
+            self._check(db)
+            counters = db.stats()['meter']['counters']
+            self.assertEqual(counters['id_index_hits'], 160)
+            with self.assertRaises(KeyError):
+                db.get('k1', 'id2.0')
+            db.close()
+            shutil.rmtree(self.path)
+
+    def test_shared_id(self):
+        db = self._create(growable=False, hash_limit=0x3)
+        # The id index holds the last key written with an id, the other
+        # keys fall back to walking their revisions
+        db.insert({'v': 'a'}, 'a', 'same')
+        db.insert({'v': 'b'}, 'b', 'same')
+        self.assertEqual(db.get('a', 'same')['d'], {'v': 'a'})
+        self.assertEqual(db.get('b', 'same')['d'], {'v': 'b'})
+        db.close()
+
+    def test_rebuild(self):
+        db = self._create(growable=False, hash_limit=0x3)
+        self._fill(db)
+        fns = list(db.indexes['test'].maps)
+        db.close()
+        for fn_ in fns:
+            os.remove(db.indexes['test']._ids_fn(fn_))
+        # Without the manifest, which records the removed files as present
+        db = maras.db.DB(self.path, manifest=False, meter=True)
+        db.open_db()
+        db.add_index('test')
+        self._check(db)
+        counters = db.stats()['meter']['counters']
+        self.assertEqual(counters['id_index_hits'], 160)
+        db.close()
+        for fn_ in fns:
+            self.assertTrue(os.path.isfile(db.indexes['test']._ids_fn(fn_)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+Test batched inserts
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestInsertMany(unittest.TestCase):
+    '''
+    Insert batches of records spread over many hash map files
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _create(self, **kwargs):
+        db = maras.db.DB(self.path, meter=True)
+        db.create(sync='none', **kwargs)
+        db.add_index('test')
+        return db
+
+    def test_order(self):
+        db = self._create()
+        recs = [({'n': num}, 'd{0}/k{1}'.format(num % 4, num))
+                for num in range(100)]
+        refs = db.insert_many(recs)
+        self.assertEqual(len(refs), len(recs))
+        for rec, ref in zip(recs, refs):
+            entry = db.get(rec[1])
+            self.assertEqual(entry['d'], rec[0])
+            self.assertEqual(ref['size'], db.indexes['test'].get_h_index(
+                rec[1])[0]['sz'])
+        db.close()
+
+    def test_grouped_appends(self):
+        db = self._create()
+        db.insert_many(
+                [({'n': num}, 'd{0}/k{1}'.format(num % 4, num))
+                 for num in range(100)])
+        # One storage append for each of the four hash map directories
+        counters = db.stats()['meter']['counters']
+        self.assertEqual(counters['stor.writes'], 4)
+        db.close()
+
+    def test_revisions(self):
+        for growable in (True, False):
+            db = self._create(growable=growable, hash_limit=0xff)
+            # Repeated keys of a batch become revisions in batch order
+            db.insert_many([
+                ({'rev': 0}, 'key', 'id0'),
+                ({'other': 1}, 'other'),
+                ({'rev': 1}, 'key', 'id1'),
+                ])
+            db.insert_many([({'rev': 2}, 'key', 'id2')])
+            self.assertEqual(db.get('key')['d'], {'rev': 2})
+            for rev in range(3):
+                entry = db.get('key', 'id{0}'.format(rev))
+                self.assertEqual(entry['d'], {'rev': rev})
+            self.assertEqual(db.get('other')['d'], {'other': 1})
+            db.close()
+            shutil.rmtree(self.path)
+
+    def test_reopen(self):
+        db = self._create()
+        db.insert_many(
+                [('v{0}'.format(num), 'd{0}/k{1}'.format(num % 3, num))
+                 for num in range(50)])
+        db.close()
+        db = maras.db.DB(self.path)
+        db.open_db()
+        db.add_index('test')
+        for num in range(50):
+            entry = db.get('d{0}/k{1}'.format(num % 3, num))
+            self.assertEqual(entry['d'], 'v{0}'.format(num))
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+'''
+Test the manifest of the hash map files
+'''
+# Import python libs
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.manifest
+
+
+class TestManifest(unittest.TestCase):
+    '''
+    Reopen databases after the manifest lost its latest records
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _open(self):
+        db = maras.db.DB(self.path)
+        db.open_db()
+        db.add_index('test')
+        return db
+
+    def _log(self):
+        with io.open(self._log_fn(), 'rb') as fp_:
+            return fp_.read()
+
+    def _log_fn(self):
+        return os.path.join(self.path, maras.manifest.NAME)
+
+    def _restore(self, raw):
+        with io.open(self._log_fn(), 'wb') as fp_:
+            fp_.write(raw)
+
+    def test_lost_compaction_records(self):
+        '''
+        A crash after compaction which loses the records of the compacted
+        maps must not leave their old headers in use
+        '''
+        db = maras.db.DB(self.path)
+        db.create(sync='none')
+        db.add_index('test')
+        for rev in range(3):
+            for num in range(200):
+                db.insert({'rev': rev}, 'd/k{0}'.format(num))
+        db.close()
+        db = self._open()
+        raw = self._log()
+        for _ in db.compact():
+            pass
+        # The session ends without a close and its records are lost
+        self._restore(raw)
+        db = self._open()
+        for num in range(200):
+            self.assertEqual(db.get('d/k{0}'.format(num))['d']['rev'], 2)
+        db.close()
+
+    def test_opened_is_synced(self):
+        '''
+        The OPENED record is on disk before the session writes any map
+        '''
+        db = maras.db.DB(self.path)
+        db.create(sync='none')
+        db.close()
+        synced = []
+        fsync = os.fsync
+
+        def record(fd):
+            synced.append(os.fstat(fd).st_size)
+            fsync(fd)
+        os.fsync = record
+        try:
+            db = self._open()
+        finally:
+            os.fsync = fsync
+        self.assertEqual(synced, [len(self._log())])
+        db.insert({'rev': 0}, 'd/k')
+        db.close()
+
+
+    def _watch(self):
+        '''
+        Count the file system checks of the map files until the returned
+        function is called
+        '''
+        seen = []
+        isfile = os.path.isfile
+        getsize = os.path.getsize
+
+        def _isfile(path):
+            seen.append(path)
+            return isfile(path)
+
+        def _getsize(path):
+            seen.append(path)
+            return getsize(path)
+        os.path.isfile = _isfile
+        os.path.getsize = _getsize
+
+        def _stop():
+            os.path.isfile = isfile
+            os.path.getsize = getsize
+            return [path for path in seen
+                    if os.path.basename(path).startswith(('midx_', 'ids_'))]
+        return _stop
+
+    def _fill(self, **kwargs):
+        db = maras.db.DB(self.path)
+        db.create(sync='none', **kwargs)
+        db.add_index('test')
+        for num in range(100):
+            db.insert({'n': num}, 'd{0}/k{1}'.format(num % 4, num),
+                      'id{0}'.format(num))
+        db.close()
+
+    def test_listed_files(self):
+        '''
+        Opening the maps listed in a closed log leaves their files alone
+        '''
+        for use_mmap in (False, True):
+            self._fill(use_mmap=use_mmap, growable=not use_mmap)
+            stop = self._watch()
+            try:
+                db = self._open()
+                for num in range(100):
+                    entry = db.get(
+                            'd{0}/k{1}'.format(num % 4, num),
+                            'id{0}'.format(num))
+                    self.assertEqual(entry['d'], {'n': num})
+            finally:
+                seen = stop()
+            self.assertEqual(seen, [])
+            db.close()
+            shutil.rmtree(self.path)
+
+    def test_unknown_files(self):
+        '''
+        The id index of maps listed without their file state is looked for
+        on first use
+        '''
+        self._fill()
+        raw = self._log()
+        chunks = []
+        pos = 0
+        while pos < len(raw):
+            kind, p_len, d_len = maras.manifest.REC.unpack_from(raw, pos)
+            start = pos + maras.manifest.REC.size
+            path = raw[start:start + p_len]
+            data = raw[start + p_len:start + p_len + d_len]
+            if kind == maras.manifest.MAP and data:
+                self.assertEqual(data[:1], maras.manifest.FILES_MARK)
+                data = data[1 + maras.manifest.FILES.size:]
+            chunks.append(b''.join([
+                maras.manifest.REC.pack(kind, p_len, len(data)),
+                path,
+                data]))
+            pos = start + p_len + d_len
+        # The log as written before the file state was recorded
+        self._restore(b''.join(chunks))
+        stop = self._watch()
+        try:
+            db = self._open()
+            self.assertEqual(db.get('d1/k1', 'id1')['d'], {'n': 1})
+            opened = list(db.indexes['test'].maps)
+        finally:
+            seen = stop()
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(seen, [db.indexes['test']._ids_fn(opened[0])])
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
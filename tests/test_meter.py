@@ -0,0 +1,72 @@
+'''
+Test the optional instrumentation
+'''
+# Import python libs
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.utils.meter
+
+
+class TestMeter(unittest.TestCase):
+    '''
+    Record from many threads and read the merged stats
+    '''
+    def test_threads(self):
+        meter = maras.utils.meter.Meter()
+
+        def _record():
+            for num in range(1000):
+                meter.io('stor', 'read', 10)
+                meter.count('skips')
+                meter.observe('depth', num % 3)
+                meter.timed('get', meter.now())
+        threads = [threading.Thread(target=_record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = meter.stats()
+        self.assertEqual(stats['counters'], {
+            'stor.reads': 4000,
+            'stor.read_bytes': 40000,
+            'skips': 4000,
+            })
+        self.assertEqual(
+                stats['hists'],
+                {'depth': {0: 1336, 1: 1332, 2: 1332}})
+        self.assertEqual(stats['timers']['get']['count'], 4000)
+        meter.reset()
+        meter.count('skips')
+        self.assertEqual(meter.stats()['counters'], {'skips': 1})
+
+    def test_db(self):
+        path = tempfile.mkdtemp(prefix='maras_test_')
+        try:
+            db = maras.db.DB(path, meter=True)
+            db.create(sync='none')
+            db.add_index('test')
+            seen = []
+            db.add_hook(lambda name, value: seen.append(name))
+            for num in range(10):
+                db.insert({'n': num}, 'k{0}'.format(num))
+            for num in range(10):
+                db.get('k{0}'.format(num))
+            stats = db.stats()['meter']
+            self.assertEqual(stats['timers']['insert']['count'], 10)
+            self.assertEqual(stats['timers']['get']['count'], 10)
+            self.assertEqual(stats['counters']['stor.reads'], 10)
+            # Inserts probe the maps as well
+            self.assertEqual(sum(stats['hists']['probe_depth'].values()), 20)
+            self.assertEqual(seen.count('get'), 10)
+            db.close()
+        finally:
+            shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
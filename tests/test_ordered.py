@@ -0,0 +1,131 @@
+'''
+Test the ordered key index
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.index.ordered
+
+
+class TestOrdered(unittest.TestCase):
+    '''
+    Read ranges of keys while runs are flushed and merged
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _index(self, **kwargs):
+        return maras.index.ordered.OrderedIndex(
+                self.path,
+                'test',
+                flush_keys=10,
+                max_runs=2,
+                page_size=64,
+                **kwargs)
+
+    def _add(self, index, first, last):
+        # One run for every flush_keys keys
+        for num in range(first, last, 10):
+            index.insert_keys('k{0:03}'.format(key)
+                              for key in range(num, num + 10))
+
+    def _cached(self, index, runs):
+        return [run.fn_ for run in runs if run.fn_ in index.page_cache.ids]
+
+    def test_merge_closes_runs(self):
+        index = self._index()
+        self._add(index, 0, 20)
+        old = list(index.runs)
+        self.assertEqual(len(old), 2)
+        keys = index.range()
+        self.assertEqual(next(keys), 'k000')
+        self.assertEqual(len(self._cached(index, old)), 2)
+        # The third run is merged with the two the range reads
+        self._add(index, 20, 30)
+        self.assertEqual(len(index.runs), 1)
+        self.assertTrue(all(run.retired for run in old))
+        self.assertFalse(any(run.fp_.closed for run in old))
+        self.assertEqual(
+                list(keys),
+                ['k{0:03}'.format(num) for num in range(1, 20)])
+        self.assertTrue(all(run.fp_.closed for run in old))
+        self.assertEqual(self._cached(index, old), [])
+        # Without a range in progress merged runs are closed at once
+        merged = index.runs[0]
+        self.assertEqual(len(list(index.range())), 30)
+        self._add(index, 30, 50)
+        self.assertTrue(merged.fp_.closed)
+        self.assertEqual(self._cached(index, [merged]), [])
+        self.assertEqual(
+                list(index.range('k025', 'k035')),
+                ['k{0:03}'.format(num) for num in range(25, 35)])
+        index.close()
+
+    def test_abandoned_range(self):
+        index = self._index()
+        self._add(index, 0, 20)
+        old = list(index.runs)
+        keys = index.range()
+        next(keys)
+        self._add(index, 20, 30)
+        self.assertFalse(any(run.fp_.closed for run in old))
+        keys.close()
+        self.assertTrue(all(run.fp_.closed for run in old))
+        index.close()
+
+    def test_range_bounds(self):
+        db = maras.db.DB(self.path)
+        db.create(sync='none')
+        db.add_index('test')
+        with self.assertRaises(ValueError):
+            db.range()
+        db.add_index('ordered', 'ordered', flush_keys=16, max_runs=2)
+        keys = ['k{0:03}'.format(num) for num in range(0, 100, 2)]
+        # Keys in the memory table, in runs and repeated across both
+        for key in keys:
+            db.insert({'k': key}, key)
+        for key in keys[::5]:
+            db.insert({'k': key, 'rev': 1}, key)
+        self.assertTrue(db.indexes['ordered'].runs)
+        self.assertTrue(db.indexes['ordered'].mem)
+        for start, end, limit in (
+                (None, None, None),
+                ('k010', 'k020', None),
+                ('k011', 'k021', None),
+                ('k010', None, 3),
+                (None, 'k004', None),
+                ('k098', None, None),
+                ('k099', None, None),
+                ('k020', 'k020', None),
+                ('a', 'z', 0)):
+            expect = [key for key in keys
+                      if (start is None or key >= start) and
+                      (end is None or key < end)]
+            if limit is not None:
+                expect = expect[:limit]
+            self.assertEqual(
+                    db.range(start, end, limit, keys_only=True),
+                    expect)
+        pairs = db.range('k000', 'k012')
+        self.assertEqual([key for key, entry in pairs], keys[:6])
+        self.assertEqual(pairs[0][1]['d'], {'k': 'k000', 'rev': 1})
+        self.assertEqual(pairs[1][1]['d'], {'k': 'k002'})
+        db.close()
+        # The log of the memory table is replayed on open
+        db = maras.db.DB(self.path)
+        db.open_db()
+        db.add_index('test')
+        db.add_index('ordered', 'ordered', flush_keys=16, max_runs=2)
+        self.assertEqual(db.range(keys_only=True), keys)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''
+Test the placement of keys in hash map buckets
+'''
+# Import python libs
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+# Import maras libs
+import maras.db
+import maras.index.dhm
+
+# Import third party libs
+import msgpack
+
+# Read back the keys of a legacy map in a process of its own
+READ = '''
+import sys
+import maras.db
+db = maras.db.DB(sys.argv[1], manifest=False)
+db.open_db()
+db.add_index('test')
+for num in range(200):
+    assert db.get('d/k{0}'.format(num))['d'] == num
+db.close()
+'''
+
+
+class _Legacy(object):
+    '''
+    msgpack writing map headers without the place field, as they were
+    written before digest placement
+    '''
+    def __getattr__(self, name):
+        return getattr(msgpack, name)
+
+    def dumps(self, obj):
+        if isinstance(obj, dict) and 'h_limit' in obj:
+            obj = dict(obj)
+            obj.pop('place', None)
+        return msgpack.dumps(obj)
+
+
+class TestPlacement(unittest.TestCase):
+    '''
+    Maps written before digest placement must be found after a restart
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_py2_hash(self):
+        # The values python 2.7 returns on 64 bit platforms
+        hashes = {
+                b'': 0,
+                b'a': 12416037344,
+                b'd0/k1': -395201308008689478,
+                b'q/k1999': -6934968816898591212,
+                b'\xff\x00abc': 279157820724450566,
+                }
+        for raw, val in hashes.items():
+            self.assertEqual(maras.index.dhm.py2_hash(raw), val)
+
+    def test_legacy_restart(self):
+        db = maras.db.DB(self.path, manifest=False)
+        db.create(sync='none', growable=False, hash_limit=0xff)
+        index = db.add_index('test')
+        create = index.create_h_index
+
+        def _legacy(fn_):
+            header = create(fn_)
+            header.pop('place')
+            return header
+        index.create_h_index = _legacy
+        maras.index.dhm.msgpack = _Legacy()
+        try:
+            for num in range(200):
+                db.insert(num, 'd/k{0}'.format(num))
+        finally:
+            maras.index.dhm.msgpack = msgpack
+        db.close()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(maras.__file__))] +
+                sys.path)
+        for seed in ('1', '2'):
+            env['PYTHONHASHSEED'] = seed
+            subprocess.check_call(
+                    [sys.executable, '-c', READ, self.path],
+                    env=env)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Test rebuilding and verifying the hash maps from the storage files
+'''
+# Import python libs
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.rebuild
+
+DIRS = 3
+
+
+class TestRebuild(unittest.TestCase):
+    '''
+    Damage the maps of a database and rebuild them from storage
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        db = maras.db.DB(self.path)
+        db.create(sync='none', growable=False, hash_limit=0xf)
+        db.add_index('test')
+        for rev in range(3):
+            db.insert_many(
+                    [({'n': num, 'rev': rev},
+                      self._key(num),
+                      'id{0}.{1}'.format(num, rev))
+                     for num in range(60)])
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _key(self, num):
+        return 'd{0}/k{1}'.format(num % DIRS, num)
+
+    def _map_fn(self, num=1):
+        return os.path.join(self.path, 'd0', 'midx_{0}'.format(num))
+
+    def _bad(self, processes=1):
+        reports = maras.rebuild.verify(self.path, processes)
+        self.assertTrue(reports)
+        return [report for report in reports
+                if maras.rebuild.problems(report)]
+
+    def _check(self):
+        db = maras.db.DB(self.path)
+        db.open_db()
+        db.add_index('test')
+        for num in range(60):
+            self.assertEqual(
+                    db.get(self._key(num))['d'], {'n': num, 'rev': 2})
+            entry = db.get(self._key(num), 'id{0}.0'.format(num))
+            self.assertEqual(entry['d'], {'n': num, 'rev': 0})
+        db.close()
+
+    def test_clean(self):
+        self.assertEqual(self._bad(), [])
+        self.assertEqual(self._bad(None), [])
+
+    def test_zeroed_buckets(self):
+        with io.open(self._map_fn(), 'r+b') as fp_:
+            fp_.seek(1024)
+            fp_.write(b'\x00' * 16 * 64)
+        bad = self._bad()
+        self.assertEqual([report['map'] for report in bad], [self._map_fn()])
+        self.assertTrue(bad[0]['missing'] > 0)
+        reports = maras.rebuild.rebuild(self.path, 2)
+        self.assertTrue(all(report['rebuilt'] for report in reports))
+        self.assertEqual(self._bad(), [])
+        self._check()
+
+    def test_missing_map(self):
+        os.remove(self._map_fn())
+        bad = self._bad()
+        self.assertEqual(bad[0]['error'], 'map is missing')
+        maras.rebuild.rebuild(self.path, 1)
+        self.assertEqual(self._bad(), [])
+        self._check()
+
+    def test_trailing(self):
+        stor_fn = os.path.join(self.path, 'd1', 'stor_1')
+        with io.open(stor_fn, 'ab') as fp_:
+            fp_.write(b'\x83\xa3id_')
+        bad = self._bad()
+        self.assertEqual([report['stor'] for report in bad], [stor_fn])
+        self.assertTrue(bad[0]['trailing'] > 0)
+        self._check()
+
+    def test_main(self):
+        with io.open(self._map_fn(), 'r+b') as fp_:
+            fp_.seek(1024)
+            fp_.write(b'\xff' * 16 * 64)
+        devnull = open(os.devnull, 'w')
+        stdout = maras.rebuild.sys.stdout
+        maras.rebuild.sys.stdout = devnull
+        try:
+            self.assertEqual(maras.rebuild.main(['verify', self.path]), 1)
+            self.assertEqual(
+                    maras.rebuild.main(['rebuild', self.path, '-j', '1']),
+                    0)
+            self.assertEqual(maras.rebuild.main(['verify', self.path]), 0)
+        finally:
+            maras.rebuild.sys.stdout = stdout
+            devnull.close()
+        self._check()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+Test prefix scans over the key hierarchy
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestScan(unittest.TestCase):
+    '''
+    Scan prefixes ending inside and at the edges of hash map directories
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        self.db = maras.db.DB(self.path)
+        self.db.create(sync='none', growable=False, hash_limit=0xf)
+        self.db.add_index('test')
+        self.keys = [
+                'top', 'd1/k1', 'd10/k1', 'a/b/c', 'a/bc/d', 'a/x', '/lead/k']
+        self.keys.extend('d1/k{0}'.format(num) for num in range(2, 30))
+        for rev in range(2):
+            for key in self.keys:
+                self.db.insert({'k': key, 'rev': rev}, key)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path, True)
+
+    def _keys(self, prefix):
+        return sorted(self.db.scan(prefix, keys_only=True))
+
+    def _expect(self, prefix):
+        return sorted(key for key in self.keys if key.startswith(prefix))
+
+    def test_prefixes(self):
+        for prefix in (
+                '', 't', 'top', 'd1', 'd1/', 'd1/k1', 'd1/k29', 'd10/',
+                'a/', 'a/b', 'a/b/', 'a/b/c', 'missing/', 'd1/missing'):
+            self.assertEqual(self._keys(prefix), self._expect(prefix))
+
+    def test_entries(self):
+        for batch in (1, 7, 1024):
+            pairs = list(self.db.scan('d1/', batch=batch))
+            self.assertEqual(sorted(key for key, entry in pairs),
+                             self._expect('d1/'))
+            # Only the latest revision of each key
+            for key, entry in pairs:
+                self.assertEqual(entry['d'], {'k': key, 'rev': 1})
+
+    def test_leading_delim(self):
+        # Keys are matched as written, the delimiter only picks the
+        # directory
+        self.assertEqual(self._keys('/lead/'), ['/lead/k'])
+        self.assertEqual(self._keys('/d10/'), [])
+        self.assertEqual(self._keys('lead/'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
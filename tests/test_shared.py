@@ -0,0 +1,131 @@
+'''
+Test a database shared between processes
+'''
+# Import python libs
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+
+# Import maras libs
+import maras.db
+import maras.utils.lock
+
+# Import third party libs
+if maras.utils.lock.HAS_FCNTL:
+    import fcntl
+
+# Insert revisions of keys from a process of its own
+WRITE = '''
+import sys
+import maras.db
+db = maras.db.DB(sys.argv[1], shared=True)
+db.open_db()
+db.add_index('test')
+for rev in range(3):
+    for num in range(100):
+        db.insert({'w': sys.argv[2], 'rev': rev},
+                  'd{0}/{1}{2}'.format(num % 3, sys.argv[2], num))
+db.close()
+'''
+
+
+@unittest.skipIf(not maras.utils.lock.HAS_FCNTL, 'flock is not available')
+class TestShared(unittest.TestCase):
+    '''
+    Lock hash map directories and read the writes of other handles
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _open(self, create=False):
+        db = maras.db.DB(self.path, shared=True)
+        if create:
+            db.create(sync='none', growable=False, hash_limit=0xf)
+        else:
+            db.open_db()
+        db.add_index('test')
+        return db
+
+    def _try_lock(self, exclusive):
+        fd_ = os.open(
+                os.path.join(self.path, maras.utils.lock.LOCK_NAME),
+                os.O_RDWR | os.O_CREAT)
+        try:
+            op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            fcntl.flock(fd_, op | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            os.close(fd_)
+
+    def test_locks(self):
+        locks = maras.utils.lock.ShardLocks()
+        with locks.write([self.path]):
+            self.assertFalse(self._try_lock(False))
+        with locks.read([self.path]):
+            self.assertTrue(self._try_lock(False))
+            self.assertFalse(self._try_lock(True))
+        self.assertTrue(self._try_lock(True))
+        # A writer waits for the readers to let go
+        done = threading.Event()
+
+        def _write():
+            with locks.write([self.path]):
+                done.set()
+        with locks.read([self.path]):
+            thread = threading.Thread(target=_write)
+            thread.start()
+            self.assertFalse(done.wait(0.2))
+        thread.join()
+        self.assertTrue(done.is_set())
+        self.assertEqual(locks.stats(), {'acquired': 4, 'waits': 1})
+
+    def test_handles(self):
+        writer = self._open(True)
+        reader = self._open()
+        writer.insert({'rev': 0}, 'd0/k0')
+        self.assertEqual(reader.get('d0/k0')['d'], {'rev': 0})
+        # New maps and revisions written after the reader opened them
+        for num in range(100):
+            writer.insert({'rev': 1}, 'd0/k{0}'.format(num))
+        for num in range(100):
+            self.assertEqual(
+                    reader.get('d0/k{0}'.format(num))['d'], {'rev': 1})
+        self.assertEqual(
+                len(list(reader.scan('d0/', keys_only=True))), 100)
+        reader.close()
+        writer.close()
+
+    def test_processes(self):
+        self._open(True).close()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(maras.__file__))] +
+                sys.path)
+        procs = [
+                subprocess.Popen(
+                    [sys.executable, '-c', WRITE, self.path, name],
+                    env=env)
+                for name in ('a', 'b')]
+        self.assertEqual([proc.wait() for proc in procs], [0, 0])
+        db = self._open()
+        keys = sorted(db.scan('', keys_only=True))
+        self.assertEqual(len(keys), 200)
+        entries, missing = db.get_many(keys)
+        self.assertEqual(missing, [])
+        for key, entry in zip(keys, entries):
+            self.assertEqual(entry['d']['w'], key.split('/')[1][0])
+            self.assertEqual(entry['d']['rev'], 2)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+'''
+Test streamed values
+'''
+# Import python libs
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+import maras.stor.mpack
+
+
+class TestStream(unittest.TestCase):
+    '''
+    Stream large values in and out of storage
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        self.db = maras.db.DB(self.path)
+        self.db.create(sync='none')
+        self.db.add_index('test')
+        # Spans a few read chunks and ends inside one
+        self.big = os.urandom(2 * maras.stor.mpack.CHUNK + 1234)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path, True)
+
+    def test_file_in(self):
+        self.db.insert(io.BytesIO(self.big), 'd/big', 'id1')
+        reader = self.db.get_stream('d/big')
+        self.assertEqual(reader.read(10), self.big[:10])
+        self.assertEqual(reader.tell(), 10)
+        reader.seek(-5, 2)
+        self.assertEqual(reader.read(), self.big[-5:])
+        reader.seek(0)
+        self.assertEqual(reader.read(), self.big)
+        self.assertEqual(reader.read(), b'')
+        reader.close()
+        self.assertEqual(self.db.get('d/big', 'id1')['d'], self.big)
+
+    def test_chunks_in(self):
+        chunks = [self.big[pos:pos + 100000]
+                  for pos in range(0, len(self.big), 100000)]
+        self.db.insert(iter(chunks), 'd/big')
+        self.db.insert({'small': 1}, 'd/other')
+        out = []
+        reader = self.db.get_stream('d/big')
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            out.append(chunk)
+        reader.close()
+        self.assertEqual(b''.join(out), self.big)
+        entries, missing = self.db.get_many(['d/other', 'd/big'])
+        self.assertEqual(entries[0]['d'], {'small': 1})
+        self.assertEqual(entries[1]['d'], self.big)
+
+    def test_small_values(self):
+        self.db.insert(b'short', 'd/bytes')
+        self.db.insert(b'x' * maras.stor.mpack.BLOB_MIN, 'd/edge')
+        self.db.insert({'not': 'bytes'}, 'd/dict')
+        self.assertEqual(self.db.get_stream('d/bytes').read(), b'short')
+        self.assertEqual(
+                self.db.get_stream('d/edge').read(),
+                b'x' * maras.stor.mpack.BLOB_MIN)
+        with self.assertRaises(ValueError):
+            self.db.get_stream('d/dict')
+
+    def test_revisions(self):
+        self.db.insert(io.BytesIO(self.big), 'd/big', 'old')
+        reader = self.db.get_stream('d/big')
+        self.db.insert(io.BytesIO(b'new' * 30000), 'd/big', 'new')
+        # A reader holds on to the revision it was opened on
+        self.assertEqual(reader.read(), self.big)
+        reader.close()
+        self.assertEqual(self.db.get_stream('d/big').read(), b'new' * 30000)
+        self.assertEqual(self.db.get_stream('d/big', 'old').read(), self.big)
+
+    def test_zblock(self):
+        self.db.add_storage('packed', 'zblock')
+        with self.assertRaises(ValueError):
+            self.db.insert(io.BytesIO(b'data'), 'd/z', stor='packed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''
+Test a database used from many threads
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+import threading
+
+# Import maras libs
+import maras.db
+
+THREADS = 8
+DIRS = 4
+
+
+class TestThreads(unittest.TestCase):
+    '''
+    Write the shards of a database in parallel and read them meanwhile
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+        self.db = maras.db.DB(self.path, threads=4)
+        self.db.create(sync='none', growable=False, hash_limit=0x3f)
+        self.db.add_index('test')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path, True)
+
+    def _run(self, target, count=THREADS):
+        errors = []
+
+        def _wrap(num):
+            try:
+                target(num)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=_wrap, args=(num,))
+                   for num in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_inserts(self):
+        def _insert(num):
+            for rev in range(3):
+                for ind in range(50):
+                    self.db.insert(
+                            {'t': num, 'rev': rev},
+                            'd{0}/t{1}_k{2}'.format(ind % DIRS, num, ind),
+                            't{0}_k{1}.{2}'.format(num, ind, rev))
+        self._run(_insert)
+        keys = sorted(self.db.scan('', keys_only=True))
+        self.assertEqual(len(keys), THREADS * 50)
+        for num in range(THREADS):
+            for ind in range(50):
+                key = 'd{0}/t{1}_k{2}'.format(ind % DIRS, num, ind)
+                self.assertEqual(self.db.get(key)['d'], {'t': num, 'rev': 2})
+                entry = self.db.get(key, 't{0}_k{1}.0'.format(num, ind))
+                self.assertEqual(entry['d'], {'t': num, 'rev': 0})
+
+    def test_insert_many(self):
+        recs = [({'n': num}, 'd{0}/k{1}'.format(num % DIRS, num))
+                for num in range(400)]
+        refs = self.db.insert_many(recs)
+        # The batches of the directories went to the pool
+        self.assertTrue(self.db.pool is not None)
+        self.assertEqual(len(refs), len(recs))
+        entries, missing = self.db.get_many([rec[1] for rec in recs])
+        self.assertEqual(missing, [])
+        self.assertEqual([entry['d'] for entry in entries],
+                         [rec[0] for rec in recs])
+
+    def test_read_while_writing(self):
+        self.db.insert_many(
+                [({'k': 'd{0}/k{1}'.format(num % DIRS, num), 'rev': 0},
+                  'd{0}/k{1}'.format(num % DIRS, num))
+                 for num in range(100)])
+
+        def _work(num):
+            for rev in range(1, 6):
+                for ind in range(100):
+                    key = 'd{0}/k{1}'.format(ind % DIRS, ind)
+                    if num % 2:
+                        self.db.insert({'k': key, 'rev': rev}, key)
+                    else:
+                        # Readers see a whole record of the key read
+                        self.assertEqual(self.db.get(key)['d']['k'], key)
+        self._run(_work, 4)
+        for ind in range(100):
+            key = 'd{0}/k{1}'.format(ind % DIRS, ind)
+            self.assertEqual(self.db.get(key)['d']['rev'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
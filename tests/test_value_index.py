@@ -0,0 +1,89 @@
+'''
+Test the value indexes and find
+'''
+# Import python libs
+import io
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestValueIndex(unittest.TestCase):
+    '''
+    Find records by field values as they are inserted and changed
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _open(self, create=False):
+        db = maras.db.DB(self.path)
+        if create:
+            db.create(sync='none')
+        else:
+            db.open_db()
+        db.add_index('test')
+        db.add_index('color', 'value', field='color')
+        db.add_index('city', 'value', field='addr.city')
+        db.add_index(
+                'len',
+                'value',
+                extract=lambda data: len(data.get('tags', ())) or None)
+        return db
+
+    def test_find(self):
+        db = self._open(True)
+        db.insert({'color': 'red', 'addr': {'city': 'x'}}, 'a/1')
+        db.insert_many([
+            ({'color': 'blue', 'tags': ['t1', 't2']}, 'a/2'),
+            ({'color': ['red', 'blue', 'red']}, 'b/3'),
+            ({'addr': 'flat'}, 'b/4'),
+            ])
+        self.assertEqual(db.find('color', 'red'), ['a/1', 'b/3'])
+        self.assertEqual(db.find('color', 'blue'), ['a/2', 'b/3'])
+        self.assertEqual(db.find('color', 'green'), [])
+        self.assertEqual(db.find('city', 'x'), ['a/1'])
+        self.assertEqual(db.find('len', 2), ['a/2'])
+        with self.assertRaises(ValueError):
+            db.find('test', 'red')
+        with self.assertRaises(ValueError):
+            db.find('missing', 'red')
+        db.close()
+
+    def test_changes(self):
+        db = self._open(True)
+        db.insert({'color': 'red'}, 'k1')
+        db.insert({'color': 'red'}, 'k2')
+        # New revisions move and drop keys
+        db.insert({'color': 'blue'}, 'k1')
+        db.insert({'shape': 'round'}, 'k2')
+        db.insert(io.BytesIO(b'raw'), 'k3')
+        self.assertEqual(db.find('color', 'red'), [])
+        self.assertEqual(db.find('color', 'blue'), ['k1'])
+        db.close()
+        db = self._open()
+        self.assertEqual(db.find('color', 'blue'), ['k1'])
+        self.assertEqual(db.indexes['color'].stats()['keys'], 1)
+        db.close()
+
+    def test_backfill(self):
+        db = maras.db.DB(self.path)
+        db.create(sync='none')
+        db.add_index('test')
+        for num in range(20):
+            db.insert({'parity': num % 2}, 'd/k{0:02}'.format(num))
+        # A new value index is built from the records already stored
+        db.add_index('parity', 'value', field='parity')
+        self.assertEqual(
+                db.find('parity', 1),
+                ['d/k{0:02}'.format(num) for num in range(1, 20, 2)])
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+Test the compressed block storage engine
+'''
+# Import python libs
+import shutil
+import tempfile
+import unittest
+
+# Import maras libs
+import maras.db
+
+
+class TestZBlock(unittest.TestCase):
+    '''
+    Write records in compressed blocks and read them back after reopening
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='maras_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def _create(self, **kwargs):
+        db = maras.db.DB(
+                self.path,
+                storage='zblock',
+                stor_opts={'codec': 'zlib', 'level': 1, 'block_size': 1024},
+                **kwargs)
+        db.create(sync='none')
+        db.add_index('test')
+        return db
+
+    def _reopen(self, **kwargs):
+        db = maras.db.DB(self.path, **kwargs)
+        db.open_db()
+        db.add_index('test')
+        return db
+
+    def test_reopen(self):
+        db = self._create()
+        for num in range(300):
+            db.insert({'n': num}, 'd{0}/k{1}'.format(num % 3, num))
+        db.close()
+        # The engine and its options come from the meta header
+        db = self._reopen()
+        self.assertEqual(db.default_stor, 'zblock')
+        self.assertEqual(db.default_storage.block_size, 1024)
+        self.assertEqual(db.default_storage.level, 1)
+        for num in range(300):
+            entry = db.get('d{0}/k{1}'.format(num % 3, num))
+            self.assertEqual(entry['d'], {'n': num})
+        db.insert({'n': 300}, 'd0/k300')
+        db.close()
+        db = self._reopen()
+        self.assertEqual(db.get('d0/k300')['d'], {'n': 300})
+        db.close()
+
+    def test_insert_many(self):
+        db = self._create(meter=True)
+        recs = [({'n': num, 'pad': 'x' * 40}, 'k{0}'.format(num))
+                for num in range(100)]
+        db.insert_many(recs)
+        stats = db.stats()['meter']['counters']
+        blocks = sum(
+                len(state['table'])
+                for state in db.default_storage.state.values())
+        self.assertTrue(blocks > 1)
+        # A block is appended to once and then written compressed, the
+        # records of the open block are appended once more
+        self.assertEqual(stats['stor.writes'], 2 * blocks + 1)
+        self.assertEqual(db.get_many([rec[1] for rec in recs])[1], [])
+        db.close()
+        db = self._reopen()
+        entries, missing = db.get_many([rec[1] for rec in recs])
+        self.assertEqual(missing, [])
+        self.assertEqual([entry['d'] for entry in entries],
+                         [rec[0] for rec in recs])
+        db.close()
+
+    def test_passed_storage(self):
+        db = self._create()
+        db.insert({'n': 1}, 'old')
+        db.close()
+        # Records written with the saved engine stay readable
+        db = self._reopen(storage='msgpack')
+        self.assertEqual(db.default_stor, 'msgpack')
+        db.insert({'n': 2}, 'new')
+        self.assertEqual(db.get('old')['d'], {'n': 1})
+        self.assertEqual(db.get('new')['d'], {'n': 2})
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()